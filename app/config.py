@@ -15,4 +15,80 @@ WEBHOOK_URL = f"{WEBHOOK_DOMAIN}{WEBHOOK_PATH}"
 
 # Настройки локального сервера (aiohttp)
 WEBAPP_HOST = "127.0.0.1"
-WEBAPP_PORT = 8085
\ No newline at end of file
+WEBAPP_PORT = 8085
+
+# Настройки матчмейкера
+# "lua" — атомарные скрипты в Redis, "python" — эталонная реализация (тесты/симуляции)
+MATCHMAKER_ENGINE = os.getenv("MATCHMAKER_ENGINE", "lua")
+PREFS_TTL = 86400
+# Через сколько секунд ожидания в очереди подключаем ИИ
+AI_FALLBACK_TIMEOUT = int(os.getenv("AI_FALLBACK_TIMEOUT", "10"))
+# На сколько секунд VIP "старше" обычных юзеров в очереди (обычный юзер,
+# прождавший дольше буста, все равно обгонит только что пришедшего VIP)
+VIP_QUEUE_BOOST = int(os.getenv("VIP_QUEUE_BOOST", "5"))
+# Режим подбора: "fifo" — кто дольше ждет, "scored" — с учетом возраста и
+# рейтинга, окно допустимой разницы расширяется с ожиданием кандидата
+MATCH_MODE = os.getenv("MATCH_MODE", "fifo")
+MATCH_AGE_BAND = 2           # ширина возраст-бакета в индексе (лет)
+MATCH_AGE_WINDOW = 2         # допустимая разница в возрасте сразу после входа (лет)
+MATCH_RATING_WINDOW = 1      # допустимая разница рейтинга сразу после входа (звезд)
+MATCH_WIDEN_SECONDS = 8      # через сколько секунд ожидания подходит кто угодно
+# Не сводим повторно с последними собеседниками (кнопка "Следующий")
+RECENT_PARTNERS_MAX = 3
+RECENT_PARTNERS_TTL = 600
+# Сколько юзеров одновременно переводим к ИИ (запросы к Telegram)
+AI_HANDOFF_CONCURRENCY = int(os.getenv("AI_HANDOFF_CONCURRENCY", "20"))
+# Сессия чата без сообщений дольше этого времени считается зависшей и закрывается
+SESSION_TTL = int(os.getenv("SESSION_TTL", "21600"))
+# Счетчики сообщений и продление сессий копятся в памяти и уходят в Redis раз в столько секунд
+SESSION_PUSH_SECONDS = 5
+# Локальный кэш маршрутов пересылки (партнер, имя): страховочный TTL и размер
+ROUTE_CACHE_TTL = 60
+ROUTE_CACHE_SIZE = 50000
+# Кэш профилей (пол, фильтр, возраст, VIP, ник, рейтинг): локальный LRU + хеш в Redis
+PROFILE_CACHE_TTL = 300
+PROFILE_CACHE_SIZE = 20000
+PROFILE_CACHE_REDIS = os.getenv("PROFILE_CACHE_REDIS", "1") == "1"
+PROFILE_CACHE_REDIS_TTL = 600
+# Как часто узел сверяет локальную копию реестра банов с Redis (сек)
+BAN_REFRESH_SECONDS = 5
+# Оценки: как часто сбрасываем буфер в БД и сколько после чата можно оценить собеседника
+RATING_FLUSH_SECONDS = 30
+RATED_TTL = 7 * 86400
+# Альбомы: сколько секунд тишины после очередной части считаем альбом собранным
+ALBUM_WINDOW = 0.6
+# Очистка метаданных картинок (app/utils/security.py): максимум байт (лимит
+# скачивания Bot API — 20 МБ), пикселей для пересохранения и потоков пула
+SANITIZE_MAX_BYTES = 20 * 1024 * 1024
+SANITIZE_MAX_PIXELS = 50_000_000
+SANITIZE_WORKERS = int(os.getenv("SANITIZE_WORKERS", "2"))
+# Пересылка картинок-файлов (app/services/media.py): сколько байт файлов узел
+# держит в работе одновременно и до какого размера буфер живет в памяти, а не
+# поверх временного файла
+MEDIA_INFLIGHT_BYTES = int(os.getenv("MEDIA_INFLIGHT_BYTES", str(128 * 1024 * 1024)))
+MEDIA_SPOOL_MEMORY = 1024 * 1024
+# Кэш очищенных копий (file_unique_id -> file_id): сколько записей и как долго
+# хранить с последнего использования (сек)
+MEDIA_CACHE_SIZE = int(os.getenv("MEDIA_CACHE_SIZE", "100000"))
+MEDIA_CACHE_TTL = 30 * 86400
+# Исходящие сообщения узла (app/middlewares/outbound.py): общий лимит в секунду
+# (у Telegram ~30), лимит и всплеск на один чат, сколько раз повторять после
+# RetryAfter и дольше скольких секунд паузы не ждать (ошибка уходит вызывающему)
+OUTBOUND_RATE = int(os.getenv("OUTBOUND_RATE", "28"))
+OUTBOUND_CHAT_RATE = 1
+OUTBOUND_CHAT_BURST = 3
+OUTBOUND_MAX_RETRIES = 3
+OUTBOUND_MAX_RETRY_AFTER = 30
+# Рассылки (темп задает полоса BACKGROUND общего лимита исходящих): параллельных отправок,
+# размер страницы получателей (= максимум повторов после падения) и как часто
+# обновлять прогресс у админа (сек)
+BROADCAST_CONCURRENCY = 10
+BROADCAST_PAGE_SIZE = 100
+BROADCAST_PROGRESS_SECONDS = 5
+# Недоступные юзеры (заблокировали бота): как часто пишем флаг в БД (сек)
+REACHABILITY_FLUSH_SECONDS = 30
+# Активность: локально не чаще раза в ACTIVITY_COALESCE_SECONDS на юзера,
+# в Redis — пачкой раз в ACTIVITY_PUSH_SECONDS, last_seen_at в БД — раз в ACTIVITY_FLUSH_SECONDS
+ACTIVITY_COALESCE_SECONDS = 60
+ACTIVITY_PUSH_SECONDS = 10
+ACTIVITY_FLUSH_SECONDS = 300
@@ -1,6 +1,11 @@
 from sqlalchemy import select, func
 from sqlalchemy.ext.asyncio import AsyncSession
 from app.database.models import Report, User
+from app.services.profile_cache import Profile, profile_cache, invalidate_profile
+from app.services.ban_registry import ban_registry
+from app.database.lazy_session import LazySession
+from app.services.ratings import get_pending_rating, merge_rating
+from app.services.stats import track_user_created, track_vip, track_ban, track_report
 import datetime
 
 async def get_or_create_user(session: AsyncSession, telegram_id: int, referrer_id: int = None):
@@ -35,17 +40,27 @@ async def get_or_create_user(session: AsyncSession, telegram_id: int, referrer_i
                     referral_event = {"id": referrer_id, "count": count, "bonus": False}
                     
         await session.commit()
+        await track_user_created()
+        if referral_event and referral_event["bonus"]:
+            await invalidate_profile(referrer_id)
+            await track_vip(referrer_id, referrer.gender, referrer.vip_until)
         
     return user, referral_event
 
-async def update_user_rating(session: AsyncSession, user_id: int, score: int):
-    user, _ = await get_or_create_user(session, user_id)
-    # Формула пересчета среднего значения
-    new_rating = ((user.rating * user.rating_count) + score) / (user.rating_count + 1)
-    
-    user.rating = round(new_rating, 2)
-    user.rating_count += 1
-    await session.commit()
+async def get_user_profile(session: AsyncSession, telegram_id: int) -> Profile:
+    """Профиль для хендлеров (пол, фильтр, возраст, VIP, ник, рейтинг) через кэш.
+    При промахе — get_or_create_user, так что новый юзер создается как раньше."""
+    profile = await profile_cache.get(telegram_id)
+    if profile is None:
+        user, _ = await get_or_create_user(session, telegram_id)
+        profile = Profile.from_user(user)
+        # Оценки, еще не сброшенные в БД
+        profile.rating = merge_rating(user.rating, user.rating_count, *await get_pending_rating(telegram_id))
+        await profile_cache.put(profile)
+        # Дальше хендлер обычно ходит в Telegram/Redis — не держим соединение из пула
+        if isinstance(session, LazySession):
+            await session.release()
+    return profile
 
 async def add_report_and_check_ban(session: AsyncSession, reported_id: int, reporter_id: int, reason: str, ban_times: dict):
     # Добавляем запись о жалобе в таблицу reports
@@ -63,15 +78,22 @@ async def add_report_and_check_ban(session: AsyncSession, reported_id: int, repo
         if report_count >= 5:
             user.is_banned = True
             await session.commit()
+            await track_report()
+            await ban_registry.ban_permanent(reported_id)
+            await track_ban(reported_id, user.gender, permanent=True)
             return {"is_banned": True, "permanent": True}
             
         duration_sec = ban_times.get(report_count, 0)
         if duration_sec > 0:
             user.ban_until = datetime.datetime.utcnow() + datetime.timedelta(seconds=duration_sec)
             await session.commit()
+            await track_report()
+            await ban_registry.ban_until(reported_id, user.ban_until)
+            await track_ban(reported_id, user.gender, user.ban_until)
             return {"is_banned": True, "duration": duration_sec // 60}
             
     await session.commit()
+    await track_report()
     return {"is_banned": False}
 
 async def is_user_banned(session, user_id: int):
@@ -0,0 +1,84 @@
+# app/database/lazy_session.py
+"""Ленивая сессия БД для апдейтов и счетчики запросов на апдейт.
+
+LazySession создает AsyncSession только при первом обращении хендлера к ней:
+пересылка текста, стикеры и большинство колбэков вообще не трогают пул.
+Соединение AsyncSession берет на первом запросе и отдает после commit;
+release() завершает чтение без изменений, чтобы не держать соединение
+на время медленных вызовов Telegram/Gemini.
+"""
+import contextvars
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession, async_sessionmaker
+
+# Счетчики текущего апдейта: {"sessions": ..., "queries": ...}
+db_stats: contextvars.ContextVar[dict | None] = contextvars.ContextVar("db_stats", default=None)
+
+
+class DbMetrics:
+    def __init__(self):
+        self.updates = 0
+        self.updates_with_db = 0
+        self.sessions = 0
+        self.queries = 0
+        self.max_queries = 0
+
+    def record(self, stats: dict):
+        self.updates += 1
+        if stats["sessions"]:
+            self.updates_with_db += 1
+        self.sessions += stats["sessions"]
+        self.queries += stats["queries"]
+        self.max_queries = max(self.max_queries, stats["queries"])
+
+    def snapshot(self) -> dict:
+        return {
+            "updates": self.updates,
+            "db_share": self.updates_with_db / self.updates if self.updates else 0.0,
+            "avg_queries": self.queries / self.updates_with_db if self.updates_with_db else 0.0,
+            "max_queries": self.max_queries,
+            "sessions": self.sessions,
+        }
+
+
+db_metrics = DbMetrics()
+
+
+def instrument_engine(engine: AsyncEngine):
+    """Считает SQL-запросы в счетчик текущего апдейта"""
+    @event.listens_for(engine.sync_engine, "before_cursor_execute")
+    def _count_query(conn, cursor, statement, parameters, context, executemany):
+        stats = db_stats.get()
+        if stats is not None:
+            stats["queries"] += 1
+
+
+class LazySession:
+    """Прокси AsyncSession: настоящая сессия открывается при первом обращении"""
+
+    def __init__(self, session_pool: async_sessionmaker):
+        self._session_pool = session_pool
+        self._session: AsyncSession | None = None
+
+    def _get_session(self) -> AsyncSession:
+        if self._session is None:
+            self._session = self._session_pool()
+            stats = db_stats.get()
+            if stats is not None:
+                stats["sessions"] += 1
+        return self._session
+
+    def __getattr__(self, name):
+        return getattr(self._get_session(), name)
+
+    async def release(self):
+        """Отдает соединение в пул, если сессия только читала (нет несохраненных изменений).
+        Объекты остаются в сессии (expire_on_commit=False) и пригодны для записи дальше."""
+        session = self._session
+        if session is not None and session.in_transaction() and not (session.new or session.dirty or session.deleted):
+            await session.commit()
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
@@ -0,0 +1,133 @@
+# app/database/migrations.py
+"""Версионные миграции схемы вместо create_all на каждом старте.
+
+Применённые версии записаны в таблице schema_version. На старте migrate()
+делает два дешевых запроса (есть ли таблица и какая версия) и, только если
+схема отстала, применяет недостающие миграции — каждую в своей транзакции
+под advisory lock, чтобы узлы, стартующие одновременно, не мигрировали дважды.
+
+Миграция 1 — схема в том виде, в каком ее создавал create_all (IF NOT EXISTS:
+на существующих базах ничего не делает). Новые изменения — только новой
+миграцией в конец MIGRATIONS; модели (app/database/models.py) держим в
+соответствии. Индексы создаются обычным CREATE INDEX (блокирует запись в
+таблицу на время построения); на большой базе их можно заранее построить
+вручную с CONCURRENTLY под теми же именами — миграция их пропустит.
+"""
+import logging
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+# Любое число, одинаковое на всех узлах
+MIGRATION_LOCK_ID = 20240601
+
+MIGRATIONS: list[tuple[int, str, list[str]]] = [
+    (1, "Базовая схема (users, reports, transactions)", [
+        """
+        CREATE TABLE IF NOT EXISTS users (
+            telegram_id BIGSERIAL NOT NULL,
+            rating FLOAT NOT NULL,
+            rating_count INTEGER NOT NULL,
+            vip_until TIMESTAMP WITHOUT TIME ZONE,
+            referrer_id BIGINT,
+            referrals_count INTEGER NOT NULL,
+            is_banned BOOLEAN NOT NULL,
+            ban_until TIMESTAMP WITHOUT TIME ZONE,
+            strikes INTEGER NOT NULL,
+            created_at TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+            nickname VARCHAR(32),
+            nickname_changes INTEGER NOT NULL,
+            last_nickname_change TIMESTAMP WITHOUT TIME ZONE,
+            gender VARCHAR(1),
+            age INTEGER,
+            search_gender VARCHAR(3) NOT NULL,
+            PRIMARY KEY (telegram_id),
+            FOREIGN KEY (referrer_id) REFERENCES users (telegram_id)
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS reports (
+            id SERIAL NOT NULL,
+            reporter_id BIGINT NOT NULL,
+            reported_id BIGINT NOT NULL,
+            reason VARCHAR NOT NULL,
+            created_at TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+            PRIMARY KEY (id)
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS transactions (
+            id SERIAL NOT NULL,
+            user_id BIGINT NOT NULL,
+            amount INTEGER NOT NULL,
+            created_at TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+            PRIMARY KEY (id)
+        )
+        """,
+    ]),
+    (2, "Доступность и активность юзеров", [
+        "ALTER TABLE users ADD COLUMN IF NOT EXISTS unreachable_since TIMESTAMP WITHOUT TIME ZONE",
+        "ALTER TABLE users ADD COLUMN IF NOT EXISTS last_seen_at TIMESTAMP WITHOUT TIME ZONE",
+    ]),
+    (3, "Индексы под фильтры по VIP, банам, рефералам, жалобам и платежам", [
+        # Частичные: VIP/бан/реферер есть у малой доли юзеров, индекс маленький.
+        # "vip_until > now()" планировщик сводит к "IS NOT NULL" (оператор строгий)
+        "CREATE INDEX IF NOT EXISTS ix_users_vip_until ON users (vip_until) WHERE vip_until IS NOT NULL",
+        "CREATE INDEX IF NOT EXISTS ix_users_ban_until ON users (ban_until) WHERE ban_until IS NOT NULL",
+        # Вечные баны: "is_banned OR ban_until > now()" — BitmapOr двух частичных индексов
+        "CREATE INDEX IF NOT EXISTS ix_users_permanent_ban ON users (telegram_id) WHERE is_banned",
+        # Поиск рефералов и проверка внешнего ключа при удалении юзера
+        "CREATE INDEX IF NOT EXISTS ix_users_referrer_id ON users (referrer_id) WHERE referrer_id IS NOT NULL",
+        "CREATE INDEX IF NOT EXISTS ix_reports_reported_id ON reports (reported_id)",
+        "CREATE INDEX IF NOT EXISTS ix_reports_reporter_id ON reports (reporter_id)",
+        # Платежи юзера; amount в INCLUDE — сумма по юзеру без обращения к таблице
+        "CREATE INDEX IF NOT EXISTS ix_transactions_user_id ON transactions (user_id) INCLUDE (amount)",
+    ]),
+    (4, "Примененные пачки оценок (защита от повторного сброса)", [
+        """
+        CREATE TABLE IF NOT EXISTS rating_batches (
+            batch_id VARCHAR(32) NOT NULL,
+            applied_at TIMESTAMP WITHOUT TIME ZONE NOT NULL DEFAULT (now() AT TIME ZONE 'utc'),
+            PRIMARY KEY (batch_id)
+        )
+        """,
+    ]),
+]
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+
+async def get_schema_version(conn) -> int:
+    if not await conn.scalar(text("SELECT to_regclass('schema_version') IS NOT NULL")):
+        return 0
+    return await conn.scalar(text("SELECT COALESCE(MAX(version), 0) FROM schema_version"))
+
+
+async def migrate(engine: AsyncEngine):
+    """Проверка версии схемы на старте; применяет недостающие миграции"""
+    async with engine.connect() as conn:
+        version = await get_schema_version(conn)
+    if version >= LATEST_VERSION:
+        return
+
+    for target, description, statements in MIGRATIONS:
+        if target <= version:
+            continue
+        async with engine.begin() as conn:
+            await conn.execute(text("SELECT pg_advisory_xact_lock(:id)"), {"id": MIGRATION_LOCK_ID})
+            await conn.execute(text("""
+                CREATE TABLE IF NOT EXISTS schema_version (
+                    version INTEGER PRIMARY KEY,
+                    description TEXT NOT NULL,
+                    applied_at TIMESTAMP WITHOUT TIME ZONE NOT NULL DEFAULT (now() AT TIME ZONE 'utc')
+                )
+            """))
+            # Пока ждали блокировку, миграцию мог применить другой узел
+            if await get_schema_version(conn) >= target:
+                continue
+            for statement in statements:
+                await conn.execute(text(statement))
+            await conn.execute(
+                text("INSERT INTO schema_version (version, description) VALUES (:version, :description)"),
+                {"version": target, "description": description},
+            )
+        logging.info(f"Applied schema migration {target}: {description}")
@@ -1,13 +1,22 @@
 # app/database/models.py
 from datetime import datetime
-from sqlalchemy import BigInteger, String, Float, Integer, Boolean, DateTime, ForeignKey, func
+from sqlalchemy import BigInteger, String, Float, Integer, Boolean, DateTime, ForeignKey, Index, func, text
 from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column
 
 class Base(DeclarativeBase):
     pass
 
+# Схема меняется только миграциями (app/database/migrations.py);
+# индексы здесь повторяют их, чтобы метаданные совпадали с базой
+
 class User(Base):
     __tablename__ = 'users'
+    __table_args__ = (
+        Index("ix_users_vip_until", "vip_until", postgresql_where=text("vip_until IS NOT NULL")),
+        Index("ix_users_ban_until", "ban_until", postgresql_where=text("ban_until IS NOT NULL")),
+        Index("ix_users_permanent_ban", "telegram_id", postgresql_where=text("is_banned")),
+        Index("ix_users_referrer_id", "referrer_id", postgresql_where=text("referrer_id IS NOT NULL")),
+    )
     
     telegram_id: Mapped[int] = mapped_column(BigInteger, primary_key=True)
     rating: Mapped[float] = mapped_column(Float, default=5.0)
@@ -32,9 +41,17 @@ class User(Base):
     gender: Mapped[str | None] = mapped_column(String(1), nullable=True) # 'M' или 'F'
     age: Mapped[int | None] = mapped_column(Integer, nullable=True)
     search_gender: Mapped[str] = mapped_column(String(3), default="any") # 'M', 'F' или 'any'
+    # Когда Telegram ответил "бот заблокирован" (None — доступен)
+    unreachable_since: Mapped[datetime | None] = mapped_column(DateTime, nullable=True)
+    # Последняя активность (пишется пакетно из Redis, app/services/activity.py)
+    last_seen_at: Mapped[datetime | None] = mapped_column(DateTime, nullable=True)
 
 class Report(Base):
     __tablename__ = 'reports'
+    __table_args__ = (
+        Index("ix_reports_reported_id", "reported_id"),
+        Index("ix_reports_reporter_id", "reporter_id"),
+    )
     
     id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
     reporter_id: Mapped[int] = mapped_column(BigInteger)
@@ -44,8 +61,18 @@ class Report(Base):
 
 class Transaction(Base):
     __tablename__ = 'transactions'
+    __table_args__ = (
+        Index("ix_transactions_user_id", "user_id", postgresql_include=["amount"]),
+    )
     
     id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
     user_id: Mapped[int] = mapped_column(BigInteger)
     amount: Mapped[int] = mapped_column(Integer) # Сумма в звездах
-    created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
\ No newline at end of file
+    created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
+
+class RatingBatch(Base):
+    __tablename__ = 'rating_batches'
+
+    # id пачки оценок из Redis, уже примененной к users (app/services/ratings.py)
+    batch_id: Mapped[str] = mapped_column(String(32), primary_key=True)
+    applied_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
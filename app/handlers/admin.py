@@ -1,17 +1,27 @@
 import datetime
-import asyncio
 from aiogram import Router, F, Bot
 from aiogram.types import Message, CallbackQuery
 from aiogram.filters import Command
 from aiogram.fsm.context import FSMContext
-from sqlalchemy import select, func
-from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
 
 from app.filters.admin_filter import IsAdmin
 from app.utils.states import AdminState
-from app.keyboards.admin_kb import get_admin_main_kb, get_admin_cancel_kb
-from app.database.models import User, Report, Transaction
-from app.services.matchmaker import redis_client
+from app.keyboards.admin_kb import get_admin_main_kb, get_admin_cancel_kb, get_broadcast_kb, get_broadcast_segment_kb
+from app.database.models import User, Transaction
+from app.services.matchmaker import redis_client, get_queue_stats, get_match_quality, count_live_sessions
+from app.middlewares.ordering import metrics as ordering_metrics
+from app.middlewares.outbound import metrics as outbound_metrics
+from app.utils.security import metrics as sanitize_metrics
+from app.services.media import budget as media_budget
+from app.services.route_cache import route_cache
+from app.services.profile_cache import profile_cache, invalidate_profile
+from app.services.ban_registry import ban_registry
+from app.database.lazy_session import db_metrics
+from app.services.stats import get_stats, track_vip, track_ban, track_payment
+from app.services.broadcast import create_broadcast, start_broadcast, set_broadcast_status
+from app.services.activity import count_active
 
 # Подключаем роутер и вешаем на него фильтр IsAdmin(). 
 # Теперь ни один хендлер в этом роутере не сработает для обычного юзера.
@@ -33,53 +43,103 @@ async def admin_cancel(callback: CallbackQuery, state: FSMContext):
     await callback.answer()
 
 # ==========================================
-# СТАТИСТИКА (Сбор данных из PG и Redis)
+# СТАТИСТИКА (счетчики в Redis, app/services/stats.py)
 # ==========================================
+def _by_gender(counts: dict) -> str:
+    return f"👨 {counts['M']} / 👩 {counts['F']} / ❔ {counts['?']}"
+
 @router.callback_query(F.data == "admin_stats")
-async def show_statistics(callback: CallbackQuery, session: AsyncSession):
-    # 1. Данные из БД (PostgreSQL)
-    total_users = await session.scalar(select(func.count(User.telegram_id)))
-    
-    now = datetime.datetime.utcnow()
-    banned_users = await session.scalar(select(func.count(User.telegram_id)).where(User.ban_until > now))
-    vip_users = await session.scalar(select(func.count(User.telegram_id)).where(User.vip_until > now))
-    total_reports = await session.scalar(select(func.count(Report.id)))
-    total_stars = await session.scalar(select(func.sum(Transaction.amount))) or 0
-    
-    # Добавь это в текст ответа:
-    text = (
-        f"📊 <b>Статистика:</b>\n\n"
-        f"💰 Заработано всего: <b>{total_stars} ⭐️</b>\n"
-        # ... остальной текст статистики ...
-    )
+async def show_statistics(callback: CallbackQuery):
+    # 1. Накопительные счетчики — без COUNT(*) по таблицам
+    st = await get_stats()
     
     # 2. Данные реального времени (Redis)
-    normal_q_len = await redis_client.llen("queue:normal")
-    vip_q_len = await redis_client.llen("queue:vip")
-    
-    # Считаем количество активных чатов (грубый, но быстрый подсчет по ключам)
-    # Используем scan для неблокирующего поиска ключей
-    chat_keys = []
-    cursor = '0'
-    while cursor != 0:
-        cursor, keys = await redis_client.scan(cursor=cursor, match='chat:*', count=100)
-        chat_keys.extend(keys)
+    queue_stats = await get_queue_stats()
+    queued_total = sum(q["length"] for q in queue_stats.values())
+    oldest_wait = max((q["oldest_wait"] for q in queue_stats.values()), default=0)
+    queue_lines = "".join(
+        f"  {name.split(':', 1)[1]}: <b>{q['length']}</b> (ждет {q['oldest_wait']} с)\n"
+        for name, q in queue_stats.items() if q["length"]
+    )
     
-    # В Redis каждый чат это 2 ключа (chat:A=B и chat:B=A). Значит чатов = ключи / 2
-    active_chats = len(chat_keys) // 2
+    # Активные чаты — O(1) по индексу сессий (включая чаты с ИИ)
+    active_chats = await count_live_sessions()
     
     ai_chats_count = await redis_client.scard("ai_chats")
 
+    # Качество подбора по режимам (FIFO / с учетом возраста и рейтинга)
+    quality_lines = ""
+    for mode, q in (await get_match_quality()).items():
+        quality_lines += (
+            f"\n🎯 <b>Подбор ({mode}):</b> пар {q['matches']} (из ожидания {q['rematches']}), к ИИ {q['ai_fallbacks']}\n"
+            f"  Δ возраст: {q['avg_age_diff']:.1f} | Δ рейтинг: {q['avg_rating_diff']:.2f} | ожидание: {q['avg_wait']:.1f} с"
+        )
+
+    # Метрики этого процесса (у каждого узла свои), по строке на подсистему.
+    # Очереди апдейтов по юзерам
+    om = ordering_metrics.snapshot()
+    node_lines = (
+        f"\n\n⏳ <b>Апдейты:</b> ждут {om['waiting']}, макс. очередь {om['max_depth']}, "
+        f"ожидание ср. {om['avg_wait_ms']:.0f} / макс. {om['max_wait_ms']:.0f} мс, отброшено {om['dropped']}"
+    )
+    rc = route_cache.stats()
+    node_lines += (
+        f"\n🧭 <b>Кэш маршрутов:</b> {rc['size']} записей, попаданий {rc['hit_ratio']:.0%}, "
+        f"инвалидаций {rc['invalidations']}"
+    )
+    pc = profile_cache.stats()
+    node_lines += (
+        f"\n🗂 <b>Кэш профилей:</b> {pc['size']} записей, попаданий {pc['hit_ratio']:.0%} "
+        f"(локально {pc['local_hits']}, Redis {pc['redis_hits']}, из БД {pc['misses']})"
+    )
+    ob = outbound_metrics.snapshot()
+    lanes = ob["sent_by_lane"]
+    node_lines += (
+        f"\n📤 <b>Исходящие:</b> {ob['sent']} (чаты {lanes['relay']}, ответы {lanes['interactive']}, "
+        f"рассылки {lanes['background']}), ждут {ob['waiting']}, "
+        f"задержка ср. {ob['avg_wait_ms']:.0f} / макс. {ob['max_wait_ms']:.0f} мс, "
+        f"429: {ob['retry_after']} (повторов {ob['retried']}, сдались {ob['gave_up']})"
+    )
+    sm = sanitize_metrics.snapshot()
+    node_lines += (
+        f"\n🧹 <b>Очистка метаданных:</b> {sm['count']} "
+        f"({', '.join(f'{name} {count}' for name, count in sm['by_method'].items()) or '-'}), "
+        f"ср. {sm['avg_ms']:.0f} / макс. {sm['max_ms']:.0f} мс, в работе {sm['in_progress']}, "
+        f"{sm['bytes_in'] // 1024} → {sm['bytes_out'] // 1024} КБ"
+    )
+    mb = media_budget.snapshot()
+    node_lines += (
+        f"\n📦 <b>Файлы в работе:</b> {mb['in_flight'] // 1024} из {mb['capacity'] // 1024} КБ "
+        f"(пик {mb['peak'] // 1024} КБ), ждут {mb['waiting']}, ждали {mb['waits']} раз"
+    )
+    dm = db_metrics.snapshot()
+    node_lines += (
+        f"\n🗄 <b>БД:</b> апдейтов с запросами {dm['db_share']:.0%} из {dm['updates']}, "
+        f"запросов на апдейт ср. {dm['avg_queries']:.1f} / макс. {dm['max_queries']}"
+    )
+
+    cache_lookups = st["media_cache_hits"] + st["media_cache_misses"]
+    cache_ratio = st["media_cache_hits"] / cache_lookups if cache_lookups else 0.0
+
     text = (
         f"📊 <b>Статистика реального времени:</b>\n\n"
-        f"👥 Всего пользователей: <b>{total_users}</b>\n"
-        f"👑 Активных VIP: <b>{vip_users}</b>\n"
-        f"🚫 В бане: <b>{banned_users}</b>\n"
-        f"⚠️ Всего жалоб за все время: <b>{total_reports}</b>\n\n"
+        f"👥 Всего пользователей: <b>{st['users']}</b> ({_by_gender(st['users_by_gender'])})\n"
+        f"👑 Активных VIP: <b>{st['vip']}</b> ({_by_gender(st['vip_by_gender'])})\n"
+        f"🚫 В бане: <b>{st['banned']}</b> ({_by_gender(st['banned_by_gender'])})\n"
+        f"🔕 Заблокировали бота: <b>{st['unreachable']}</b>\n"
+        f"📈 Активны: за сутки <b>{st['dau']}</b>, за 7 дней <b>{st['wau']}</b>, за 30 дней <b>{st['mau']}</b>\n"
+        f"⚠️ Всего жалоб за все время: <b>{st['reports']}</b>\n"
+        f"💰 Заработано всего: <b>{st['stars']} ⭐️</b> (платежей: {st['payments']})\n"
+        f"💬 Чатов начато: <b>{st['chats_started']}</b> (с ИИ: {st['chats_ai']}), завершено: {st['chats_ended']}\n"
+        f"🔍 Входов в поиск: <b>{st['queue_joins']}</b> ({_by_gender(st['queue_joins_by_gender'])})\n"
+        f"🖼 Кэш очищенных файлов: попаданий <b>{cache_ratio:.0%}</b> "
+        f"({st['media_cache_hits']} из {cache_lookups}), не скачано {st['media_cache_bytes_saved'] // (1024 * 1024)} МБ\n\n"
         f"⚡️ <b>Прямо сейчас (Redis):</b>\n"
-        f"Очередь (обычная): <b>{normal_q_len}</b>\n"
-        f"Очередь (VIP): <b>{vip_q_len}</b>\n"
+        f"В очереди: <b>{queued_total}</b> (дольше всех ждет: {oldest_wait} с)\n"
+        f"{queue_lines}"
         f"Активных чатов: <b>{active_chats}</b> (из них с ИИ: {ai_chats_count})"
+        f"{quality_lines}"
+        f"{node_lines}"
     )
     
     await callback.message.edit_text(text, parse_mode="HTML", reply_markup=get_admin_main_kb())
@@ -110,6 +170,8 @@ async def process_ban_id(message: Message, state: FSMContext, session: AsyncSess
     else:
         user.ban_until = datetime.datetime.utcnow() + datetime.timedelta(days=30)
         await session.commit()
+        await ban_registry.ban_until(target_id, user.ban_until)
+        await track_ban(target_id, user.gender, user.ban_until, permanent=user.is_banned)
         
         # Пытаемся уведомить пользователя
         try:
@@ -153,6 +215,8 @@ async def process_unban_id(message: Message, state: FSMContext, session: AsyncSe
         user.strikes = 0 
         
         await session.commit()
+        await ban_registry.unban(target_id)
+        await track_ban(target_id, user.gender)
         
         # Радуем пользователя
         try:
@@ -268,6 +332,8 @@ async def process_set_vip_duration(callback: CallbackQuery, session: AsyncSessio
         user_msg = f"👑 <b>Поздравляем!</b>\nАдминистратор выдал вам VIP-статус на {days} дней!\nТеперь вы можете отправлять фото, видео и кружочки!"
 
     await session.commit()
+    await invalidate_profile(target_id)
+    await track_vip(target_id, user.gender, user.vip_until)
     
     # Пытаемся уведомить пользователя
     try:
@@ -297,6 +363,9 @@ async def approve_receipt(callback: CallbackQuery, session: AsyncSession, bot: B
         session.add(new_tx)
         
         await session.commit()
+        await invalidate_profile(target_user_id)
+        await track_vip(target_user_id, user.gender, user.vip_until)
+        await track_payment(150)
         
         # Радуем юзера
         try:
@@ -340,82 +409,56 @@ async def reject_receipt(callback: CallbackQuery, bot: Bot):
 # ГЛОБАЛЬНАЯ РАССЫЛКА
 # ==========================================
 @router.callback_query(F.data == "admin_broadcast")
+async def ask_broadcast_segment(callback: CallbackQuery):
+    # Размер сегментов — оценка по HyperLogLog активности, без запросов к БД
+    wau, mau = await count_active(7), await count_active(30)
+    await callback.message.edit_text(
+        "📢 <b>Рассылка сообщений</b>\n\n"
+        "Кому отправить?\n"
+        f"Активных за 7 дней: ~<b>{wau}</b>, за 30 дней: ~<b>{mau}</b>",
+        parse_mode="HTML",
+        reply_markup=get_broadcast_segment_kb()
+    )
+    await callback.answer()
+
+@router.callback_query(F.data.startswith("bseg_"))
 async def ask_broadcast_msg(callback: CallbackQuery, state: FSMContext):
+    # bseg_<активны за N дней> (0 — все)
+    active_days = int(callback.data.split("_")[1])
     await state.set_state(AdminState.waiting_for_broadcast_msg)
+    await state.update_data(active_days=active_days)
+    audience = f"активные за {active_days} дней" if active_days else "ВСЕ"
     await callback.message.edit_text(
         "📢 <b>Рассылка сообщений</b>\n\n"
-        "Отправьте сюда сообщение, которое получат ВСЕ пользователи бота. "
+        f"Отправьте сюда сообщение, которое получат {audience} пользователи бота. "
         "<i>Можно использовать текст, фото, видео или кружочки.</i>\n\n"
-        "Внимание: Рассылка начнется СРАЗУ после отправки сообщения!",
+        "Внимание: Рассылка начнется СРАЗУ после отправки сообщения! "
+        "Ее можно будет поставить на паузу или остановить.",
         parse_mode="HTML",
         reply_markup=get_admin_cancel_kb()
     )
     await callback.answer()
 
 @router.message(AdminState.waiting_for_broadcast_msg)
-async def process_broadcast_msg(message: Message, state: FSMContext, session: AsyncSession, bot: Bot):
+async def process_broadcast_msg(message: Message, state: FSMContext, bot: Bot, session_pool: async_sessionmaker):
+    active_days = (await state.get_data()).get("active_days", 0)
     await state.clear()
     
-    # 1. Уведомляем админа
-    status_msg = await message.answer("⏳ <i>Рассылка запущена... Пожалуйста, подождите.</i>", parse_mode="HTML")
-    
-    # 2. Выгружаем ID всех пользователей из БД
-    result = await session.execute(select(User.telegram_id))
-    users = result.scalars().all()
-    
-    success_count = 0
-    failed_count = 0
+    # 1. Уведомляем админа — это сообщение дальше редактируется прогрессом
+    status_msg = await message.answer("⏳ <i>Рассылка запущена...</i>", parse_mode="HTML")
     
-    # --- ФОРМИРУЕМ НАДПИСЬ ОБЪЯВЛЕНИЯ ---
-    prefix = "📢 <b>ОБЪЯВЛЕНИЕ</b>\n\n"
-    # Сохраняем исходное форматирование админа (жирный текст, ссылки и т.д.)
-    original_text = message.html_text or ""
-    new_text = prefix + original_text
-    
-    # 3. Рассылаем
-    for user_id in users:
-        try:
-            # Разбираем по типам контента, чтобы подставить новый текст в caption
-            if message.content_type == 'text':
-                await bot.send_message(chat_id=user_id, text=new_text, parse_mode="HTML")
-                
-            elif message.content_type == 'photo':
-                await bot.send_photo(chat_id=user_id, photo=message.photo[-1].file_id, caption=new_text, parse_mode="HTML")
-                
-            elif message.content_type == 'video':
-                await bot.send_video(chat_id=user_id, video=message.video.file_id, caption=new_text, parse_mode="HTML")
-                
-            elif message.content_type == 'document':
-                await bot.send_document(chat_id=user_id, document=message.document.file_id, caption=new_text, parse_mode="HTML")
-                
-            elif message.content_type == 'voice':
-                await bot.send_voice(chat_id=user_id, voice=message.voice.file_id, caption=new_text, parse_mode="HTML")
-                
-            elif message.content_type == 'video_note': 
-                # Telegram "кружочки" не поддерживают текст под ними. 
-                # Поэтому отправляем 2 сообщения: сначала плашку объявления, потом сам кружок.
-                await bot.send_message(chat_id=user_id, text="📢 <b>ОБЪЯВЛЕНИЕ</b>", parse_mode="HTML")
-                await bot.send_video_note(chat_id=user_id, video_note=message.video_note.file_id)
-                
-            else:
-                # Фоллбек для стикеров, локаций, гифок и т.д.
-                await bot.send_message(chat_id=user_id, text="📢 <b>ОБЪЯВЛЕНИЕ</b>", parse_mode="HTML")
-                await message.send_copy(chat_id=user_id)
+    # 2. Задача уходит в фон (app/services/broadcast.py), вебхук отвечает сразу
+    job_id = await create_broadcast(message, status_msg, active_days)
+    start_broadcast(bot, session_pool, job_id)
 
-            success_count += 1
-        except Exception:
-            # Если юзер заблокировал бота или удалил аккаунт
-            failed_count += 1
-            
-        # Защита от лимитов Telegram - ждем 0.05 сек (20 сообщений в секунду)
-        await asyncio.sleep(0.05)
-        
-    # 4. Выводим отчет
-    report_text = (
-        f"📢 <b>Рассылка завершена!</b>\n\n"
-        f"✅ Успешно доставлено: <b>{success_count}</b>\n"
-        f"❌ Не доставлено (блокировки): <b>{failed_count}</b>\n"
-        f"👥 Всего в базе: <b>{len(users)}</b>"
-    )
-    
-    await status_msg.edit_text(report_text, parse_mode="HTML", reply_markup=get_admin_main_kb())
\ No newline at end of file
+@router.callback_query(F.data.startswith("bcast_"))
+async def control_broadcast(callback: CallbackQuery):
+    # bcast_<pause|resume|cancel>_<id задачи>
+    _, action, job_id = callback.data.split("_")
+    status = {"pause": "paused", "resume": "running", "cancel": "cancelled"}[action]
+    if not await set_broadcast_status(job_id, status):
+        await callback.answer("Рассылка уже завершена.", show_alert=True)
+        return
+    if action != "cancel":
+        await callback.message.edit_reply_markup(reply_markup=get_broadcast_kb(job_id, paused=(action == "pause")))
+    await callback.answer("Применится после текущей пачки получателей.")
@@ -2,17 +2,25 @@ import os
 import datetime
 import re
 from aiogram import Router, F, Bot
-from aiogram.types import Message, CallbackQuery
+from aiogram.types import (Message, CallbackQuery,
+                           InputMediaPhoto, InputMediaVideo, InputMediaAudio, InputMediaDocument)
 from aiogram.fsm.context import FSMContext, StorageKey
+from aiogram.exceptions import TelegramForbiddenError, TelegramRetryAfter, TelegramNetworkError, TelegramServerError
 from sqlalchemy.ext.asyncio import AsyncSession
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 from app.utils.states import ChatState
 from app.keyboards.chat_kb import get_search_kb, get_in_chat_kb, get_rating_kb, get_report_reasons_kb
 from app.handlers.menu import get_main_kb
-from app.services.matchmaker import join_queue, leave_chat, is_in_chat, remove_from_queue, redis_client
-from app.database.db import get_or_create_user, update_user_rating, add_report_and_check_ban
+from app.services.matchmaker import join_queue, leave_chat, end_chat, is_in_chat, remove_from_queue, record_message, redis_client
+from app.services.route_cache import route_cache
+from app.database.db import get_user_profile, add_report_and_check_ban
+from app.services.ratings import submit_rating
+from app.services.profile_cache import invalidate_profile
 from app.services.ai_client import get_ai_response, clear_ai_context
 from app.utils.name_generator import generate_random_name
+from app.middlewares.outbound import lane, Lane
+from app.services.media import send_sanitized
+from app.config import SANITIZE_MAX_BYTES
 
 router = Router()
 
@@ -24,11 +32,9 @@ async def start_search(message: Message, state: FSMContext, session: AsyncSessio
     await state.set_state(ChatState.searching)
     await message.answer("🔍 Ищем собеседника...", reply_markup=get_search_kb())
     
-    # Обновлено: get_or_create_user теперь возвращает 2 значения (user, ref_event)
-    user, _ = await get_or_create_user(session, message.from_user.id)
-    
-    import datetime
-    is_vip = user.vip_until and user.vip_until > datetime.datetime.utcnow()
+    # Профиль из кэша (при промахе — get_or_create_user)
+    user = await get_user_profile(session, message.from_user.id)
+    is_vip = user.is_vip
     
     # Защита от старых юзеров: берем пол и кого ищем из базы
     user_gender = user.gender or "M"
@@ -47,7 +53,9 @@ async def start_search(message: Message, state: FSMContext, session: AsyncSessio
         message.from_user.id, 
         is_vip=is_vip, 
         user_gender=user_gender, 
-        search_gender=search_gender
+        search_gender=search_gender,
+        age=user.age,
+        rating=user.rating
     )
     
     if partner_id:
@@ -75,14 +83,14 @@ async def start_search(message: Message, state: FSMContext, session: AsyncSessio
 
 @router.message(F.text == "⛔ Отменить поиск", ChatState.searching)
 async def cancel_search(message: Message, state: FSMContext):
-    await remove_from_queue(message.from_user.id) # Нужно добавить эту функцию в matchmaker.py (redis_client.lrem)
+    await remove_from_queue(message.from_user.id)
     await state.set_state(ChatState.menu)
     await message.answer("Поиск отменен.", reply_markup=get_main_kb())
 
 # ==========================================
 # 2. УПРАВЛЕНИЕ ЧАТОМ (ЗАВЕРШИТЬ / СЛЕДУЮЩИЙ)
 # ==========================================
-async def notify_partner_disconnect(bot: Bot, storage, partner_id: str, current_user_id: int):
+async def notify_partner_disconnect(bot: Bot, storage, partner_id: str, current_user_id: int, session_id: str | None = None):
     if partner_id and partner_id != "AI":
         partner_id_int = int(partner_id)
         
@@ -93,21 +101,21 @@ async def notify_partner_disconnect(bot: Bot, storage, partner_id: str, current_
         await bot.send_message(
             partner_id_int, 
             "Собеседник завершил чат. Оцените его:", 
-            reply_markup=get_rating_kb(current_user_id)
+            reply_markup=get_rating_kb(current_user_id, session_id)
         )
         await bot.send_message(partner_id_int, "Возврат в главное меню.", reply_markup=get_main_kb())
 
 @router.message(F.text == "⛔ Завершить чат", ChatState.in_chat)
 async def stop_chat(message: Message, state: FSMContext, bot: Bot):
     user_id = message.from_user.id
-    partner_id = await leave_chat(user_id)
+    partner_id, session_id = await end_chat(user_id)
     if partner_id == "AI":
         await clear_ai_context(user_id)
-    await notify_partner_disconnect(bot, state.storage, partner_id, user_id)
+    await notify_partner_disconnect(bot, state.storage, partner_id, user_id, session_id)
     
     await state.set_state(ChatState.menu)
     if partner_id and partner_id != "AI":
-        await message.answer("Чат завершен. Оцените собеседника:", reply_markup=get_rating_kb(int(partner_id)))
+        await message.answer("Чат завершен. Оцените собеседника:", reply_markup=get_rating_kb(int(partner_id), session_id))
     
     await message.answer("Вы в главном меню.", reply_markup=get_main_kb())
 
@@ -115,10 +123,10 @@ async def stop_chat(message: Message, state: FSMContext, bot: Bot):
 async def next_chat(message: Message, state: FSMContext, bot: Bot, session: AsyncSession):
     # Логика: Завершаем текущий, не предлагая оценку (для скорости), и сразу в поиск
     user_id = message.from_user.id
-    partner_id = await leave_chat(user_id)
+    partner_id, session_id = await end_chat(user_id)
     if partner_id == "AI":
         await clear_ai_context(user_id)
-    await notify_partner_disconnect(bot, state.storage, partner_id, user_id)
+    await notify_partner_disconnect(bot, state.storage, partner_id, user_id, session_id)
     
     # Сразу запускаем поиск заново
     await start_search(message, state, session)
@@ -211,26 +219,63 @@ async def process_report_reason(callback: CallbackQuery, session: AsyncSession,
 SPAM_PATTERN = re.compile(r"(https?://\S+|www\.\S+|t\.me/\S+|@\w+)", re.IGNORECASE)
 
 
+def _is_image_document(message: Message) -> bool:
+    return bool(message.document and message.document.mime_type and message.document.mime_type.startswith('image/'))
+
+
+def _album_media(album: list[Message], prefix: str, safe_files: dict) -> list:
+    """Альбом для send_media_group: подписи частей сохраняются, имя — один раз, в первой.
+    safe_files — очищенные картинки-файлы по message_id"""
+    media = []
+    for i, item in enumerate(album):
+        caption = item.html_text or ""
+        if i == 0:
+            caption = prefix + caption
+        params = {"caption": caption or None, "parse_mode": "HTML"}
+        if item.photo:
+            media.append(InputMediaPhoto(media=item.photo[-1].file_id, **params))
+        elif item.video:
+            media.append(InputMediaVideo(media=item.video.file_id, **params))
+        elif item.audio:
+            media.append(InputMediaAudio(media=item.audio.file_id, **params))
+        elif item.document:
+            media.append(InputMediaDocument(media=safe_files.get(item.message_id, item.document.file_id), **params))
+    return media
+
+
 @router.message()
-async def route_message(message: Message, state: FSMContext, bot: Bot, session: AsyncSession):
+async def route_message(message: Message, state: FSMContext, bot: Bot, session: AsyncSession,
+                        album: list[Message] | None = None):
     user_id = message.from_user.id
-    partner_id = await is_in_chat(user_id)
     
-    if not partner_id:
+    # Горячий путь: партнер, стейт и имя — из локального кэша маршрутов (без Redis)
+    route = route_cache.get(user_id)
+    if route:
+        partner_id, sender_name = route.partner_id, route.display_name
+    else:
+        route_cache.begin(user_id)
+        partner_id = await is_in_chat(user_id)
+        
+        if not partner_id:
+            route_cache.abort(user_id)
+            current_state = await state.get_state()
+            if current_state != ChatState.menu.state:
+                await state.set_state(ChatState.menu)
+                await message.answer("Чат завершен. Выберите действие:", reply_markup=get_main_kb())
+            return
+            
         current_state = await state.get_state()
-        if current_state != ChatState.menu.state:
-            await state.set_state(ChatState.menu)
-            await message.answer("Чат завершен. Выберите действие:", reply_markup=get_main_kb())
-        return
+        if current_state != ChatState.in_chat.state:
+            await state.set_state(ChatState.in_chat)
         
-    current_state = await state.get_state()
-    if current_state != ChatState.in_chat.state:
-        await state.set_state(ChatState.in_chat)
+        sender_name = await redis_client.get(f"display_name:{user_id}") or "Аноним"
+        route_cache.put(user_id, partner_id, sender_name)
     
     # ==========================================
     # 🛑 АНТИСПАМ-ФИЛЬТР
     # ==========================================
-    text_to_check = message.text or message.caption
+    # Альбом (AlbumMiddleware) приходит одним апдейтом — проверяем подписи всех частей
+    text_to_check = " ".join(m.caption for m in album if m.caption) if album else message.text or message.caption
     if text_to_check and SPAM_PATTERN.search(text_to_check):
         await message.answer(
             "🚫 <b>Отправка ссылок запрещена!</b>\nВ целях безопасности мы блокируем любые ссылки и Telegram-юзернеймы.", 
@@ -244,11 +289,9 @@ async def route_message(message: Message, state: FSMContext, bot: Bot, session:
     allowed_for_all = ['text', 'sticker', 'voice', 'animation'] # Добавили гифки
     
     if message.content_type not in allowed_for_all:
-        user, _ = await get_or_create_user(session, user_id)
-        import datetime
-        is_vip = user.vip_until and user.vip_until > datetime.datetime.utcnow()
+        user = await get_user_profile(session, user_id)
         
-        if not is_vip:
+        if not user.is_vip:
             bot_info = await bot.get_me()
             ref_link = f"https://t.me/{bot_info.username}?start={user_id}"
             share_url = f"https://t.me/share/url?url={ref_link}&text=Привет! Заходи общаться анонимно!"
@@ -267,12 +310,19 @@ async def route_message(message: Message, state: FSMContext, bot: Bot, session:
             )
             return 
 
+    # Картинки файлом пересылаются только после очистки — слишком большие не пропускаем
+    if any(_is_image_document(m) and (m.document.file_size or 0) > SANITIZE_MAX_BYTES for m in album or [message]):
+        await message.answer(
+            f"⚠️ Изображение больше {SANITIZE_MAX_BYTES // (1024 * 1024)} МБ: отправьте его как фото или уменьшите файл."
+        )
+        return
+
     # ==========================================
     # ОТПРАВКА СООБЩЕНИЯ С ИМЕНЕМ
     # ==========================================
-    # Получаем имя отправителя
-    sender_name = await redis_client.get(f"display_name:{user_id}") or "Аноним"
     prefix = f"👤 <b>{sender_name}</b>:\n"
+    # Пересылка в живом чате — первой в очереди исходящих (рассылки подождут)
+    lane.set(Lane.RELAY)
     
     if partner_id == "AI":
         await bot.send_chat_action(chat_id=user_id, action="typing")
@@ -284,22 +334,32 @@ async def route_message(message: Message, state: FSMContext, bot: Bot, session:
         # Получаем имя ИИ
         ai_name = await redis_client.get(f"display_name:AI_{user_id}") or "Собеседник"
         await message.answer(f"👤 <b>{ai_name}</b>:\n{ai_reply}", parse_mode="HTML")
+        record_message(user_id)
         
     else:
         try:
             original_text = message.html_text or ""
             new_text = prefix + original_text if original_text else prefix
             
+            # Альбом — одним вызовом, с одной плашкой имени
+            # (картинки-файлы — без EXIF: скачиваются, чистятся и уходят из одного буфера,
+            # а уже пересылавшиеся — по file_id очищенной копии, без скачивания)
+            if album:
+                images = [m for m in album if _is_image_document(m)]
+
+                async def send_album(files: list) -> list[Message]:
+                    safe_files = dict(zip((m.message_id for m in images), files))
+                    sent = await bot.send_media_group(chat_id=int(partner_id), media=_album_media(album, prefix, safe_files))
+                    return [msg for msg, item in zip(sent, album) if _is_image_document(item)]
+
+                await send_sanitized(bot, [m.document for m in images], send_album)
+            
             # Удаление EXIF из файлов
-            if message.content_type == 'document' and message.document.mime_type and message.document.mime_type.startswith('image/'):
-                file_info = await bot.get_file(message.document.file_id)
-                file_bytes_io = await bot.download_file(file_info.file_path)
-                from app.utils.security import strip_exif_data
-                safe_bytes = strip_exif_data(file_bytes_io.read())
-                
-                from aiogram.types import BufferedInputFile
-                input_file = BufferedInputFile(safe_bytes, filename=message.document.file_name or "safe_image.jpg")
-                await bot.send_document(chat_id=int(partner_id), document=input_file, caption=new_text, parse_mode="HTML")
+            elif _is_image_document(message):
+                async def send_file(files: list) -> list[Message]:
+                    return [await bot.send_document(chat_id=int(partner_id), document=files[0], caption=new_text, parse_mode="HTML")]
+
+                await send_sanitized(bot, [message.document], send_file)
             
             # Маршрутизация по типам контента
             elif message.content_type == 'text':
@@ -317,13 +377,25 @@ async def route_message(message: Message, state: FSMContext, bot: Bot, session:
                 # Только для стикеров и GIF-ок
                 await bot.send_message(chat_id=int(partner_id), text=prefix, parse_mode="HTML")
                 await message.send_copy(chat_id=int(partner_id))
+            
+            record_message(user_id)
+        
+        except (TelegramRetryAfter, TelegramNetworkError, TelegramServerError) as e:
+            # Флуд-контроль или сбой на стороне Telegram — собеседник на месте, чат не завершаем
+            import logging
+            logging.warning(f"Routing delayed for {user_id}: {e}")
+            await message.answer("⏳ Сообщение не доставлено: Telegram временно ограничил отправку. Повторите чуть позже.")
                 
         except Exception as e:
             import logging
             logging.error(f"Routing error: {e}")
             await leave_chat(user_id)
             
-            await bot.send_message(int(partner_id), "Собеседник отключился.", reply_markup=get_main_kb())
+            try:
+                await bot.send_message(int(partner_id), "Собеседник отключился.", reply_markup=get_main_kb())
+            except TelegramForbiddenError:
+                # Собеседник заблокировал бота (он уже помечен недоступным)
+                pass
             from aiogram.fsm.storage.base import StorageKey
             state_key = StorageKey(bot_id=bot.id, chat_id=int(partner_id), user_id=int(partner_id))
             await state.storage.set_state(key=state_key, state=ChatState.menu)
@@ -334,13 +406,24 @@ async def route_message(message: Message, state: FSMContext, bot: Bot, session:
 # 4. ОБРАБОТКА ОЦЕНОК (CALLBACK)
 # ==========================================
 @router.callback_query(F.data.startswith("rate_"))
-async def process_rating(callback: CallbackQuery, session: AsyncSession):
-    # Парсим: rate_5_123456789
-    _, score_str, target_id_str = callback.data.split("_")
-    score = int(score_str)
-    target_id = int(target_id_str)
+async def process_rating(callback: CallbackQuery):
+    # Парсим: rate_5_123456789_<sid>. callback_data приходит от клиента — пара
+    # (сессия, цель) сверяется с записанной сервером при завершении чата
+    parts = callback.data.split("_")
+    try:
+        score, target_id, session_id = int(parts[1]), int(parts[2]), parts[3]
+    except (IndexError, ValueError):
+        await callback.answer("Оценка недоступна.", show_alert=True)
+        return
+    if not 1 <= score <= 5:
+        await callback.answer("Оценка недоступна.", show_alert=True)
+        return
     
-    await update_user_rating(session, target_id, score)
+    # Оценка копится в Redis и пакетом уходит в БД (rating_flusher)
+    if not await submit_rating(callback.from_user.id, target_id, score, session_id):
+        await callback.answer("Вы уже оценили этого собеседника (или время оценки истекло).", show_alert=True)
+        return
+    await invalidate_profile(target_id)
     
     # Удаляем инлайн-клавиатуру, чтобы нельзя было голосовать дважды
     await callback.message.edit_text(f"✅ Вы оценили собеседника на {score} звезд. Спасибо!")
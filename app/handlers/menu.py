@@ -12,7 +12,11 @@ from sqlalchemy.ext.asyncio import AsyncSession
 
 # Наши внутренние модули
 from app.database.models import User, Transaction
-from app.database.db import get_or_create_user
+from app.database.db import get_or_create_user, get_user_profile
+from app.services.profile_cache import invalidate_profile
+from app.services.ratings import get_pending_rating, merge_rating
+from app.services.stats import track_gender, track_vip, track_payment
+from app.services.reachability import mark_reachable
 from app.utils.states import ChatState, RegState, SettingsState
 from app.services.matchmaker import redis_client
 from app.services.ai_client import clear_ai_context
@@ -36,6 +40,8 @@ async def cmd_start(message: Message, command: CommandObject, state: FSMContext,
     
     # Теперь функция возвращает 2 значения
     user, ref_event = await get_or_create_user(session, message.from_user.id, referrer_id)
+    # Юзер снова пишет боту — значит, разблокировал его
+    await mark_reachable(message.from_user.id)
 
     # Отправляем ПУШ-УВЕДОМЛЕНИЕ тому, кто пригласил
     if ref_event:
@@ -70,9 +76,11 @@ async def cmd_start(message: Message, command: CommandObject, state: FSMContext,
 @router.callback_query(RegState.gender, F.data.startswith("setgen_"))
 async def process_gender(callback: CallbackQuery, state: FSMContext, session: AsyncSession):
     gender = callback.data.split("_")[1]
-    user, _ = await get_or_create_user(session, message.from_user.id)
-    user.gender = gender
+    user, _ = await get_or_create_user(session, callback.from_user.id)
+    old_gender, user.gender = user.gender, gender
     await session.commit()
+    await invalidate_profile(callback.from_user.id)
+    await track_gender(callback.from_user.id, old_gender, gender)
     
     await state.set_state(RegState.age)
     await callback.message.edit_text("Отлично! Теперь напишите ваш возраст (цифрой, например 20):")
@@ -87,6 +95,7 @@ async def process_age(message: Message, state: FSMContext, session: AsyncSession
     user, _ = await get_or_create_user(session, message.from_user.id)
     user.age = int(message.text)
     await session.commit()
+    await invalidate_profile(message.from_user.id)
     
     await state.set_state(ChatState.menu)
     await message.answer("✅ Регистрация завершена! Приятного общения.", reply_markup=get_main_kb())
@@ -94,6 +103,7 @@ async def process_age(message: Message, state: FSMContext, session: AsyncSession
 @router.message(F.text == "👤 Профиль", ChatState.menu)
 async def show_profile(message: Message, session: AsyncSession):
     user, _ = await get_or_create_user(session, message.from_user.id)
+    rating = merge_rating(user.rating, user.rating_count, *await get_pending_rating(user.telegram_id))
     
     now = datetime.datetime.utcnow()
     # Проверяем VIP статус
@@ -114,7 +124,7 @@ async def show_profile(message: Message, session: AsyncSession):
     text = (
         f"👤 <b>Ваш профиль:</b>\n\n"
         f"Данные: {gender_emoji} | <b>{user.age} лет</b>\n"
-        f"⭐️ Рейтинг: <b>{user.rating:.1f}/5.0</b>\n"
+        f"⭐️ Рейтинг: <b>{rating:.1f}/5.0</b>\n"
         f"⚡️ Статус: <b>{status}</b>\n"
         f"🎯 Ищу: <b>{filter_text}</b>\n\n"
         f"🔗 <b>Реферальная ссылка:</b>\n<code>{ref_link}</code>\n\n"
@@ -155,6 +165,7 @@ async def process_set_filter(callback: CallbackQuery, session: AsyncSession):
     user, _ = await get_or_create_user(session, callback.from_user.id)
     user.search_gender = target
     await session.commit()
+    await invalidate_profile(callback.from_user.id)
     await callback.message.edit_text("✅ Фильтр поиска успешно обновлен!")
 
 # 2. Добавь обработчики ниже:
@@ -189,19 +200,16 @@ async def process_new_nickname(message: Message, state: FSMContext, session: Asy
     user.nickname_changes += 1
     user.last_nickname_change = datetime.datetime.utcnow()
     await session.commit()
+    await invalidate_profile(message.from_user.id)
     
     await message.answer(f"✅ Никнейм успешно изменен на <b>{new_nick}</b>!", parse_mode="HTML", reply_markup=get_main_kb())
 
 @router.message(F.text == "👑 VIP статус", ChatState.menu)
 async def show_vip_info(message: Message, session: AsyncSession):
-    # Проверяем текущий статус пользователя
-    user, _ = await get_or_create_user(session, message.from_user.id)
-    
-    import datetime
-    now = datetime.datetime.utcnow()
-    is_vip = user.vip_until and user.vip_until > now
+    # Проверяем текущий статус пользователя (профиль из кэша)
+    user = await get_user_profile(session, message.from_user.id)
     
-    if is_vip:
+    if user.is_vip:
         status_text = f"✅ <b>Активен до:</b> {user.vip_until.strftime('%d.%m.%Y %H:%M')} (UTC)"
     else:
         status_text = "❌ <b>Неактивен</b>"
@@ -351,12 +359,15 @@ async def process_successful_payment(message: Message, session: AsyncSession, bo
             new_tx = Transaction(user_id=user_id, amount=payment_info.total_amount)
             session.add(new_tx)
             await session.commit()
+            await track_payment(payment_info.total_amount)
         except Exception as e:
             # Если таблицы нет, откатываем ошибку и сохраняем хотя бы VIP
             await session.rollback()
             user.vip_until = current_vip + datetime.timedelta(days=30)
             await session.commit()
             print(f"Ошибка сохранения транзакции: {e}")
+        await invalidate_profile(user_id)
+        await track_vip(user_id, user.gender, user.vip_until)
 
         # 4. Уведомляем админа (ИСПРАВЛЕНЫ ТЕГИ)
         import os
@@ -377,7 +388,7 @@ async def process_successful_payment(message: Message, session: AsyncSession, bo
 # ==========================================
 @router.message(F.text.in_({"⚙️ Настройки", "Настройки"}), ChatState.menu)
 async def show_settings(message: Message, session: AsyncSession):
-    user, _ = await get_or_create_user(session, message.from_user.id)
+    user = await get_user_profile(session, message.from_user.id)
     
     gender_str = "👨 Парень" if user.gender == "M" else "👩 Девушка" if user.gender == "F" else "Не указан"
     
@@ -411,8 +422,10 @@ async def process_new_gender(callback: CallbackQuery, state: FSMContext, session
     
     # 1. Обновляем в БД
     user, _ = await get_or_create_user(session, callback.from_user.id)
-    user.gender = new_gender
+    old_gender, user.gender = user.gender, new_gender
     await session.commit()
+    await invalidate_profile(callback.from_user.id)
+    await track_gender(callback.from_user.id, old_gender, new_gender)
     
     # 2. Обновляем Redis (важно для поиска)
     from app.services.matchmaker import redis_client
@@ -451,6 +464,7 @@ async def process_new_age(message: Message, state: FSMContext, session: AsyncSes
     user, _ = await get_or_create_user(session, message.from_user.id)
     user.age = int(message.text)
     await session.commit()
+    await invalidate_profile(message.from_user.id)
     
     await state.set_state(ChatState.menu)
     await message.answer("✅ Ваш возраст успешно изменен!", reply_markup=get_main_kb())
@@ -16,4 +16,23 @@ def get_admin_main_kb() -> InlineKeyboardMarkup:
 def get_admin_cancel_kb() -> InlineKeyboardMarkup:
     builder = InlineKeyboardBuilder()
     builder.button(text="❌ Отмена", callback_data="admin_cancel")
-    return builder.as_markup()
\ No newline at end of file
+    return builder.as_markup()
+
+def get_broadcast_kb(job_id: str, paused: bool = False) -> InlineKeyboardMarkup:
+    builder = InlineKeyboardBuilder()
+    if paused:
+        builder.button(text="▶️ Продолжить", callback_data=f"bcast_resume_{job_id}")
+    else:
+        builder.button(text="⏸ Пауза", callback_data=f"bcast_pause_{job_id}")
+    builder.button(text="⛔ Остановить", callback_data=f"bcast_cancel_{job_id}")
+    builder.adjust(2)
+    return builder.as_markup()
+
+def get_broadcast_segment_kb() -> InlineKeyboardMarkup:
+    builder = InlineKeyboardBuilder()
+    builder.button(text="👥 Всем", callback_data="bseg_0")
+    builder.button(text="📈 Активным за 7 дней", callback_data="bseg_7")
+    builder.button(text="📅 Активным за 30 дней", callback_data="bseg_30")
+    builder.button(text="❌ Отмена", callback_data="admin_cancel")
+    builder.adjust(1)
+    return builder.as_markup()
@@ -16,11 +16,12 @@ def get_in_chat_kb() -> ReplyKeyboardMarkup:
         resize_keyboard=True
     )
 
-def get_rating_kb(target_user_id: int) -> InlineKeyboardMarkup:
+def get_rating_kb(target_user_id: int, session_id: str | None = None) -> InlineKeyboardMarkup:
     builder = InlineKeyboardBuilder()
     for i in range(1, 6):
-        # callback_data формата: "rate_<оценка>_<id_собеседника>"
-        builder.button(text=("⭐️" * i), callback_data=f"rate_{i}_{target_user_id}")
+        # callback_data формата: "rate_<оценка>_<id_собеседника>_<id_сессии чата>"
+        callback_data = f"rate_{i}_{target_user_id}_{session_id}" if session_id else f"rate_{i}_{target_user_id}"
+        builder.button(text=("⭐️" * i), callback_data=callback_data)
     builder.adjust(1) # По одной кнопке в ряд (или можно adjust(5) для горизонтального ряда)
     return builder.as_markup()
 
@@ -0,0 +1,18 @@
+from typing import Any, Awaitable, Callable, Dict
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject
+from app.services.activity import activity
+
+class ActivityMiddleware(BaseMiddleware):
+    """Отмечает активность юзера (только в памяти, в Redis уходит пачкой)"""
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        user = data.get("event_from_user")
+        if user:
+            activity.touch(user.id)
+        return await handler(event, data)
@@ -0,0 +1,64 @@
+import asyncio
+from typing import Any, Awaitable, Callable, Dict
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject, Update, Message
+from app.config import ALBUM_WINDOW
+
+# В альбоме Telegram не больше 10 элементов
+ALBUM_MAX = 10
+
+
+class _Album:
+    __slots__ = ("messages", "arrived")
+
+    def __init__(self, message: Message):
+        self.messages = [message]
+        self.arrived = asyncio.Event()
+
+
+class AlbumMiddleware(BaseMiddleware):
+    """Собирает альбом (апдейты с общим media_group_id) в один апдейт.
+
+    Первый апдейт альбома ждет, пока части перестанут приходить дольше
+    ALBUM_WINDOW секунд, и идет дальше с data["album"] — частями по порядку.
+    Остальные апдейты альбома дальше не идут вовсе, так что троттлинг, бан и
+    очередь юзера видят альбом одним событием. Вешается на dp.update до
+    UserOrderingMiddleware: ожидание частей не держит очередь юзера.
+    Части, попавшие на другой узел, уйдут там отдельным альбомом.
+    """
+
+    def __init__(self, window: float = ALBUM_WINDOW):
+        super().__init__()
+        self.window = window
+        self.albums: Dict[tuple[int, str], _Album] = {}
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        message = event.message if isinstance(event, Update) else None
+        if message is None or not message.media_group_id or not message.from_user:
+            return await handler(event, data)
+
+        key = (message.from_user.id, message.media_group_id)
+        album = self.albums.get(key)
+        if album is not None:
+            album.messages.append(message)
+            album.arrived.set()
+            return
+
+        album = self.albums[key] = _Album(message)
+        try:
+            while len(album.messages) < ALBUM_MAX:
+                album.arrived.clear()
+                try:
+                    await asyncio.wait_for(album.arrived.wait(), self.window)
+                except asyncio.TimeoutError:
+                    break
+        finally:
+            self.albums.pop(key, None)
+
+        data["album"] = sorted(album.messages, key=lambda m: m.message_id)
+        return await handler(event, data)
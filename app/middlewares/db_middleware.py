@@ -2,6 +2,7 @@ from typing import Callable, Dict, Any, Awaitable
 from aiogram import BaseMiddleware
 from aiogram.types import TelegramObject
 from sqlalchemy.ext.asyncio import async_sessionmaker
+from app.database.lazy_session import LazySession, db_stats, db_metrics
 
 class DbSessionMiddleware(BaseMiddleware):
     def __init__(self, session_pool: async_sessionmaker):
@@ -14,6 +15,14 @@ class DbSessionMiddleware(BaseMiddleware):
         event: TelegramObject,
         data: Dict[str, Any],
     ) -> Any:
-        async with self.session_pool() as session:
-            data["session"] = session # Прокидываем сессию в kwargs хендлера
-            return await handler(event, data)
\ No newline at end of file
+        # Сессия откроется только если хендлер к ней обратится
+        stats = {"sessions": 0, "queries": 0}
+        token = db_stats.set(stats)
+        session = LazySession(self.session_pool)
+        data["session"] = session # Прокидываем сессию в kwargs хендлера
+        try:
+            return await handler(event, data)
+        finally:
+            await session.close()
+            db_stats.reset(token)
+            db_metrics.record(stats)
@@ -0,0 +1,97 @@
+import asyncio
+import logging
+import time
+from typing import Any, Awaitable, Callable, Dict
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject
+
+# Сколько апдейтов одного юзера может ждать своей очереди (остальные отбрасываем)
+MAX_USER_BACKLOG = 20
+
+
+class OrderingMetrics:
+    """Глубина очередей апдейтов и время ожидания своей очереди"""
+
+    def __init__(self):
+        self.waiting = 0          # апдейтов ждут прямо сейчас (по всем юзерам)
+        self.max_depth = 0        # самая длинная очередь одного юзера
+        self.processed = 0
+        self.dropped = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def snapshot(self) -> dict:
+        return {
+            "waiting": self.waiting,
+            "max_depth": self.max_depth,
+            "processed": self.processed,
+            "dropped": self.dropped,
+            "avg_wait_ms": self.total_wait / self.processed * 1000 if self.processed else 0.0,
+            "max_wait_ms": self.max_wait * 1000,
+        }
+
+
+metrics = OrderingMetrics()
+
+
+class _UserLane:
+    __slots__ = ("lock", "depth")
+
+    def __init__(self):
+        self.lock = asyncio.Lock()
+        self.depth = 0  # выполняется + ждут
+
+
+class UserOrderingMiddleware(BaseMiddleware):
+    """Апдейты одного юзера выполняются строго по очереди, разных юзеров — параллельно.
+
+    Двойной клик по "Найти собеседника" или сообщение во время leave_chat больше
+    не проходят через хендлеры одновременно. Вешается на dp.update первым,
+    чтобы ожидание не держало сессию БД.
+    """
+
+    def __init__(self, max_backlog: int = MAX_USER_BACKLOG):
+        super().__init__()
+        self.max_backlog = max_backlog
+        self.lanes: Dict[int, _UserLane] = {}
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        user = data.get("event_from_user")
+        if not user:
+            return await handler(event, data)
+
+        lane = self.lanes.get(user.id)
+        if lane is None:
+            lane = self.lanes[user.id] = _UserLane()
+
+        if lane.depth >= self.max_backlog:
+            metrics.dropped += 1
+            logging.warning(f"Update backlog overflow for {user.id}, update dropped")
+            return
+
+        lane.depth += 1
+        metrics.max_depth = max(metrics.max_depth, lane.depth)
+        metrics.waiting += 1
+        queued_at = time.monotonic()
+        acquired = False
+        try:
+            async with lane.lock:
+                acquired = True
+                metrics.waiting -= 1
+                wait = time.monotonic() - queued_at
+                metrics.total_wait += wait
+                metrics.max_wait = max(metrics.max_wait, wait)
+                metrics.processed += 1
+                return await handler(event, data)
+        finally:
+            if not acquired:
+                metrics.waiting -= 1
+            lane.depth -= 1
+            if lane.depth == 0:
+                # Очередь пуста — не копим записи по всем юзерам, которые когда-либо писали
+                self.lanes.pop(user.id, None)
@@ -0,0 +1,136 @@
+import contextvars
+import logging
+import time
+from enum import IntEnum
+from aiogram import Bot
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware, NextRequestMiddlewareType
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import TelegramMethod, CopyMessage, ForwardMessage, SendChatAction, SendMediaGroup
+from aiogram.methods.base import Response, TelegramType
+from app.config import (OUTBOUND_RATE, OUTBOUND_CHAT_RATE, OUTBOUND_CHAT_BURST,
+                        OUTBOUND_MAX_RETRIES, OUTBOUND_MAX_RETRY_AFTER)
+from app.utils.rate_limit import TokenBucket
+
+# Сколько бакетов чатов держим, прежде чем выбрасывать простаивающие
+CHAT_BUCKETS_PRUNE_AT = 10000
+
+
+class Lane(IntEnum):
+    """Полосы исходящих: при нехватке лимита первой уходит меньшая"""
+    RELAY = 0        # пересылка сообщений собеседнику
+    INTERACTIVE = 1  # ответы и уведомления юзерам (по умолчанию)
+    BACKGROUND = 2   # рассылки
+
+
+# Полоса задается там, где начинается отправка (хендлер, задача рассылки),
+# и наследуется всеми вызовами API в этом контексте
+lane: contextvars.ContextVar[Lane] = contextvars.ContextVar("outbound_lane", default=Lane.INTERACTIVE)
+
+
+class OutboundMetrics:
+    """Исходящие сообщения: задержка на лимитах, 429 от Telegram, повторы"""
+
+    def __init__(self):
+        self.sent = {item: 0 for item in Lane}
+        self.waiting = {item: 0 for item in Lane}
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.retry_after = 0      # ответов 429
+        self.retried = 0          # повторных отправок после 429
+        self.gave_up = 0          # не дождались (повторы кончились или пауза слишком длинная)
+
+    def snapshot(self) -> dict:
+        sent = sum(self.sent.values())
+        return {
+            "sent": sent,
+            "sent_by_lane": {item.name.lower(): count for item, count in self.sent.items()},
+            "waiting": sum(self.waiting.values()),
+            "avg_wait_ms": self.total_wait / sent * 1000 if sent else 0.0,
+            "max_wait_ms": self.max_wait * 1000,
+            "retry_after": self.retry_after,
+            "retried": self.retried,
+            "gave_up": self.gave_up,
+        }
+
+
+metrics = OutboundMetrics()
+
+
+def _cost(method: TelegramMethod) -> int:
+    """Сколько сообщений создаст вызов (0 — не лимитируется)"""
+    if isinstance(method, SendMediaGroup):
+        return len(method.media)
+    if isinstance(method, (CopyMessage, ForwardMessage)):
+        return 1
+    if type(method).__name__.startswith("Send") and not isinstance(method, SendChatAction):
+        return 1
+    return 0
+
+
+class OutboundSchedulerMiddleware(BaseRequestMiddleware):
+    """Middleware сессии бота: все отправки узла проходят через общий бакет
+    (лимит Telegram ~30 сообщений/с) и бакет чата (~1/с на чат).
+
+    Ожидающие токен обслуживаются по полосе (Lane): пересылка в чате обгоняет
+    уведомления, те — рассылку. На RetryAfter на паузу встает бакет чата, запрос
+    повторяется до OUTBOUND_MAX_RETRIES раз; лишь потом ошибка уходит вызывающему.
+    """
+
+    def __init__(self):
+        self.bucket = TokenBucket(OUTBOUND_RATE)
+        self.chat_buckets: dict[int | str, TokenBucket] = {}
+
+    def _chat_bucket(self, chat_id: int | str) -> TokenBucket:
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self.chat_buckets) >= CHAT_BUCKETS_PRUNE_AT:
+                self.chat_buckets = {key: b for key, b in self.chat_buckets.items() if not b.idle()}
+            bucket = self.chat_buckets[chat_id] = TokenBucket(OUTBOUND_CHAT_RATE, OUTBOUND_CHAT_BURST)
+        return bucket
+
+    async def __call__(
+        self,
+        make_request: NextRequestMiddlewareType[TelegramType],
+        bot: Bot,
+        method: TelegramMethod[TelegramType],
+    ) -> Response[TelegramType]:
+        cost = _cost(method)
+        if not cost:
+            return await make_request(bot, method)
+
+        current = lane.get()
+        chat_id = getattr(method, "chat_id", None)
+        chat_bucket = self._chat_bucket(chat_id) if chat_id is not None else None
+        for attempt in range(OUTBOUND_MAX_RETRIES + 1):
+            queued_at = time.monotonic()
+            metrics.waiting[current] += 1
+            try:
+                # Сначала чат: ожидание своего чата не держит токены общего лимита
+                if chat_bucket:
+                    await chat_bucket.acquire(cost, current)
+                await self.bucket.acquire(cost, current)
+            finally:
+                metrics.waiting[current] -= 1
+            wait = time.monotonic() - queued_at
+            metrics.total_wait += wait
+            metrics.max_wait = max(metrics.max_wait, wait)
+
+            try:
+                response = await make_request(bot, method)
+            except TelegramRetryAfter as e:
+                metrics.retry_after += 1
+                if attempt == OUTBOUND_MAX_RETRIES or e.retry_after > OUTBOUND_MAX_RETRY_AFTER:
+                    metrics.gave_up += 1
+                    logging.warning(f"Outbound {type(method).__name__} to {chat_id} gave up: retry after {e.retry_after}s")
+                    raise
+                # 429 на отправку в чат — лимит этого чата: ждет только он. Общий
+                # бакет встает на паузу лишь для запросов без чата, и не дольше
+                # OUTBOUND_MAX_RETRY_AFTER — один ответ не замораживает весь узел
+                if chat_bucket:
+                    chat_bucket.pause(e.retry_after)
+                else:
+                    self.bucket.pause(min(e.retry_after, OUTBOUND_MAX_RETRY_AFTER))
+                metrics.retried += 1
+                continue
+            metrics.sent[current] += 1
+            return response
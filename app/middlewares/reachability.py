@@ -0,0 +1,25 @@
+from aiogram import Bot
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware, NextRequestMiddlewareType
+from aiogram.exceptions import TelegramForbiddenError
+from aiogram.methods import TelegramMethod
+from aiogram.methods.base import Response, TelegramType
+from app.services.reachability import mark_unreachable
+
+class ReachabilityMiddleware(BaseRequestMiddleware):
+    """Middleware сессии бота: любой вызов API, на который Telegram ответил
+    "бот заблокирован", помечает получателя недоступным (app/services/reachability.py)"""
+
+    async def __call__(
+        self,
+        make_request: NextRequestMiddlewareType[TelegramType],
+        bot: Bot,
+        method: TelegramMethod[TelegramType],
+    ) -> Response[TelegramType]:
+        try:
+            return await make_request(bot, method)
+        except TelegramForbiddenError:
+            chat_id = getattr(method, "chat_id", None)
+            # Личные чаты: chat_id == id юзера (группы/каналы — отрицательные или @username)
+            if isinstance(chat_id, int) and chat_id > 0:
+                await mark_unreachable(chat_id)
+            raise
@@ -0,0 +1,159 @@
+# app/services/activity.py
+"""Активность юзеров: DAU/WAU/MAU и last_seen_at без записи в БД на каждый апдейт.
+
+Узел копит отметки в памяти (один юзер — не чаще раза в
+ACTIVITY_COALESCE_SECONDS) и раз в ACTIVITY_PUSH_SECONDS отправляет пачку
+одним pipeline: PFADD в HyperLogLog active:<YYYYMMDD> и HSET в хеш last_seen
+(id -> unix time). Число активных за N дней — PFCOUNT по N ключам (~12 КБ на
+день при любом числе юзеров, погрешность ~0.8%). last_seen_flusher раз в
+ACTIVITY_FLUSH_SECONDS переносит last_seen в users.last_seen_at пачками UPDATE.
+"""
+import asyncio
+import datetime
+import logging
+import time
+from sqlalchemy import text
+from app.config import ACTIVITY_COALESCE_SECONDS, ACTIVITY_PUSH_SECONDS, ACTIVITY_FLUSH_SECONDS
+from app.services.matchmaker import redis_client
+from app.services.match_scripts import RedisScript
+
+PENDING_KEY, FLUSHING_KEY = "last_seen", "last_seen:flushing"
+# HyperLogLog по дням храним чуть дольше окна MAU
+DAY_TTL = 35 * 86400
+# Сколько юзеров обновляем одним UPDATE
+FLUSH_CHUNK = 1000
+
+
+def _day(ts: float) -> str:
+    return datetime.datetime.utcfromtimestamp(ts).strftime("%Y%m%d")
+
+
+class ActivityTracker:
+    def __init__(self):
+        self.pending: dict[int, int] = {}     # id -> unix time, еще не отправлено в Redis
+        self.last_touch: dict[int, float] = {}
+        self.day = _day(time.time())
+
+    def touch(self, user_id: int):
+        now = time.time()
+        day = _day(now)
+        if day != self.day:
+            # Новые сутки: первая активность каждого должна попасть в новый HyperLogLog
+            self.day = day
+            self.last_touch.clear()
+        if now - self.last_touch.get(user_id, 0) < ACTIVITY_COALESCE_SECONDS:
+            return
+        self.last_touch[user_id] = now
+        self.pending[user_id] = int(now)
+
+    async def push(self) -> int:
+        """Отправляет накопленное в Redis. Возвращает число юзеров"""
+        if not self.pending:
+            return 0
+        batch, self.pending = self.pending, {}
+        by_day: dict[str, list[int]] = {}
+        for user_id, ts in batch.items():
+            by_day.setdefault(_day(ts), []).append(user_id)
+        try:
+            async with redis_client.pipeline(transaction=False) as pipe:
+                for day, user_ids in by_day.items():
+                    pipe.pfadd(f"active:{day}", *user_ids)
+                    pipe.expire(f"active:{day}", DAY_TTL)
+                pipe.hset(PENDING_KEY, mapping=batch)
+                await pipe.execute()
+        except Exception:
+            # Вернем пачку (новые отметки свежее — их не перетираем)
+            self.pending = {**batch, **self.pending}
+            raise
+
+        # Чтобы last_touch не рос бесконечно: старые отметки больше не нужны
+        cutoff = time.time() - ACTIVITY_COALESCE_SECONDS
+        self.last_touch = {user_id: ts for user_id, ts in self.last_touch.items() if ts > cutoff}
+        return len(batch)
+
+
+activity = ActivityTracker()
+
+
+def active_keys(days: int) -> list[str]:
+    """Ключи HyperLogLog за последние days дней (включая сегодня)"""
+    now = time.time()
+    return [f"active:{_day(now - i * 86400)}" for i in range(days)]
+
+
+async def count_active(days: int) -> int:
+    """Примерное число уникальных активных юзеров за последние days дней"""
+    return await redis_client.pfcount(*active_keys(days))
+
+
+async def activity_pusher():
+    while True:
+        await asyncio.sleep(ACTIVITY_PUSH_SECONDS)
+        try:
+            await activity.push()
+        except Exception as e:
+            logging.error(f"Activity push error: {e}")
+
+
+# KEYS: 1 last_seen, 2 last_seen:flushing
+# Ответ: 1 — есть пачка для сброса (новая или недосброшенная после падения), 0 — нет
+FLUSH_BEGIN_LUA = """
+if redis.call('EXISTS', KEYS[2]) == 0 then
+    if redis.call('EXISTS', KEYS[1]) == 0 then
+        return 0
+    end
+    redis.call('RENAME', KEYS[1], KEYS[2])
+end
+return 1
+"""
+
+
+async def flush_begin_reference(client, keys: list, args: list):
+    pending, flushing = keys
+    if not await client.exists(flushing):
+        if not await client.exists(pending):
+            return 0
+        await client.rename(pending, flushing)
+    return 1
+
+
+flush_begin_script = RedisScript(FLUSH_BEGIN_LUA, flush_begin_reference)
+
+
+async def flush_last_seen(session_pool) -> int:
+    """Переносит last_seen в users.last_seen_at. Возвращает число обновленных юзеров"""
+    if not await flush_begin_script(redis_client, [PENDING_KEY, FLUSHING_KEY], []):
+        return 0
+    batch = [(int(user_id), int(ts)) for user_id, ts in (await redis_client.hgetall(FLUSHING_KEY)).items()]
+
+    async with session_pool() as session:
+        for start in range(0, len(batch), FLUSH_CHUNK):
+            chunk = batch[start:start + FLUSH_CHUNK]
+            values = ", ".join(
+                f"(CAST(:id{i} AS BIGINT), CAST(:seen{i} AS TIMESTAMP))" for i in range(len(chunk))
+            )
+            params = {}
+            for i, (user_id, ts) in enumerate(chunk):
+                params.update({f"id{i}": user_id, f"seen{i}": datetime.datetime.utcfromtimestamp(ts)})
+            # GREATEST игнорирует NULL: впервые замеченные получают v.seen
+            await session.execute(text(f"""
+                UPDATE users SET last_seen_at = GREATEST(users.last_seen_at, v.seen)
+                FROM (VALUES {values}) AS v(id, seen)
+                WHERE users.telegram_id = v.id
+            """), params)
+        await session.commit()
+
+    await redis_client.delete(FLUSHING_KEY)
+    return len(batch)
+
+
+async def last_seen_flusher(session_pool):
+    while True:
+        await asyncio.sleep(ACTIVITY_FLUSH_SECONDS)
+        try:
+            flushed = await flush_last_seen(session_pool)
+            if flushed:
+                logging.info(f"Flushed last_seen for {flushed} users")
+        except Exception as e:
+            # Пачка остается в last_seen:flushing и будет досброшена в следующий раз
+            logging.error(f"Last seen flush error: {e}")
@@ -1,59 +1,159 @@
 import asyncio
+import logging
 import time
 from aiogram.fsm.storage.base import StorageKey
-from app.services.matchmaker import redis_client
+from app.services.matchmaker import redis_client, claim_due_users, rematch_waiting, get_next_deadline, expire_stale_sessions
 from app.keyboards.chat_kb import get_in_chat_kb
 from app.utils.states import ChatState
 from app.services.ai_client import clear_ai_context
+from app.services.stats import cleanup_expired
 from app.utils.name_generator import generate_random_name
+from app.utils.timer_wheel import TimerWheel
+from app.config import AI_HANDOFF_CONCURRENCY, MATCH_MODE
+
+# Сколько юзеров забираем за один вызов скрипта
+CLAIM_BATCH = 100
+# Страховочный сон без дедлайнов (на случай потерянного уведомления pub/sub)
+IDLE_WAKEUP = 30
+# Пауза "ИИ печатает..." перед приветствием
+AI_GREETING_DELAY = 2
+# Как часто закрываем зависшие сессии чатов
+SESSION_SWEEP_INTERVAL = 300
+# Режим "scored": как часто, пока кто-то ждет, пересматриваем пары среди ожидающих
+REMATCH_INTERVAL = 1
+
+# Ограничиваем число одновременных обращений к Telegram API из воркера
+handoff_pool = asyncio.Semaphore(AI_HANDOFF_CONCURRENCY)
+greeting_wheel = TimerWheel()
+_handoff_tasks: set[asyncio.Task] = set()
+
+async def _listen_queue_events(wakeup: asyncio.Event):
+    """Будит планировщик, когда кто-то встает в очередь (PUBLISH из join_queue)"""
+    while True:
+        try:
+            async with redis_client.pubsub() as pubsub:
+                await pubsub.subscribe("queue_events")
+                async for message in pubsub.listen():
+                    if message["type"] == "message":
+                        wakeup.set()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logging.error(f"Queue events listener error: {e}")
+            wakeup.set()
+            await asyncio.sleep(1)
+
+async def send_ai_greeting(bot, user_id: int):
+    async with handoff_pool:
+        # Юзер мог уйти из чата или его перехватил живой собеседник
+        if await redis_client.get(f"chat:{user_id}") == "AI":
+            await bot.send_message(user_id, "Привет! Как дела?")
+
+async def handoff_to_ai(bot, storage, user_id: int):
+    """Переводит юзера, уже подключенного к ИИ в Redis, в режим чата"""
+    async with handoff_pool:
+        await clear_ai_context(user_id)
+
+        # --- ИСПРАВЛЕНИЕ БАГА: Принудительно меняем FSM-стейт на "в чате" ---
+        state_key = StorageKey(bot_id=bot.id, chat_id=user_id, user_id=user_id)
+        await storage.set_state(key=state_key, state=ChatState.in_chat)
+
+        # --- ДАЕМ ИМЯ ИИ ---
+        ai_name = generate_random_name()
+        await redis_client.setex(f"display_name:AI_{user_id}", 86400, ai_name)
+
+        await bot.send_message(
+            user_id,
+            "✅ Собеседник найден! Можете общаться.",
+            reply_markup=get_in_chat_kb()
+        )
+
+        # Имитация того, что ИИ печатает сообщение
+        await bot.send_chat_action(chat_id=user_id, action="typing")
+
+    # Приветствие — через колесо таймеров, не занимая слот пула на время паузы
+    greeting_wheel.schedule(AI_GREETING_DELAY, lambda: send_ai_greeting(bot, user_id))
+
+async def handoff_to_partner(bot, storage, user_id: int):
+    """Переводит в режим чата юзера, которого планировщик свел с живым собеседником"""
+    async with handoff_pool:
+        state_key = StorageKey(bot_id=bot.id, chat_id=user_id, user_id=user_id)
+        await storage.set_state(key=state_key, state=ChatState.in_chat)
+        await bot.send_message(
+            user_id,
+            "✅ Собеседник найден! Поздоровайтесь.",
+            reply_markup=get_in_chat_kb()
+        )
+
+async def _run_handoff(handoff, bot, storage, user_id: int):
+    try:
+        await handoff(bot, storage, user_id)
+    except Exception as e:
+        logging.error(f"Handoff error for {user_id}: {e}")
+
+def spawn_handoff(bot, storage, user_id: int, handoff=handoff_to_ai):
+    """Каждый юзер обслуживается отдельной задачей: медленный запрос к Telegram
+    одного юзера не задерживает остальных"""
+    task = asyncio.create_task(_run_handoff(handoff, bot, storage, user_id))
+    _handoff_tasks.add(task)
+    task.add_done_callback(_handoff_tasks.discard)
 
 async def ai_fallback_worker(bot, storage):
+    """Планировщик ИИ-фоллбека: спит ровно до ближайшего дедлайна из queue_deadlines
+    (или до уведомления о новом юзере в очереди) и атомарно забирает просроченных.
+    В режиме "scored", пока очередь не пуста, просыпается и раз в REMATCH_INTERVAL:
+    ожидающие сводятся между собой по мере расширения окон подбора."""
+    wakeup = asyncio.Event()
+    listener = asyncio.create_task(_listen_queue_events(wakeup))
+
+    try:
+        while True:
+            # Сбрасываем флаг ДО чтения дедлайнов, чтобы не потерять уведомление
+            wakeup.clear()
+            timeout = IDLE_WAKEUP
+
+            try:
+                # Сначала — пары среди ожидающих (окна подбора расширились),
+                # и только оставшихся просроченных — к ИИ
+                for pair in await rematch_waiting(CLAIM_BATCH):
+                    for user_id in pair:
+                        spawn_handoff(bot, storage, user_id, handoff_to_partner)
+
+                claimed = await claim_due_users(CLAIM_BATCH)
+                for user_id in claimed:
+                    spawn_handoff(bot, storage, user_id)
+
+                if len(claimed) == CLAIM_BATCH:
+                    # Просроченных больше, чем влезло в пачку — сразу берем следующую
+                    continue
+
+                next_deadline = await get_next_deadline()
+                if next_deadline is not None:
+                    timeout = max(0.0, next_deadline - time.time())
+                    if MATCH_MODE == "scored":
+                        timeout = min(timeout, REMATCH_INTERVAL)
+            except Exception as e:
+                logging.error(f"Worker Error: {e}")
+                timeout = 1
+
+            try:
+                await asyncio.wait_for(wakeup.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                pass
+    finally:
+        listener.cancel()
+        greeting_wheel.stop()
+        for task in list(_handoff_tasks):
+            task.cancel()
+
+async def session_sweeper():
+    """Периодически закрывает сессии чатов без активности дольше SESSION_TTL"""
     while True:
         try:
-            # Получаем все активные очереди
-            _, queues = await redis_client.scan(cursor=0, match='queue:*:*', count=100)
-            for queue_name in queues:
-                user_id = await redis_client.lindex(queue_name, 0)
-                
-                if user_id:
-                    join_time = await redis_client.hget("queue_times", str(user_id))
-                    
-                    if join_time and (int(time.time()) - int(join_time) >= 10):
-                        await redis_client.lpop(queue_name)
-                        await redis_client.hdel("queue_times", str(user_id))
-                        
-                        await clear_ai_context(int(user_id))
-                        # Подключаем ИИ в Redis
-                        await redis_client.set(f"chat:{user_id}", "AI")
-                        await redis_client.sadd("ai_chats", user_id)
-                        
-                        # --- ИСПРАВЛЕНИЕ БАГА: Принудительно меняем FSM-стейт на "в чате" ---
-                        state_key = StorageKey(bot_id=bot.id, chat_id=int(user_id), user_id=int(user_id))
-                        await storage.set_state(key=state_key, state=ChatState.in_chat)
-                        
-                        await clear_ai_context(int(user_id))
-                        # Подключаем ИИ в Redis
-                        await redis_client.set(f"chat:{user_id}", "AI")
-                        await redis_client.sadd("ai_chats", user_id)
-                        
-                        # --- ДАЕМ ИМЯ ИИ ---
-                        ai_name = generate_random_name()
-                        await redis_client.setex(f"display_name:AI_{user_id}", 86400, ai_name)
-                        
-                        await bot.send_message(
-                            int(user_id), 
-                            "✅ Собеседник найден! Можете общаться.",
-                            reply_markup=get_in_chat_kb()
-                        )
-                        
-                        # Имитация того, что ИИ печатает сообщение
-                        await bot.send_chat_action(chat_id=int(user_id), action="typing")
-                        await asyncio.sleep(2)
-                        
-                        if await redis_client.get(f"chat:{user_id}") == "AI":
-                            await bot.send_message(int(user_id), "Привет! Как дела?")
-                            
+            closed = await expire_stale_sessions()
+            if closed:
+                logging.info(f"Closed {closed} stale chat sessions")
+            await cleanup_expired()
         except Exception as e:
-            print(f"Worker Error: {e}")
-            
-        await asyncio.sleep(3)
\ No newline at end of file
+            logging.error(f"Session sweeper error: {e}")
+        await asyncio.sleep(SESSION_SWEEP_INTERVAL)
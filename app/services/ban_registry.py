@@ -0,0 +1,120 @@
+# app/services/ban_registry.py
+"""Реестр банов: Redis — источник правды для всех узлов, проверка — из памяти.
+
+bans:permanent — set id с вечным баном, bans:temporary — sorted set
+(id -> unix time окончания бана), bans:version — счетчик изменений.
+Каждый узел держит локальную копию и раз в BAN_REFRESH_SECONDS сверяет
+версию (один GET); полная перезагрузка — только если реестр менялся.
+При старте реестр собирается из БД (users.is_banned / users.ban_until).
+"""
+import asyncio
+import datetime
+import logging
+import time
+from sqlalchemy import select, or_
+from app.config import BAN_REFRESH_SECONDS
+from app.database.models import User
+from app.services.matchmaker import redis_client
+
+
+def _to_ts(moment: datetime.datetime) -> float:
+    return moment.replace(tzinfo=datetime.timezone.utc).timestamp()
+
+
+def _to_datetime(ts: float) -> datetime.datetime:
+    return datetime.datetime.fromtimestamp(ts, datetime.timezone.utc).replace(tzinfo=None)
+
+
+class BanRegistry:
+    def __init__(self):
+        self.permanent: set[int] = set()
+        self.temporary: dict[int, float] = {}
+        self.version: str | None = None
+
+    def check(self, user_id: int):
+        """"permanent", datetime окончания (UTC) или None — как is_user_banned, но без БД"""
+        if user_id in self.permanent:
+            return "permanent"
+        until = self.temporary.get(user_id)
+        if until is not None:
+            if until > time.time():
+                return _to_datetime(until)
+            del self.temporary[user_id]
+        return None
+
+    async def load(self):
+        async with redis_client.pipeline(transaction=True) as pipe:
+            pipe.get("bans:version")
+            pipe.smembers("bans:permanent")
+            pipe.zrangebyscore("bans:temporary", time.time(), "+inf", withscores=True)
+            version, permanent, temporary = await pipe.execute()
+        self.permanent = {int(user_id) for user_id in permanent}
+        self.temporary = {int(user_id): until for user_id, until in temporary}
+        self.version = version
+
+    async def refresh(self):
+        if await redis_client.get("bans:version") != self.version:
+            await self.load()
+
+    async def _commit(self, pipe):
+        pipe.zremrangebyscore("bans:temporary", "-inf", time.time())
+        pipe.incr("bans:version")
+        await pipe.execute()
+
+    async def ban_permanent(self, user_id: int):
+        self.permanent.add(user_id)
+        async with redis_client.pipeline(transaction=True) as pipe:
+            pipe.sadd("bans:permanent", user_id)
+            await self._commit(pipe)
+
+    async def ban_until(self, user_id: int, until: datetime.datetime):
+        ts = _to_ts(until)
+        self.temporary[user_id] = ts
+        async with redis_client.pipeline(transaction=True) as pipe:
+            pipe.zadd("bans:temporary", {user_id: ts})
+            await self._commit(pipe)
+
+    async def unban(self, user_id: int):
+        self.permanent.discard(user_id)
+        self.temporary.pop(user_id, None)
+        async with redis_client.pipeline(transaction=True) as pipe:
+            pipe.srem("bans:permanent", user_id)
+            pipe.zrem("bans:temporary", user_id)
+            await self._commit(pipe)
+
+    async def bootstrap(self, session):
+        """Пересобирает реестр из БД (при старте): источник правды по банам — таблица users"""
+        now = datetime.datetime.utcnow()
+        rows = await session.execute(
+            select(User.telegram_id, User.is_banned, User.ban_until)
+            .where(or_(User.is_banned == True, User.ban_until > now))  # noqa: E712
+        )
+        permanent, temporary = [], {}
+        for telegram_id, is_banned, ban_until in rows:
+            if is_banned:
+                permanent.append(telegram_id)
+            else:
+                temporary[telegram_id] = _to_ts(ban_until)
+
+        async with redis_client.pipeline(transaction=True) as pipe:
+            pipe.delete("bans:permanent", "bans:temporary")
+            if permanent:
+                pipe.sadd("bans:permanent", *permanent)
+            if temporary:
+                pipe.zadd("bans:temporary", temporary)
+            await self._commit(pipe)
+        await self.load()
+        logging.info(f"Ban registry loaded: {len(self.permanent)} permanent, {len(self.temporary)} temporary")
+
+
+ban_registry = BanRegistry()
+
+
+async def ban_refresher():
+    """Подтягивает баны, выданные на других узлах"""
+    while True:
+        await asyncio.sleep(BAN_REFRESH_SECONDS)
+        try:
+            await ban_registry.refresh()
+        except Exception as e:
+            logging.error(f"Ban registry refresh error: {e}")
@@ -0,0 +1,332 @@
+# app/services/broadcast.py
+"""Рассылки: фоновые задачи с чекпоинтами в Redis.
+
+broadcast:<id> — хеш задачи: что отправлять (тип, file_id, текст, исходное
+сообщение для send_copy), статус (running | paused | cancelled | done),
+курсор last_id и счетчики. broadcast:jobs — незавершенные задачи, их
+поднимает resume_broadcasts при старте узла. Выполняет задачу один узел —
+тот, кто держит broadcast:lock:<id>.
+
+Получатели идут страницами WHERE telegram_id > last_id (keyset, короткая
+сессия БД на страницу; заблокировавшие бота пропускаются, сегмент
+"активные за N дней" — по users.last_seen_at), внутри страницы —
+параллельно. Темп задает общий лимит исходящих (app/middlewares/outbound.py):
+рассылка идет нижней полосой и забирает только то, что не нужно живым чатам.
+Блокировку продлевает отдельная задача (только пока токен наш); потеряв ее,
+узел бросает страницу, не сохраняя курсор — задачу ведет новый владелец.
+Курсор сохраняется после каждой страницы: после падения сообщение повторно
+получат не больше BROADCAST_PAGE_SIZE юзеров.
+"""
+import asyncio
+import datetime
+import logging
+import time
+import uuid
+from aiogram import Bot
+from aiogram.exceptions import TelegramRetryAfter, TelegramForbiddenError, TelegramBadRequest
+from aiogram.types import Message
+from sqlalchemy import select
+from app.config import BROADCAST_CONCURRENCY, BROADCAST_PAGE_SIZE, BROADCAST_PROGRESS_SECONDS
+from app.database.models import User
+from app.keyboards.admin_kb import get_admin_main_kb, get_broadcast_kb
+from app.services.matchmaker import redis_client
+from app.services.stats import get_stats
+from app.services.activity import count_active
+from app.services.match_scripts import RedisScript
+from app.middlewares.outbound import lane, Lane
+
+JOBS_KEY = "broadcast:jobs"
+# Блокировка задачи: TTL и как часто ее продлевает владелец
+LOCK_TTL = 60
+LOCK_RENEW_SECONDS = LOCK_TTL / 4
+# Сколько раз повторяем отправку одному юзеру после RetryAfter
+MAX_RETRIES = 3
+# Сколько хранить хеш завершенной задачи
+FINISHED_TTL = 7 * 86400
+
+PREFIX = "📢 <b>ОБЪЯВЛЕНИЕ</b>"
+COUNTERS = ("sent", "blocked", "failed")
+
+_tasks: dict[str, asyncio.Task] = {}
+
+
+def _job_key(job_id: str) -> str:
+    return f"broadcast:{job_id}"
+
+
+async def create_broadcast(message: Message, status_msg: Message, active_days: int = 0) -> str:
+    """Сохраняет задачу рассылки сообщения админа и возвращает ее id.
+    active_days > 0 — только юзерам, активным за последние active_days дней"""
+    file_id = ""
+    if message.content_type == "photo":
+        file_id = message.photo[-1].file_id
+    elif message.content_type in ("video", "document", "voice", "video_note"):
+        file_id = getattr(message, message.content_type).file_id
+
+    job_id = str(await redis_client.incr("broadcast_seq"))
+    async with redis_client.pipeline(transaction=True) as pipe:
+        pipe.hset(_job_key(job_id), mapping={
+            "content_type": message.content_type,
+            "file_id": file_id,
+            # Сохраняем исходное форматирование админа (жирный текст, ссылки и т.д.)
+            "text": f"{PREFIX}\n\n{message.html_text or ''}",
+            "from_chat_id": message.chat.id,
+            "message_id": message.message_id,
+            "status_chat_id": status_msg.chat.id,
+            "status_message_id": status_msg.message_id,
+            "status": "running",
+            "last_id": 0,
+            "active_days": active_days,
+            # Оценка для прогресса: сегмент — по HyperLogLog активности
+            "total": await count_active(active_days) if active_days else (await get_stats())["users"],
+            "started_at": int(time.time()),
+            **{name: 0 for name in COUNTERS},
+        })
+        pipe.sadd(JOBS_KEY, job_id)
+        await pipe.execute()
+    return job_id
+
+
+async def set_broadcast_status(job_id: str, status: str) -> bool:
+    """Пауза/продолжение/отмена. False — задача уже завершена"""
+    if not await redis_client.sismember(JOBS_KEY, job_id):
+        return False
+    await redis_client.hset(_job_key(job_id), "status", status)
+    return True
+
+
+async def _send(bot: Bot, job: dict, user_id: int):
+    content_type, file_id, text = job["content_type"], job["file_id"], job["text"]
+    # Разбираем по типам контента, чтобы подставить новый текст в caption
+    if content_type == "text":
+        await bot.send_message(chat_id=user_id, text=text, parse_mode="HTML")
+    elif content_type == "photo":
+        await bot.send_photo(chat_id=user_id, photo=file_id, caption=text, parse_mode="HTML")
+    elif content_type == "video":
+        await bot.send_video(chat_id=user_id, video=file_id, caption=text, parse_mode="HTML")
+    elif content_type == "document":
+        await bot.send_document(chat_id=user_id, document=file_id, caption=text, parse_mode="HTML")
+    elif content_type == "voice":
+        await bot.send_voice(chat_id=user_id, voice=file_id, caption=text, parse_mode="HTML")
+    elif content_type == "video_note":
+        # Telegram "кружочки" не поддерживают текст под ними — сначала плашка, потом кружок
+        await bot.send_message(chat_id=user_id, text=PREFIX, parse_mode="HTML")
+        await bot.send_video_note(chat_id=user_id, video_note=file_id)
+    else:
+        # Фоллбек для стикеров, локаций, гифок и т.д.
+        await bot.send_message(chat_id=user_id, text=PREFIX, parse_mode="HTML")
+        await bot.copy_message(chat_id=user_id, from_chat_id=job["from_chat_id"], message_id=job["message_id"])
+
+
+async def _deliver(bot: Bot, job: dict, user_id: int) -> str:
+    """Отправка одному юзеру: "sent" | "blocked" | "failed" """
+    for _ in range(MAX_RETRIES):
+        try:
+            await _send(bot, job, user_id)
+            return "sent"
+        except TelegramRetryAfter as e:
+            # Флуд-контроль не отпустил и после повторов планировщика: ждем и еще попытка
+            await asyncio.sleep(e.retry_after)
+        except TelegramForbiddenError:
+            # Юзер заблокировал бота или удалил аккаунт (флаг ставит ReachabilityMiddleware)
+            return "blocked"
+        except TelegramBadRequest:
+            return "failed"
+        except Exception as e:
+            logging.warning(f"Broadcast send to {user_id} failed: {e}")
+            return "failed"
+    return "failed"
+
+
+def _progress_text(job: dict, counters: dict) -> str:
+    done = sum(counters.values())
+    total = int(job["total"]) or 1
+    title = {
+        "running": "⏳ <b>Идет рассылка...</b>",
+        "paused": "⏸ <b>Рассылка на паузе</b>",
+        "cancelled": "⛔ <b>Рассылка отменена</b>",
+        "done": "📢 <b>Рассылка завершена!</b>",
+    }[job["status"]]
+    return (
+        f"{title}\n\n"
+        f"Обработано: <b>{done}</b> из ~{job['total']} ({min(done / total, 1):.0%})\n"
+        f"✅ Успешно доставлено: <b>{counters['sent']}</b>\n"
+        f"❌ Не доставлено (блокировки): <b>{counters['blocked']}</b>\n"
+        f"⚠️ Ошибки: <b>{counters['failed']}</b>"
+    )
+
+
+async def _report(bot: Bot, job: dict, counters: dict):
+    final = job["status"] in ("done", "cancelled")
+    try:
+        await bot.edit_message_text(
+            _progress_text(job, counters),
+            chat_id=int(job["status_chat_id"]), message_id=int(job["status_message_id"]),
+            parse_mode="HTML",
+            reply_markup=get_admin_main_kb() if final else get_broadcast_kb(job["id"], job["status"] == "paused"),
+        )
+    except Exception:
+        # "message is not modified" и удаленное админом сообщение — не повод прерывать рассылку
+        pass
+
+
+# KEYS: 1 broadcast:lock:<id>
+# ARGV: 1 токен владельца, 2 TTL ("" — снять блокировку)
+# Ответ: 1 — блокировка наша (продлена или снята), 0 — ее держит другой узел или она истекла
+LOCK_LUA = """
+if redis.call('GET', KEYS[1]) ~= ARGV[1] then
+    return 0
+end
+if ARGV[2] == '' then
+    redis.call('DEL', KEYS[1])
+else
+    redis.call('EXPIRE', KEYS[1], ARGV[2])
+end
+return 1
+"""
+
+
+async def lock_reference(client, keys: list, args: list):
+    token, ttl = (str(a) for a in args)
+    if await client.get(keys[0]) != token:
+        return 0
+    if ttl:
+        await client.expire(keys[0], int(ttl))
+    else:
+        await client.delete(keys[0])
+    return 1
+
+
+lock_script = RedisScript(LOCK_LUA, lock_reference)
+
+
+async def _keep_lock(lock_key: str, token: str, lost: asyncio.Event):
+    """Продлевает блокировку, пока идет задача; не продлилась — поднимает lost"""
+    renewed_at = time.monotonic()
+    while True:
+        await asyncio.sleep(LOCK_RENEW_SECONDS)
+        try:
+            renewed = await lock_script(redis_client, [lock_key], [token, LOCK_TTL])
+        except Exception as e:
+            logging.warning(f"Broadcast lock {lock_key} renew error: {e}")
+            # Пока TTL не мог истечь — пробуем еще раз, дальше блокировка уже не наша
+            renewed = time.monotonic() - renewed_at < LOCK_TTL - LOCK_RENEW_SECONDS
+            if renewed:
+                continue
+        if not renewed:
+            lost.set()
+            return
+        renewed_at = time.monotonic()
+
+
+async def _acquire_lock(lock_key: str, token: str, job_id: str) -> bool:
+    """Ждет блокировку задачи (после падения узла — пока не истечет TTL).
+    False — задачу за это время завершил другой узел."""
+    while not await redis_client.set(lock_key, token, nx=True, ex=LOCK_TTL):
+        if not await redis_client.sismember(JOBS_KEY, job_id):
+            return False
+        await asyncio.sleep(LOCK_RENEW_SECONDS)
+    return True
+
+
+async def run_broadcast(bot: Bot, session_pool, job_id: str):
+    # Нижняя полоса исходящих: при нехватке лимита живые чаты идут первыми
+    lane.set(Lane.BACKGROUND)
+    key, lock_key, token = _job_key(job_id), f"broadcast:lock:{job_id}", uuid.uuid4().hex
+    if not await _acquire_lock(lock_key, token, job_id):
+        return
+    lost = asyncio.Event()
+    keeper = asyncio.create_task(_keep_lock(lock_key, token, lost))
+    try:
+        job = await redis_client.hgetall(key)
+        job["id"] = job_id
+        counters = {name: int(job[name]) for name in COUNTERS}
+        last_id = int(job["last_id"])
+        recipients = select(User.telegram_id).where(User.unreachable_since.is_(None))
+        active_days = int(job.get("active_days", 0))
+        if active_days:
+            # Сегмент считаем от старта задачи, чтобы после рестарта он не "уезжал"
+            since = datetime.datetime.utcfromtimestamp(int(job["started_at"])) - datetime.timedelta(days=active_days)
+            recipients = recipients.where(User.last_seen_at >= since)
+        semaphore = asyncio.Semaphore(BROADCAST_CONCURRENCY)
+        next_report = 0.0
+
+        async def deliver(user_id: int):
+            async with semaphore:
+                # Блокировка потеряна — остаток страницы отправит новый владелец
+                if not lost.is_set():
+                    counters[await _deliver(bot, job, user_id)] += 1
+
+        while True:
+            if lost.is_set():
+                break
+            now = time.monotonic()
+            if now >= next_report:
+                await _report(bot, job, counters)
+                next_report = now + BROADCAST_PROGRESS_SECONDS
+
+            job["status"] = await redis_client.hget(key, "status")
+            if job["status"] == "paused":
+                await asyncio.sleep(1)
+                continue
+            if job["status"] == "cancelled":
+                break
+
+            async with session_pool() as session:
+                page = (await session.scalars(
+                    recipients.where(User.telegram_id > last_id)
+                    .order_by(User.telegram_id).limit(BROADCAST_PAGE_SIZE)
+                )).all()
+            if not page:
+                job["status"] = "done"
+                break
+
+            await asyncio.gather(*(deliver(user_id) for user_id in page))
+            if lost.is_set():
+                break
+            last_id = page[-1]
+            await redis_client.hset(key, mapping={"last_id": last_id, **counters})
+
+        if lost.is_set():
+            logging.warning(f"Broadcast {job_id} lost its lock, leaving the job to its new owner")
+            return
+        async with redis_client.pipeline(transaction=True) as pipe:
+            pipe.hset(key, mapping={"status": job["status"], "last_id": last_id, **counters})
+            pipe.expire(key, FINISHED_TTL)
+            pipe.srem(JOBS_KEY, job_id)
+            await pipe.execute()
+        await _report(bot, job, counters)
+        logging.info(f"Broadcast {job_id} {job['status']}: {counters}")
+    finally:
+        keeper.cancel()
+        await lock_script(redis_client, [lock_key], [token, ""])
+
+
+def start_broadcast(bot: Bot, session_pool, job_id: str):
+    task = _tasks.get(job_id)
+    if task is None or task.done():
+        _tasks[job_id] = asyncio.create_task(_run_logged(bot, session_pool, job_id))
+
+
+async def _run_logged(bot: Bot, session_pool, job_id: str):
+    try:
+        await run_broadcast(bot, session_pool, job_id)
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        # Задача остается в broadcast:jobs и продолжится со следующим стартом
+        logging.error(f"Broadcast {job_id} error: {e}")
+    finally:
+        _tasks.pop(job_id, None)
+
+
+async def resume_broadcasts(bot: Bot, session_pool):
+    """Поднимает незавершенные рассылки (после рестарта) с сохраненного курсора"""
+    for job_id in await redis_client.smembers(JOBS_KEY):
+        logging.info(f"Resuming broadcast {job_id}")
+        start_broadcast(bot, session_pool, job_id)
+
+
+def stop_broadcasts():
+    for task in _tasks.values():
+        task.cancel()
@@ -0,0 +1,987 @@
+# app/services/match_scripts.py
+"""Серверные (Lua) скрипты матчмейкера и их эталонные реализации на Python.
+
+Каждый скрипт выполняется в Redis атомарно за один round-trip (EVALSHA).
+Python-версия повторяет ту же логику обычными командами: она нужна для
+тестов и симуляций на стендах без Lua (например, fakeredis без lupa).
+"""
+import hashlib
+import math
+from redis.exceptions import NoScriptError
+from app.config import MATCHMAKER_ENGINE
+
+
+class RedisScript:
+    # "lua" — EVALSHA в Redis, "python" — эталонная реализация (не атомарна!)
+    engine = MATCHMAKER_ENGINE
+
+    def __init__(self, lua: str, reference):
+        self.lua = lua
+        self.sha = hashlib.sha1(lua.encode()).hexdigest()
+        self.reference = reference
+
+    async def __call__(self, client, keys: list, args: list):
+        if self.engine == "python":
+            return await self.reference(client, keys, args)
+        try:
+            return await client.evalsha(self.sha, len(keys), *keys, *args)
+        except NoScriptError:
+            # Скрипт ещё не загружен (рестарт Redis / SCRIPT FLUSH) — EVAL заодно кэширует его
+            return await client.eval(self.lua, len(keys), *keys, *args)
+
+
+# ==========================================
+# ОБЩИЕ ФУНКЦИИ
+# ==========================================
+# Индекс для режима "scored": в дополнение к очереди queue:<g>:<s> юзер лежит
+# в qidx:<g>:<s>:<возраст-бакет>:<рейтинг-бакет> (тот же score), непустые
+# бакеты очереди перечислены в qbands:<g>:<s>, а свой бакет — в хеше queue_band.
+UNINDEX_LUA = """
+local function unindex(uid, queue)
+    local band = redis.call('HGET', 'queue_band', uid)
+    if band then
+        local suffix = string.sub(queue, 7)
+        local idx = 'qidx:' .. suffix .. ':' .. band
+        redis.call('ZREM', idx, uid)
+        if redis.call('ZCARD', idx) == 0 then
+            redis.call('SREM', 'qbands:' .. suffix, band)
+        end
+        redis.call('HDEL', 'queue_band', uid)
+    end
+end
+"""
+
+
+async def unindex_reference(client, uid: str, queue: str):
+    band = await client.hget("queue_band", uid)
+    if band:
+        suffix = queue[len("queue:"):]
+        idx = f"qidx:{suffix}:{band}"
+        await client.zrem(idx, uid)
+        if await client.zcard(idx) == 0:
+            await client.srem(f"qbands:{suffix}", band)
+        await client.hdel("queue_band", uid)
+
+
+def get_band(age, rating, age_band_width: float) -> tuple[int, int]:
+    """(возраст-бакет, рейтинг-бакет); -1 — возраст не указан"""
+    age_band = int(age // age_band_width) if age else -1
+    return age_band, int(math.floor(float(rating or 5)))
+
+
+def match_cost(my_band: tuple, band: tuple, wait: float, age_band_width: float,
+               age_window: float, rating_window: float, widen_seconds: float) -> float | None:
+    """Стоимость пары для режима "scored" (None — пока не подходит).
+
+    Окно допустимой разницы по возрасту и рейтингу расширяется с ожиданием
+    кандидата: от age_window/rating_window в момент входа до "кто угодно"
+    через widen_seconds. Среди подходящих выбираем самого близкого.
+    """
+    my_ab, my_rb = my_band
+    ab, rb = band
+    age_diff = 0 if my_ab < 0 or ab < 0 else abs(ab - my_ab) * age_band_width
+    rating_diff = abs(rb - my_rb)
+    widen = wait / widen_seconds
+    if widen < 1:
+        if age_diff > age_window * (1 + widen * 10) or rating_diff > rating_window * (1 + widen * 4):
+            return None
+    return age_diff / age_window + rating_diff / rating_window - min(widen, 1)
+
+
+MATCH_COST_LUA = """
+local function match_cost(my_ab, my_rb, ab, rb, wait, band_width, age_window, rating_window, widen_seconds)
+    local age_diff = 0
+    if my_ab >= 0 and ab >= 0 then
+        age_diff = math.abs(ab - my_ab) * band_width
+    end
+    local rating_diff = math.abs(rb - my_rb)
+    local widen = wait / widen_seconds
+    if widen < 1 then
+        if age_diff > age_window * (1 + widen * 10) or rating_diff > rating_window * (1 + widen * 4) then
+            return nil
+        end
+    end
+    return age_diff / age_window + rating_diff / rating_window - math.min(widen, 1)
+end
+"""
+
+
+# ==========================================
+# СЕССИИ ЧАТОВ
+# ==========================================
+# Чат — это хеш session:<sid> (a, b, started_at, msgs_a, msgs_b) с TTL,
+# указатели chat:<id> -> собеседник и chat_session:<id> -> sid у каждого
+# участника (у ИИ-чата b = "AI", указатели только у a) и sorted set
+# live_sessions (sid -> время последней активности). TTL продлевается
+# сообщениями (пачками с узлов, SessionTouches в app/services/matchmaker.py),
+# зависшие сессии добирает expire_stale_sessions.
+# Каждое открытие/закрытие публикует id участников в route_invalidate —
+# узлы сбрасывают локальный кэш маршрутов (app/services/route_cache.py)
+# и считается в хеше stats (app/services/stats.py).
+SESSION_LUA = """
+local function detach_ai(uid)
+    local bucket = redis.call('HGET', 'ai_chat_bucket', uid)
+    if bucket then
+        redis.call('SREM', bucket, uid)
+    end
+    redis.call('SREM', 'ai_chats', uid)
+    redis.call('HDEL', 'ai_chat_bucket', uid)
+end
+
+local function open_session(a, b, now, ttl)
+    local sid = tostring(redis.call('INCR', 'session_seq'))
+    local key = 'session:' .. sid
+    redis.call('HSET', key, 'a', a, 'b', b, 'started_at', now, 'msgs_a', 0, 'msgs_b', 0)
+    redis.call('EXPIRE', key, ttl)
+    redis.call('ZADD', 'live_sessions', now, sid)
+    redis.call('SET', 'chat:' .. a, b, 'EX', ttl)
+    redis.call('SET', 'chat_session:' .. a, sid, 'EX', ttl)
+    redis.call('PUBLISH', 'route_invalidate', a)
+    redis.call('HINCRBY', 'stats', 'chats_started', 1)
+    redis.call('HINCRBY', 'stats', 'chat_members:' .. (redis.call('HGET', 'user_prefs:' .. a, 'g') or '?'), 1)
+    if b ~= 'AI' then
+        redis.call('SET', 'chat:' .. b, a, 'EX', ttl)
+        redis.call('SET', 'chat_session:' .. b, sid, 'EX', ttl)
+        redis.call('PUBLISH', 'route_invalidate', b)
+        redis.call('HINCRBY', 'stats', 'chat_members:' .. (redis.call('HGET', 'user_prefs:' .. b, 'g') or '?'), 1)
+    else
+        redis.call('HINCRBY', 'stats', 'chats_ai', 1)
+    end
+    return sid
+end
+
+local function close_session(sid)
+    local key = 'session:' .. sid
+    local members = redis.call('HMGET', key, 'a', 'b')
+    if members[1] then
+        redis.call('HINCRBY', 'stats', 'chats_ended', 1)
+    end
+    redis.call('DEL', key)
+    redis.call('ZREM', 'live_sessions', sid)
+    for _, member in ipairs(members) do
+        -- Указатель мог уже смениться на новую сессию — его не трогаем
+        if member and member ~= 'AI' and redis.call('GET', 'chat_session:' .. member) == sid then
+            redis.call('DEL', 'chat:' .. member, 'chat_session:' .. member)
+            redis.call('PUBLISH', 'route_invalidate', member)
+        end
+    end
+    if members[1] and members[2] == 'AI' then
+        detach_ai(members[1])
+    end
+end
+"""
+
+
+async def detach_ai_reference(client, uid: str):
+    bucket = await client.hget("ai_chat_bucket", uid)
+    if bucket:
+        await client.srem(bucket, uid)
+    await client.srem("ai_chats", uid)
+    await client.hdel("ai_chat_bucket", uid)
+
+
+async def open_session_reference(client, a: str, b: str, now, ttl) -> str:
+    sid = str(await client.incr("session_seq"))
+    key = f"session:{sid}"
+    ttl = int(ttl)
+    await client.hset(key, mapping={"a": a, "b": b, "started_at": now, "msgs_a": 0, "msgs_b": 0})
+    await client.expire(key, ttl)
+    await client.zadd("live_sessions", {sid: float(now)})
+    await client.set(f"chat:{a}", b, ex=ttl)
+    await client.set(f"chat_session:{a}", sid, ex=ttl)
+    await client.publish("route_invalidate", a)
+    await client.hincrby("stats", "chats_started", 1)
+    await client.hincrby("stats", f"chat_members:{await client.hget(f'user_prefs:{a}', 'g') or '?'}", 1)
+    if b != "AI":
+        await client.set(f"chat:{b}", a, ex=ttl)
+        await client.set(f"chat_session:{b}", sid, ex=ttl)
+        await client.publish("route_invalidate", b)
+        await client.hincrby("stats", f"chat_members:{await client.hget(f'user_prefs:{b}', 'g') or '?'}", 1)
+    else:
+        await client.hincrby("stats", "chats_ai", 1)
+    return sid
+
+
+async def close_session_reference(client, sid: str):
+    key = f"session:{sid}"
+    members = await client.hmget(key, "a", "b")
+    if members[0]:
+        await client.hincrby("stats", "chats_ended", 1)
+    await client.delete(key)
+    await client.zrem("live_sessions", sid)
+    for member in members:
+        if member and member != "AI" and await client.get(f"chat_session:{member}") == sid:
+            await client.delete(f"chat:{member}", f"chat_session:{member}")
+            await client.publish("route_invalidate", member)
+    if members[0] and members[1] == "AI":
+        await detach_ai_reference(client, members[0])
+
+
+# ==========================================
+# ПОИСК СОБЕСЕДНИКА (join_queue)
+# ==========================================
+# KEYS: 1 user_prefs:<id>, 2 ai_chats, 3 queue_deadlines, 4 user_queue:<id>,
+#       5 своя очередь, 6 ai_chat_bucket, 7 match_quality,
+#       8..7+N подходящие очереди, 8+N..7+2N подходящие бакеты ai_chats:<g>:<s>
+# ARGV: 1 user_id, 2 пол, 3 кого ищет, 4 приоритет в очереди (время входа минус
+#       VIP-буст), 5 дедлайн ИИ-фоллбека, 6 TTL предпочтений, 7 N,
+#       8 режим ("fifo" | "scored"), 9 возраст ("" — не указан), 10 рейтинг,
+#       11 now, 12 таймаут ИИ-фоллбека, 13 ширина возраст-бакета,
+#       14 окно по возрасту, 15 окно по рейтингу, 16 время полного расширения окон,
+#       17 сколько недавних собеседников помнить, 18 сколько секунд их помнить,
+#       19 TTL сессии чата
+# Очереди — sorted set, score = приоритет (меньше — раньше)
+# Ответ: {partner_id | "", "ai" | "queue" | "queued"}
+JOIN_QUEUE_LUA = UNINDEX_LUA + MATCH_COST_LUA + SESSION_LUA + """
+local uid, g, s = ARGV[1], ARGV[2], ARGV[3]
+local n = tonumber(ARGV[7])
+local mode = ARGV[8]
+local my_age, my_rating = tonumber(ARGV[9]), tonumber(ARGV[10])
+local now, timeout = tonumber(ARGV[11]), tonumber(ARGV[12])
+local band_width = tonumber(ARGV[13])
+local recent_max, recent_ttl = tonumber(ARGV[17]), tonumber(ARGV[18])
+-- Сколько кандидатов смотреть в каждой очереди/бакете: недавних не больше recent_max,
+-- значит среди первых recent_max + 1 точно есть "новый" (если очередь не короче)
+local peek = recent_max + 1
+
+-- 0. Кэшируем предпочтения (возраст и рейтинг — для индекса и метрик качества)
+redis.call('HSET', KEYS[1], 'g', g, 's', s, 'a', ARGV[9], 'r', ARGV[10])
+redis.call('EXPIRE', KEYS[1], ARGV[6])
+redis.call('HINCRBY', 'stats', 'queue_joins:' .. g, 1)
+
+-- Повторный поиск (двойной клик): убираем старую запись из очереди
+local old_queue = redis.call('GET', KEYS[4])
+if old_queue then
+    redis.call('ZREM', old_queue, uid)
+    unindex(uid, old_queue)
+    redis.call('DEL', KEYS[4])
+end
+
+-- Память о недавних собеседниках: recent:<id> — sorted set (собеседник -> время),
+-- не больше recent_max записей и с TTL, чтобы "Следующий" не сводил тех же людей
+local recent_key = 'recent:' .. uid
+local function is_recent(candidate)
+    local seen = redis.call('ZSCORE', recent_key, candidate)
+    return seen and tonumber(seen) > now - recent_ttl
+end
+
+-- Заблокировавших бота (sorted set unreachable) в пару не выдаем
+local function skip(candidate)
+    return is_recent(candidate) or redis.call('ZSCORE', 'unreachable', candidate)
+end
+
+local function remember(a, b)
+    local key = 'recent:' .. a
+    redis.call('ZADD', key, now, b)
+    redis.call('ZREMRANGEBYRANK', key, 0, -(recent_max + 1))
+    redis.call('EXPIRE', key, recent_ttl)
+end
+
+local function connect(partner)
+    -- Перехваченный из ИИ-чата юзер: закрываем его ИИ-сессию
+    local old_sid = redis.call('GET', 'chat_session:' .. partner)
+    if old_sid then
+        close_session(old_sid)
+    end
+    open_session(uid, partner, ARGV[11], ARGV[19])
+    remember(uid, partner)
+    remember(partner, uid)
+end
+
+-- 1. Перехват из ИИ-чата: бакеты уже отфильтрованы по взаимной совместимости,
+-- поэтому достаточно взять несколько случайных из каждого (без обхода всех ИИ-чатов)
+for i = 8 + n, 7 + 2 * n do
+    for _, ai_uid in ipairs(redis.call('SRANDMEMBER', KEYS[i], peek)) do
+        if redis.call('GET', 'chat:' .. ai_uid) ~= 'AI' then
+            -- Устаревшая запись (юзер уже ушел из ИИ-чата)
+            redis.call('SREM', KEYS[i], ai_uid)
+            redis.call('SREM', KEYS[2], ai_uid)
+            redis.call('HDEL', KEYS[6], ai_uid)
+        elseif ai_uid ~= uid and not skip(ai_uid) then
+            redis.call('SREM', KEYS[i], ai_uid)
+            redis.call('SREM', KEYS[2], ai_uid)
+            redis.call('HDEL', KEYS[6], ai_uid)
+            connect(ai_uid)
+            return {ai_uid, 'ai'}
+        end
+    end
+end
+
+local function waited(partner)
+    local deadline = tonumber(redis.call('ZSCORE', KEYS[3], partner))
+    if not deadline then
+        return 0
+    end
+    return math.max(0, now - (deadline - timeout))
+end
+
+-- 2. Поиск в обычных очередях
+local best, best_queue
+if mode == 'scored' then
+    -- Смотрим только головы непустых бакетов возраст x рейтинг: внутри бакета
+    -- все равноценны, а дольше всех ждет (и шире всех окно) голова
+    local my_ab = my_age and math.floor(my_age / band_width) or -1
+    local my_rb = math.floor(my_rating)
+    local best_cost
+    for i = 8, 7 + n do
+        local suffix = string.sub(KEYS[i], 7)
+        for _, band in ipairs(redis.call('SMEMBERS', 'qbands:' .. suffix)) do
+            local sep = string.find(band, ':', 2, true)
+            local ab = tonumber(string.sub(band, 1, sep - 1))
+            local rb = tonumber(string.sub(band, sep + 1))
+            for _, candidate in ipairs(redis.call('ZRANGE', 'qidx:' .. suffix .. ':' .. band, 0, peek - 1)) do
+                if not skip(candidate) then
+                    local cost = match_cost(my_ab, my_rb, ab, rb, waited(candidate), band_width,
+                        tonumber(ARGV[14]), tonumber(ARGV[15]), tonumber(ARGV[16]))
+                    if cost and (not best_cost or cost < best_cost) then
+                        best, best_cost, best_queue = candidate, cost, KEYS[i]
+                    end
+                    break
+                end
+            end
+        end
+    end
+else
+    -- FIFO: наименьший score среди голов всех подходящих очередей
+    -- (VIP-буст + честное старение по времени)
+    local best_score
+    for i = 8, 7 + n do
+        local heads = redis.call('ZRANGE', KEYS[i], 0, peek - 1, 'WITHSCORES')
+        for j = 1, #heads, 2 do
+            if not skip(heads[j]) then
+                local score = tonumber(heads[j + 1])
+                if not best_score or score < best_score then
+                    best, best_score, best_queue = heads[j], score, KEYS[i]
+                end
+                break
+            end
+        end
+    end
+end
+
+if best then
+    -- Метрики качества пары по режимам: разница возраста/рейтинга и ожидание
+    local partner_prefs = redis.call('HMGET', 'user_prefs:' .. best, 'a', 'r')
+    redis.call('HINCRBY', KEYS[7], mode .. ':matches', 1)
+    redis.call('HINCRBYFLOAT', KEYS[7], mode .. ':wait', waited(best))
+    local partner_age = tonumber(partner_prefs[1])
+    if my_age and partner_age then
+        redis.call('HINCRBY', KEYS[7], mode .. ':age_pairs', 1)
+        redis.call('HINCRBYFLOAT', KEYS[7], mode .. ':age_diff', math.abs(my_age - partner_age))
+    end
+    local partner_rating = tonumber(partner_prefs[2])
+    if partner_rating then
+        redis.call('HINCRBYFLOAT', KEYS[7], mode .. ':rating_diff', math.abs(my_rating - partner_rating))
+    end
+
+    redis.call('ZREM', best_queue, best)
+    unindex(best, best_queue)
+    redis.call('ZREM', KEYS[3], best)
+    redis.call('DEL', 'user_queue:' .. best)
+    connect(best)
+    return {best, 'queue'}
+end
+
+-- 3. Никого нет — встаем в очередь
+redis.call('ZADD', KEYS[5], ARGV[4], uid)
+if mode == 'scored' then
+    local band = (my_age and math.floor(my_age / band_width) or -1) .. ':' .. math.floor(my_rating)
+    local suffix = string.sub(KEYS[5], 7)
+    redis.call('ZADD', 'qidx:' .. suffix .. ':' .. band, ARGV[4], uid)
+    redis.call('SADD', 'qbands:' .. suffix, band)
+    redis.call('HSET', 'queue_band', uid, band)
+end
+redis.call('ZADD', KEYS[3], ARGV[5], uid)
+redis.call('SET', KEYS[4], KEYS[5])
+-- Будим планировщик ИИ-фоллбека (если он спит без дедлайнов)
+redis.call('PUBLISH', 'queue_events', uid)
+return {'', 'queued'}
+"""
+
+
+async def join_queue_reference(client, keys: list, args: list):
+    prefs_key, ai_chats_key, deadlines_key, user_queue_key, my_queue, bucket_map_key, quality_key = keys[:7]
+    (uid, g, s, priority, deadline, prefs_ttl, n, mode, age, rating, now, timeout,
+     band_width, age_window, rating_window, widen_seconds, recent_max, recent_ttl,
+     session_ttl) = (str(a) for a in args)
+    n = int(n)
+    target_queues, ai_buckets = keys[7:7 + n], keys[7 + n:7 + 2 * n]
+    my_age = float(age) if age else None
+    my_rating = float(rating)
+    started_at = now
+    now, timeout, band_width = float(now), float(timeout), float(band_width)
+    recent_max, recent_ttl = int(recent_max), int(recent_ttl)
+    peek = recent_max + 1
+
+    await client.hset(prefs_key, mapping={"g": g, "s": s, "a": age, "r": rating})
+    await client.expire(prefs_key, int(prefs_ttl))
+    await client.hincrby("stats", f"queue_joins:{g}", 1)
+
+    old_queue = await client.get(user_queue_key)
+    if old_queue:
+        await client.zrem(old_queue, uid)
+        await unindex_reference(client, uid, old_queue)
+        await client.delete(user_queue_key)
+
+    async def is_recent(candidate):
+        seen = await client.zscore(f"recent:{uid}", candidate)
+        return seen is not None and seen > now - recent_ttl
+
+    async def skip(candidate):
+        return await is_recent(candidate) or await client.zscore("unreachable", candidate) is not None
+
+    async def remember(a, b):
+        key = f"recent:{a}"
+        await client.zadd(key, {b: now})
+        await client.zremrangebyrank(key, 0, -(recent_max + 1))
+        await client.expire(key, recent_ttl)
+
+    async def connect(partner):
+        old_sid = await client.get(f"chat_session:{partner}")
+        if old_sid:
+            await close_session_reference(client, old_sid)
+        await open_session_reference(client, uid, partner, started_at, session_ttl)
+        await remember(uid, partner)
+        await remember(partner, uid)
+
+    for bucket in ai_buckets:
+        for ai_uid in await client.srandmember(bucket, peek):
+            if await client.get(f"chat:{ai_uid}") != "AI":
+                await client.srem(bucket, ai_uid)
+                await client.srem(ai_chats_key, ai_uid)
+                await client.hdel(bucket_map_key, ai_uid)
+            elif ai_uid != uid and not await skip(ai_uid):
+                await client.srem(bucket, ai_uid)
+                await client.srem(ai_chats_key, ai_uid)
+                await client.hdel(bucket_map_key, ai_uid)
+                await connect(ai_uid)
+                return [ai_uid, "ai"]
+
+    async def waited(partner):
+        partner_deadline = await client.zscore(deadlines_key, partner)
+        if partner_deadline is None:
+            return 0
+        return max(0, now - (partner_deadline - timeout))
+
+    best = best_queue = None
+    if mode == "scored":
+        my_band = get_band(my_age, my_rating, band_width)
+        best_cost = None
+        for q in target_queues:
+            suffix = q[len("queue:"):]
+            for band in await client.smembers(f"qbands:{suffix}"):
+                ab, rb = (int(x) for x in band.rsplit(":", 1))
+                for candidate in await client.zrange(f"qidx:{suffix}:{band}", 0, peek - 1):
+                    if await skip(candidate):
+                        continue
+                    cost = match_cost(my_band, (ab, rb), await waited(candidate), band_width,
+                                      float(age_window), float(rating_window), float(widen_seconds))
+                    if cost is not None and (best_cost is None or cost < best_cost):
+                        best, best_cost, best_queue = candidate, cost, q
+                    break
+    else:
+        best_score = None
+        for q in target_queues:
+            for candidate, score in await client.zrange(q, 0, peek - 1, withscores=True):
+                if await skip(candidate):
+                    continue
+                if best_score is None or score < best_score:
+                    best, best_score, best_queue = candidate, score, q
+                break
+
+    if best:
+        partner_age, partner_rating = await client.hmget(f"user_prefs:{best}", "a", "r")
+        await client.hincrby(quality_key, f"{mode}:matches", 1)
+        await client.hincrbyfloat(quality_key, f"{mode}:wait", await waited(best))
+        if my_age is not None and partner_age:
+            await client.hincrby(quality_key, f"{mode}:age_pairs", 1)
+            await client.hincrbyfloat(quality_key, f"{mode}:age_diff", abs(my_age - float(partner_age)))
+        if partner_rating:
+            await client.hincrbyfloat(quality_key, f"{mode}:rating_diff", abs(my_rating - float(partner_rating)))
+
+        await client.zrem(best_queue, best)
+        await unindex_reference(client, best, best_queue)
+        await client.zrem(deadlines_key, best)
+        await client.delete(f"user_queue:{best}")
+        await connect(best)
+        return [best, "queue"]
+
+    await client.zadd(my_queue, {uid: float(priority)})
+    if mode == "scored":
+        ab, rb = get_band(my_age, my_rating, band_width)
+        band = f"{ab}:{rb}"
+        suffix = my_queue[len("queue:"):]
+        await client.zadd(f"qidx:{suffix}:{band}", {uid: float(priority)})
+        await client.sadd(f"qbands:{suffix}", band)
+        await client.hset("queue_band", uid, band)
+    await client.zadd(deadlines_key, {uid: float(deadline)})
+    await client.set(user_queue_key, my_queue)
+    await client.publish("queue_events", uid)
+    return ["", "queued"]
+
+
+join_queue_script = RedisScript(JOIN_QUEUE_LUA, join_queue_reference)
+
+
+# ==========================================
+# ИИ-ФОЛЛБЕК: ЗАХВАТ ПРОСРОЧЕННЫХ ОЖИДАНИЙ
+# ==========================================
+# KEYS: 1 queue_deadlines, 2 ai_chats, 3 ai_chat_bucket, 4 match_quality
+# ARGV: 1 now, 2 максимум юзеров за вызов, 3 режим матчинга (для метрик), 4 TTL сессии
+# Ответ: список id, которые сняты с очереди и подключены к ИИ
+CLAIM_DUE_LUA = UNINDEX_LUA + SESSION_LUA + """
+local claimed = {}
+local due = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, ARGV[2])
+for _, uid in ipairs(due) do
+    redis.call('ZREM', KEYS[1], uid)
+    local queue = redis.call('GET', 'user_queue:' .. uid)
+    -- Нет записи об очереди — юзер уже нашел собеседника или отменил поиск
+    if queue then
+        redis.call('ZREM', queue, uid)
+        unindex(uid, queue)
+        redis.call('DEL', 'user_queue:' .. uid)
+        if not redis.call('GET', 'chat:' .. uid) then
+            -- queue:<g>:<s> -> ai_chats:<g>:<s>
+            local bucket = 'ai_chats:' .. string.sub(queue, 7)
+            open_session(uid, 'AI', ARGV[1], ARGV[4])
+            redis.call('SADD', KEYS[2], uid)
+            redis.call('SADD', bucket, uid)
+            redis.call('HSET', KEYS[3], uid, bucket)
+            redis.call('HINCRBY', KEYS[4], ARGV[3] .. ':ai_fallbacks', 1)
+            table.insert(claimed, uid)
+        end
+    end
+end
+return claimed
+"""
+
+
+async def claim_due_reference(client, keys: list, args: list):
+    deadlines_key, ai_chats_key, bucket_map_key, quality_key = keys
+    now, limit, mode, session_ttl = args
+    claimed = []
+    for uid in await client.zrangebyscore(deadlines_key, "-inf", now, start=0, num=int(limit)):
+        await client.zrem(deadlines_key, uid)
+        queue = await client.get(f"user_queue:{uid}")
+        if not queue:
+            continue
+        await client.zrem(queue, uid)
+        await unindex_reference(client, uid, queue)
+        await client.delete(f"user_queue:{uid}")
+        if await client.get(f"chat:{uid}"):
+            continue
+        bucket = "ai_chats:" + queue[len("queue:"):]
+        await open_session_reference(client, uid, "AI", now, session_ttl)
+        await client.sadd(ai_chats_key, uid)
+        await client.sadd(bucket, uid)
+        await client.hset(bucket_map_key, uid, bucket)
+        await client.hincrby(quality_key, f"{mode}:ai_fallbacks", 1)
+        claimed.append(uid)
+    return claimed
+
+
+claim_due_script = RedisScript(CLAIM_DUE_LUA, claim_due_reference)
+
+
+# ==========================================
+# ПОВТОРНЫЙ ПОДБОР ОЖИДАЮЩИХ (режим "scored")
+# ==========================================
+# join_queue подбирает пару только в момент входа, а окна по возрасту и рейтингу
+# расширяются с ожиданием — два ожидающих, ставших подходящими друг другу, иначе
+# так и дождались бы ИИ. Планировщик (ai_fallback_worker) перед захватом
+# просроченных прогоняет головы бакетов через тот же match_cost.
+# KEYS: 1 queue_deadlines, 2 match_quality, 3.. все очереди queue:<g>:<s>
+# ARGV: 1 now, 2 таймаут ИИ-фоллбека, 3 ширина возраст-бакета, 4 окно по возрасту,
+#       5 окно по рейтингу, 6 время полного расширения окон, 7 сколько недавних
+#       собеседников помнить, 8 сколько секунд их помнить, 9 TTL сессии чата,
+#       10 максимум пар за вызов, 11 режим (для метрик)
+# Ответ: плоский список пар {a1, b1, a2, b2, ...}, которым открыты сессии
+REMATCH_LUA = UNINDEX_LUA + MATCH_COST_LUA + SESSION_LUA + """
+local now, timeout = tonumber(ARGV[1]), tonumber(ARGV[2])
+local band_width = tonumber(ARGV[3])
+local recent_max, recent_ttl = tonumber(ARGV[7]), tonumber(ARGV[8])
+local limit, mode = tonumber(ARGV[10]), ARGV[11]
+local peek = recent_max + 1
+local matched = {}
+
+local function waited(uid)
+    local deadline = tonumber(redis.call('ZSCORE', KEYS[1], uid))
+    if not deadline then
+        return 0
+    end
+    return math.max(0, now - (deadline - timeout))
+end
+
+local function skip(uid, candidate)
+    local seen = redis.call('ZSCORE', 'recent:' .. uid, candidate)
+    return (seen and tonumber(seen) > now - recent_ttl) or redis.call('ZSCORE', 'unreachable', candidate)
+end
+
+local function remember(a, b)
+    local key = 'recent:' .. a
+    redis.call('ZADD', key, now, b)
+    redis.call('ZREMRANGEBYRANK', key, 0, -(recent_max + 1))
+    redis.call('EXPIRE', key, recent_ttl)
+end
+
+local function take(uid, queue)
+    redis.call('ZREM', queue, uid)
+    unindex(uid, queue)
+    redis.call('ZREM', KEYS[1], uid)
+    redis.call('DEL', 'user_queue:' .. uid)
+end
+
+-- Очереди, где ждут подходящие юзеру из queue:<g>:<s> (как get_target_queues)
+local function targets(suffix)
+    local g, s = string.sub(suffix, 1, 1), string.sub(suffix, 3)
+    if s == 'any' then
+        return {'M:' .. g, 'M:any', 'F:' .. g, 'F:any'}
+    end
+    return {s .. ':' .. g, s .. ':any'}
+end
+
+local function parse_band(band)
+    local sep = string.find(band, ':', 2, true)
+    return tonumber(string.sub(band, 1, sep - 1)), tonumber(string.sub(band, sep + 1))
+end
+
+local function bands(suffix)
+    local list = redis.call('SMEMBERS', 'qbands:' .. suffix)
+    table.sort(list)
+    return list
+end
+
+for i = 3, #KEYS do
+    local suffix = string.sub(KEYS[i], 7)
+    for _, band in ipairs(bands(suffix)) do
+        if #matched >= 2 * limit then
+            return matched
+        end
+        local uid = redis.call('ZRANGE', 'qidx:' .. suffix .. ':' .. band, 0, 0)[1]
+        if uid and not redis.call('ZSCORE', 'unreachable', uid) then
+            local my_ab, my_rb = parse_band(band)
+            local my_wait = waited(uid)
+            local best, best_cost, best_queue, best_wait
+            for _, target in ipairs(targets(suffix)) do
+                for _, other in ipairs(bands(target)) do
+                    local ab, rb = parse_band(other)
+                    for _, candidate in ipairs(redis.call('ZRANGE', 'qidx:' .. target .. ':' .. other, 0, peek - 1)) do
+                        if candidate ~= uid and not skip(uid, candidate) then
+                            local wait = math.max(my_wait, waited(candidate))
+                            local cost = match_cost(my_ab, my_rb, ab, rb, wait, band_width,
+                                tonumber(ARGV[4]), tonumber(ARGV[5]), tonumber(ARGV[6]))
+                            if cost and (not best_cost or cost < best_cost) then
+                                best, best_cost, best_queue, best_wait = candidate, cost, 'queue:' .. target, wait
+                            end
+                            break
+                        end
+                    end
+                end
+            end
+
+            if best then
+                local prefs = redis.call('HMGET', 'user_prefs:' .. uid, 'a', 'r')
+                local partner_prefs = redis.call('HMGET', 'user_prefs:' .. best, 'a', 'r')
+                redis.call('HINCRBY', KEYS[2], mode .. ':matches', 1)
+                redis.call('HINCRBY', KEYS[2], mode .. ':rematches', 1)
+                redis.call('HINCRBYFLOAT', KEYS[2], mode .. ':wait', best_wait)
+                local my_age, partner_age = tonumber(prefs[1]), tonumber(partner_prefs[1])
+                if my_age and partner_age then
+                    redis.call('HINCRBY', KEYS[2], mode .. ':age_pairs', 1)
+                    redis.call('HINCRBYFLOAT', KEYS[2], mode .. ':age_diff', math.abs(my_age - partner_age))
+                end
+                local my_rating, partner_rating = tonumber(prefs[2]), tonumber(partner_prefs[2])
+                if my_rating and partner_rating then
+                    redis.call('HINCRBYFLOAT', KEYS[2], mode .. ':rating_diff', math.abs(my_rating - partner_rating))
+                end
+
+                take(uid, KEYS[i])
+                take(best, best_queue)
+                open_session(uid, best, ARGV[1], ARGV[9])
+                remember(uid, best)
+                remember(best, uid)
+                table.insert(matched, uid)
+                table.insert(matched, best)
+            end
+        end
+    end
+end
+return matched
+"""
+
+
+async def rematch_reference(client, keys: list, args: list):
+    deadlines_key, quality_key = keys[:2]
+    (now, timeout, band_width, age_window, rating_window, widen_seconds,
+     recent_max, recent_ttl, session_ttl, limit, mode) = (str(a) for a in args)
+    started_at = now
+    now, timeout, band_width = float(now), float(timeout), float(band_width)
+    recent_max, recent_ttl, limit = int(recent_max), int(recent_ttl), int(limit)
+    peek = recent_max + 1
+    matched = []
+
+    async def waited(uid):
+        deadline = await client.zscore(deadlines_key, uid)
+        if deadline is None:
+            return 0
+        return max(0, now - (deadline - timeout))
+
+    async def skip(uid, candidate):
+        seen = await client.zscore(f"recent:{uid}", candidate)
+        return (seen is not None and seen > now - recent_ttl) or await client.zscore("unreachable", candidate) is not None
+
+    async def remember(a, b):
+        key = f"recent:{a}"
+        await client.zadd(key, {b: now})
+        await client.zremrangebyrank(key, 0, -(recent_max + 1))
+        await client.expire(key, recent_ttl)
+
+    async def take(uid, queue):
+        await client.zrem(queue, uid)
+        await unindex_reference(client, uid, queue)
+        await client.zrem(deadlines_key, uid)
+        await client.delete(f"user_queue:{uid}")
+
+    def targets(suffix):
+        g, s = suffix.split(":")
+        if s == "any":
+            return [f"M:{g}", "M:any", f"F:{g}", "F:any"]
+        return [f"{s}:{g}", f"{s}:any"]
+
+    def parse_band(band):
+        return tuple(int(x) for x in band.rsplit(":", 1))
+
+    async def bands(suffix):
+        return sorted(await client.smembers(f"qbands:{suffix}"))
+
+    for queue in keys[2:]:
+        suffix = queue[len("queue:"):]
+        for band in await bands(suffix):
+            if len(matched) >= 2 * limit:
+                return matched
+            head = await client.zrange(f"qidx:{suffix}:{band}", 0, 0)
+            if not head or await client.zscore("unreachable", head[0]) is not None:
+                continue
+            uid = head[0]
+            my_band = parse_band(band)
+            my_wait = await waited(uid)
+            best = best_cost = best_queue = best_wait = None
+            for target in targets(suffix):
+                for other in await bands(target):
+                    for candidate in await client.zrange(f"qidx:{target}:{other}", 0, peek - 1):
+                        if candidate == uid or await skip(uid, candidate):
+                            continue
+                        wait = max(my_wait, await waited(candidate))
+                        cost = match_cost(my_band, parse_band(other), wait, band_width,
+                                          float(age_window), float(rating_window), float(widen_seconds))
+                        if cost is not None and (best_cost is None or cost < best_cost):
+                            best, best_cost, best_queue, best_wait = candidate, cost, f"queue:{target}", wait
+                        break
+            if not best:
+                continue
+
+            my_age, my_rating = await client.hmget(f"user_prefs:{uid}", "a", "r")
+            partner_age, partner_rating = await client.hmget(f"user_prefs:{best}", "a", "r")
+            await client.hincrby(quality_key, f"{mode}:matches", 1)
+            await client.hincrby(quality_key, f"{mode}:rematches", 1)
+            await client.hincrbyfloat(quality_key, f"{mode}:wait", best_wait)
+            if my_age and partner_age:
+                await client.hincrby(quality_key, f"{mode}:age_pairs", 1)
+                await client.hincrbyfloat(quality_key, f"{mode}:age_diff", abs(float(my_age) - float(partner_age)))
+            if my_rating and partner_rating:
+                await client.hincrbyfloat(quality_key, f"{mode}:rating_diff", abs(float(my_rating) - float(partner_rating)))
+
+            await take(uid, queue)
+            await take(best, best_queue)
+            await open_session_reference(client, uid, best, started_at, session_ttl)
+            await remember(uid, best)
+            await remember(best, uid)
+            matched += [uid, best]
+    return matched
+
+
+rematch_script = RedisScript(REMATCH_LUA, rematch_reference)
+
+
+# ==========================================
+# ВЫХОД ИЗ ОЧЕРЕДИ (отмена, бан, отключение)
+# ==========================================
+# KEYS: 1 user_queue:<id>, 2 queue_deadlines
+# ARGV: 1 user_id
+REMOVE_FROM_QUEUE_LUA = UNINDEX_LUA + """
+local queue = redis.call('GET', KEYS[1])
+if queue then
+    redis.call('ZREM', queue, ARGV[1])
+    unindex(ARGV[1], queue)
+    redis.call('DEL', KEYS[1])
+end
+redis.call('ZREM', KEYS[2], ARGV[1])
+return queue
+"""
+
+
+async def remove_from_queue_reference(client, keys: list, args: list):
+    user_queue_key, deadlines_key = keys
+    uid = str(args[0])
+    queue = await client.get(user_queue_key)
+    if queue:
+        await client.zrem(queue, uid)
+        await unindex_reference(client, uid, queue)
+        await client.delete(user_queue_key)
+    await client.zrem(deadlines_key, uid)
+    return queue
+
+
+remove_from_queue_script = RedisScript(REMOVE_FROM_QUEUE_LUA, remove_from_queue_reference)
+
+
+# ==========================================
+# СЕССИИ: СОЗДАНИЕ, ВЫХОД, АКТИВНОСТЬ, ОЧИСТКА
+# ==========================================
+# KEYS: 1 chat_session:<a>
+# ARGV: 1 a, 2 b (id собеседника или "AI"), 3 now, 4 TTL сессии
+# Ответ: sid новой сессии
+OPEN_SESSION_LUA = SESSION_LUA + """
+local old_sid = redis.call('GET', KEYS[1])
+if old_sid then
+    close_session(old_sid)
+end
+return open_session(ARGV[1], ARGV[2], ARGV[3], ARGV[4])
+"""
+
+
+async def open_session_script_reference(client, keys: list, args: list):
+    a, b, now, ttl = (str(x) for x in args)
+    old_sid = await client.get(keys[0])
+    if old_sid:
+        await close_session_reference(client, old_sid)
+    return await open_session_reference(client, a, b, now, ttl)
+
+
+open_session_script = RedisScript(OPEN_SESSION_LUA, open_session_script_reference)
+
+
+# KEYS: 1 chat:<id>, 2 chat_session:<id>
+# ARGV: 1 user_id
+# Ответ: {собеседник (id или "AI"), sid} — nil вместо значения, если его нет
+LEAVE_CHAT_LUA = SESSION_LUA + """
+local partner = redis.call('GET', KEYS[1])
+local sid = redis.call('GET', KEYS[2])
+if sid then
+    close_session(sid)
+end
+-- Чаты, созданные до появления сессий (или с уже истекшим хешем): чистим указатели напрямую
+if partner then
+    redis.call('DEL', KEYS[1], KEYS[2])
+    redis.call('PUBLISH', 'route_invalidate', ARGV[1])
+    if partner == 'AI' then
+        detach_ai(ARGV[1])
+    elseif redis.call('GET', 'chat:' .. partner) == ARGV[1] then
+        redis.call('DEL', 'chat:' .. partner, 'chat_session:' .. partner)
+        redis.call('PUBLISH', 'route_invalidate', partner)
+    end
+end
+return {partner, sid}
+"""
+
+
+async def leave_chat_reference(client, keys: list, args: list):
+    chat_key, session_key = keys
+    uid = str(args[0])
+    partner = await client.get(chat_key)
+    sid = await client.get(session_key)
+    if sid:
+        await close_session_reference(client, sid)
+    if partner:
+        await client.delete(chat_key, session_key)
+        await client.publish("route_invalidate", uid)
+        if partner == "AI":
+            await detach_ai_reference(client, uid)
+        elif await client.get(f"chat:{partner}") == uid:
+            await client.delete(f"chat:{partner}", f"chat_session:{partner}")
+            await client.publish("route_invalidate", partner)
+    return [partner, sid]
+
+
+leave_chat_script = RedisScript(LEAVE_CHAT_LUA, leave_chat_reference)
+
+
+# KEYS: chat_session:<id> для каждого юзера пачки
+# ARGV: 1 TTL сессии, дальше по тройке на ключ: user_id, время последнего
+#       сообщения, сколько сообщений
+# Считает сообщения отправителей и продлевает жизнь их сессий. Ответ: сколько сессий найдено
+TOUCH_SESSION_LUA = """
+local touched = 0
+for i, chat_key in ipairs(KEYS) do
+    local uid, now, count = ARGV[3 * i - 1], ARGV[3 * i], ARGV[3 * i + 1]
+    local sid = redis.call('GET', chat_key)
+    local key = sid and ('session:' .. sid)
+    local members = key and redis.call('HMGET', key, 'a', 'b') or {}
+    if members[1] then
+        redis.call('HINCRBY', key, members[1] == uid and 'msgs_a' or 'msgs_b', count)
+        redis.call('EXPIRE', key, ARGV[1])
+        local seen = redis.call('ZSCORE', 'live_sessions', sid)
+        if seen and tonumber(seen) < tonumber(now) then
+            redis.call('ZADD', 'live_sessions', 'XX', now, sid)
+        end
+        for _, member in ipairs(members) do
+            if member ~= 'AI' then
+                redis.call('EXPIRE', 'chat:' .. member, ARGV[1])
+                redis.call('EXPIRE', 'chat_session:' .. member, ARGV[1])
+            end
+        end
+        touched = touched + 1
+    end
+end
+return touched
+"""
+
+
+async def touch_session_reference(client, keys: list, args: list):
+    ttl, touched = int(args[0]), 0
+    for i, chat_key in enumerate(keys):
+        uid, now, count = str(args[3 * i + 1]), float(args[3 * i + 2]), int(args[3 * i + 3])
+        sid = await client.get(chat_key)
+        if not sid:
+            continue
+        key = f"session:{sid}"
+        members = await client.hmget(key, "a", "b")
+        if not members[0]:
+            continue
+        await client.hincrby(key, "msgs_a" if members[0] == uid else "msgs_b", count)
+        await client.expire(key, ttl)
+        seen = await client.zscore("live_sessions", sid)
+        if seen is not None and seen < now:
+            await client.zadd("live_sessions", {sid: now}, xx=True)
+        for member in members:
+            if member != "AI":
+                await client.expire(f"chat:{member}", ttl)
+                await client.expire(f"chat_session:{member}", ttl)
+        touched += 1
+    return touched
+
+
+touch_session_script = RedisScript(TOUCH_SESSION_LUA, touch_session_reference)
+
+
+# KEYS: 1 live_sessions
+# ARGV: 1 граница неактивности (unix time), 2 максимум сессий за вызов
+# Ответ: сколько зависших сессий закрыто
+EXPIRE_SESSIONS_LUA = SESSION_LUA + """
+local stale = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, ARGV[2])
+for _, sid in ipairs(stale) do
+    close_session(sid)
+end
+return #stale
+"""
+
+
+async def expire_sessions_reference(client, keys: list, args: list):
+    cutoff, limit = args
+    stale = await client.zrangebyscore(keys[0], "-inf", cutoff, start=0, num=int(limit))
+    for sid in stale:
+        await close_session_reference(client, sid)
+    return len(stale)
+
+
+expire_sessions_script = RedisScript(EXPIRE_SESSIONS_LUA, expire_sessions_reference)
@@ -1,102 +1,266 @@
 # app/services/matchmaker.py
+import asyncio
+import logging
 import time
 import redis.asyncio as redis
+from app.config import (
+    PREFS_TTL, AI_FALLBACK_TIMEOUT, VIP_QUEUE_BOOST, MATCH_MODE,
+    MATCH_AGE_BAND, MATCH_AGE_WINDOW, MATCH_RATING_WINDOW, MATCH_WIDEN_SECONDS,
+    RECENT_PARTNERS_MAX, RECENT_PARTNERS_TTL, SESSION_TTL, SESSION_PUSH_SECONDS, RATED_TTL,
+)
+from app.services.match_scripts import (
+    join_queue_script, claim_due_script, rematch_script, remove_from_queue_script,
+    open_session_script, leave_chat_script, touch_session_script, expire_sessions_script,
+)
+from app.services.route_cache import route_cache
 
 redis_client = redis.Redis(host='localhost', port=6379, decode_responses=True)
+# Сколько юзеров продлеваем одним вызовом скрипта
+SESSION_PUSH_CHUNK = 500
 
-async def get_partner_from_queues(target_queues: list) -> int | None:
-    """Проверяет подходящие очереди и возвращает собеседника"""
-    for q in target_queues:
-        partner_id = await redis_client.lpop(q)
-        if partner_id:
-            return int(partner_id)
-    return None
-
-async def join_queue(user_id: int, is_vip: bool, user_gender: str, search_gender: str) -> tuple[int | None, bool]:
-    user_id_str = str(user_id)
-    
-    # 0. Кэшируем предпочтения юзера в Redis на 24 часа для быстрого доступа
-    await redis_client.hset(f"user_prefs:{user_id_str}", mapping={"g": user_gender, "s": search_gender})
-    await redis_client.expire(f"user_prefs:{user_id_str}", 86400)
-
-    # ==========================================
-    # 1. ПЕРЕХВАТ ИЗ ИИ-ЧАТА (С УЧЕТОМ ФИЛЬТРОВ)
-    # ==========================================
-    ai_chat_users = await redis_client.smembers("ai_chats")
-    for ai_user_id in ai_chat_users:
-        # Получаем данные того, кто общается с ИИ
-        prefs = await redis_client.hgetall(f"user_prefs:{ai_user_id}")
-        if not prefs:
-            continue
-            
-        ai_g = prefs.get("g", "M")
-        ai_s = prefs.get("s", "any")
-        
-        # Проверяем ВЗАИМНУЮ совместимость
-        is_match_for_me = (search_gender == 'any' or search_gender == ai_g)
-        is_match_for_them = (ai_s == 'any' or ai_s == user_gender)
-        
-        if is_match_for_me and is_match_for_them:
-            # Atomic удаление: если мы смогли его удалить (никто не перехватил до нас)
-            if await redis_client.srem("ai_chats", ai_user_id):
-                await connect_users(user_id, int(ai_user_id))
-                return int(ai_user_id), True
-
-    # ==========================================
-    # 2. ПОИСК В ОБЫЧНЫХ ОЧЕРЕДЯХ
-    # ==========================================
-    target_queues = []
+def get_target_queues(user_gender: str, search_gender: str, prefix: str = "queue") -> list:
+    """Бакеты (очереди или индексы ИИ-чатов), где может ждать подходящий собеседник"""
     if search_gender == 'any':
-        target_queues = [f"queue:M:{user_gender}", f"queue:M:any", f"queue:F:{user_gender}", f"queue:F:any"]
+        return [f"{prefix}:M:{user_gender}", f"{prefix}:M:any", f"{prefix}:F:{user_gender}", f"{prefix}:F:any"]
     elif search_gender == 'M':
-        target_queues = [f"queue:M:{user_gender}", f"queue:M:any"]
+        return [f"{prefix}:M:{user_gender}", f"{prefix}:M:any"]
     elif search_gender == 'F':
-        target_queues = [f"queue:F:{user_gender}", f"queue:F:any"]
-
-    partner_id = await get_partner_from_queues(target_queues)
-    
-    if partner_id and int(partner_id) != user_id:
-        await redis_client.hdel("queue_times", str(partner_id))
-        await redis_client.delete(f"user_queue:{partner_id}") 
-        await connect_users(user_id, partner_id)
-        return int(partner_id), False
-
-    # ==========================================
-    # 3. ЕСЛИ НИКОГО НЕТ - ВСТАЕМ В ОЧЕРЕДЬ
-    # ==========================================
+        return [f"{prefix}:F:{user_gender}", f"{prefix}:F:any"]
+    return []
+
+async def join_queue(user_id: int, is_vip: bool, user_gender: str, search_gender: str,
+                     age: int | None = None, rating: float | None = None) -> tuple[int | None, bool]:
+    """Кэширование предпочтений, перехват из ИИ-чата, поиск в очередях и постановка
+    в очередь выполняются одним атомарным скриптом (один round-trip, без гонок).
+    Возраст и рейтинг учитываются в режиме MATCH_MODE="scored"."""
+    user_id_str = str(user_id)
     my_queue = f"queue:{user_gender}:{search_gender}"
-    
-    if is_vip:
-        await redis_client.lpush(my_queue, user_id)
-    else:
-        await redis_client.rpush(my_queue, user_id)
-        
-    await redis_client.hset("queue_times", user_id_str, int(time.time()))
-    await redis_client.set(f"user_queue:{user_id_str}", my_queue)
-    return None, False
-
-async def connect_users(user1: int, user2: int):
-    await redis_client.set(f"chat:{user1}", user2)
-    await redis_client.set(f"chat:{user2}", user1)
+
+    target_queues = get_target_queues(user_gender, search_gender)
+    ai_buckets = get_target_queues(user_gender, search_gender, prefix="ai_chats")
+
+    keys = [
+        f"user_prefs:{user_id_str}", "ai_chats", "queue_deadlines", f"user_queue:{user_id_str}",
+        my_queue, "ai_chat_bucket", "match_quality", *target_queues, *ai_buckets,
+    ]
+    now = time.time()
+    # Приоритет в очереди: время входа, у VIP — "сдвинутое в прошлое" на буст
+    priority = now - VIP_QUEUE_BOOST if is_vip else now
+    args = [
+        user_id_str, user_gender, search_gender, priority, now + AI_FALLBACK_TIMEOUT, PREFS_TTL,
+        len(target_queues), MATCH_MODE, age or "", rating if rating is not None else 5.0,
+        now, AI_FALLBACK_TIMEOUT, MATCH_AGE_BAND, MATCH_AGE_WINDOW, MATCH_RATING_WINDOW, MATCH_WIDEN_SECONDS,
+        RECENT_PARTNERS_MAX, RECENT_PARTNERS_TTL, SESSION_TTL,
+    ]
+
+    partner_id, outcome = await join_queue_script(redis_client, keys, args)
+    if not partner_id:
+        return None, False
+    return int(partner_id), outcome == "ai"
+
+async def connect_users(user1: int, user2: int) -> str:
+    """Создает сессию чата двух юзеров (хеш, указатели, live_sessions) одним вызовом"""
+    return await open_session_script(
+        redis_client, [f"chat_session:{user1}"], [user1, user2, time.time(), SESSION_TTL]
+    )
+
+async def claim_due_users(limit: int = 100) -> list[int]:
+    """Атомарно снимает с очереди тех, чей дедлайн ожидания истек, и подключает их к ИИ"""
+    claimed = await claim_due_script(
+        redis_client, ["queue_deadlines", "ai_chats", "ai_chat_bucket", "match_quality"],
+        [time.time(), limit, MATCH_MODE, SESSION_TTL]
+    )
+    return [int(user_id) for user_id in claimed]
+
+async def rematch_waiting(limit: int = 100) -> list[tuple[int, int]]:
+    """Режим "scored": сводит ожидающих, которым за время ожидания расширенные окна
+    подбора подошли друг другу. Возвращает пары, которым открыты сессии"""
+    if MATCH_MODE != "scored":
+        return []
+    matched = await rematch_script(
+        redis_client, ["queue_deadlines", "match_quality", *QUEUE_BUCKETS],
+        [time.time(), AI_FALLBACK_TIMEOUT, MATCH_AGE_BAND, MATCH_AGE_WINDOW, MATCH_RATING_WINDOW,
+         MATCH_WIDEN_SECONDS, RECENT_PARTNERS_MAX, RECENT_PARTNERS_TTL, SESSION_TTL, limit, MATCH_MODE]
+    )
+    return [(int(matched[i]), int(matched[i + 1])) for i in range(0, len(matched), 2)]
+
+async def get_next_deadline() -> float | None:
+    """Ближайший дедлайн ИИ-фоллбека (unix time) или None, если очереди пусты"""
+    head = await redis_client.zrange("queue_deadlines", 0, 0, withscores=True)
+    return head[0][1] if head else None
+
+async def detach_ai_chat(user_id: int):
+    """Убирает юзера из индекса ИИ-чатов (перехватывать его больше нельзя)"""
+    user_id_str = str(user_id)
+    bucket = await redis_client.hget("ai_chat_bucket", user_id_str)
+
+    async with redis_client.pipeline(transaction=True) as pipe:
+        if bucket:
+            pipe.srem(bucket, user_id_str)
+        pipe.srem("ai_chats", user_id_str)
+        pipe.hdel("ai_chat_bucket", user_id_str)
+        await pipe.execute()
+
+async def end_chat(user_id: int) -> tuple[str | None, str | None]:
+    """Закрывает сессию чата целиком (оба указателя, хеш, live_sessions, индекс ИИ-чатов).
+    Возвращает (собеседник, sid) — sid нужен, чтобы оценка была одна на сессию."""
+    partner_id, session_id = await leave_chat_script(
+        redis_client, [f"chat:{user_id}", f"chat_session:{user_id}"], [user_id]
+    )
+    # Локально сбрасываем сразу, не дожидаясь своего же сообщения из pub/sub
+    route_cache.drop(user_id, partner_id)
+    if partner_id and partner_id != "AI" and session_id:
+        # Кто кого может оценить за эту сессию (проверяет app/services/ratings.py)
+        async with redis_client.pipeline(transaction=False) as pipe:
+            pipe.set(f"rateable:{session_id}:{user_id}", partner_id, ex=RATED_TTL)
+            pipe.set(f"rateable:{session_id}:{partner_id}", user_id, ex=RATED_TTL)
+            await pipe.execute()
+    return partner_id, session_id
 
 async def leave_chat(user_id: int):
-    partner_id = await redis_client.get(f"chat:{user_id}")
-    if partner_id:
-        await redis_client.delete(f"chat:{user_id}")
-        if partner_id != "AI":
-            await redis_client.delete(f"chat:{partner_id}")
+    partner_id, _ = await end_chat(user_id)
     return partner_id
 
 async def is_in_chat(user_id: int):
     return await redis_client.get(f"chat:{user_id}")
 
+class SessionTouches:
+    """Сообщения в чатах: счетчики и время последнего сообщения копятся в памяти
+    узла и раз в SESSION_PUSH_SECONDS уходят в Redis пачкой (touch_session_script) —
+    пересылка сообщения не ходит в Redis ради продления сессии. Продление TTL
+    запаздывает не больше чем на SESSION_PUSH_SECONDS, при SESSION_TTL в часы это неважно"""
+
+    def __init__(self):
+        self.pending: dict[int, list] = {}   # id -> [сколько сообщений, время последнего]
+
+    def record(self, user_id: int):
+        entry = self.pending.get(user_id)
+        if entry is None:
+            self.pending[user_id] = [1, time.time()]
+        else:
+            entry[0] += 1
+            entry[1] = time.time()
+
+    async def push(self) -> int:
+        """Отправляет накопленное в Redis. Возвращает число юзеров"""
+        if not self.pending:
+            return 0
+        batch, self.pending = self.pending, {}
+        items = list(batch.items())
+        try:
+            for start in range(0, len(items), SESSION_PUSH_CHUNK):
+                chunk = items[start:start + SESSION_PUSH_CHUNK]
+                args = [SESSION_TTL]
+                for user_id, (count, last) in chunk:
+                    args += [user_id, last, count]
+                await touch_session_script(redis_client, [f"chat_session:{user_id}" for user_id, _ in chunk], args)
+                # Отправленное — из пачки, чтобы при ошибке не посчитать дважды
+                for user_id, _ in chunk:
+                    del batch[user_id]
+        except Exception:
+            # Вернем неотправленное, сложив со свежими отметками
+            for user_id, (count, last) in batch.items():
+                entry = self.pending.setdefault(user_id, [0, last])
+                entry[0] += count
+                entry[1] = max(entry[1], last)
+            raise
+        return len(items)
+
+
+session_touches = SessionTouches()
+
+
+def record_message(user_id: int):
+    """Счетчик сообщений в сессии + продление ее TTL (чат жив, пока в нем пишут)"""
+    session_touches.record(user_id)
+
+
+async def session_touch_pusher():
+    while True:
+        await asyncio.sleep(SESSION_PUSH_SECONDS)
+        try:
+            await session_touches.push()
+        except Exception as e:
+            logging.error(f"Session touch push error: {e}")
+
+async def get_chat_session(user_id: int) -> dict:
+    """Данные текущей сессии юзера (пустой dict, если он не в чате)"""
+    sid = await redis_client.get(f"chat_session:{user_id}")
+    if not sid:
+        return {}
+    session = await redis_client.hgetall(f"session:{sid}")
+    return {"sid": sid, **session} if session else {}
+
+async def count_live_sessions() -> int:
+    return await redis_client.zcard("live_sessions")
+
+async def expire_stale_sessions(limit: int = 500) -> int:
+    """Закрывает сессии без активности дольше SESSION_TTL"""
+    return await expire_sessions_script(
+        redis_client, ["live_sessions"], [time.time() - SESSION_TTL, limit]
+    )
+
 async def remove_from_queue(user_id: int):
     user_id_str = str(user_id)
-    my_queue = await redis_client.get(f"user_queue:{user_id}")
-    
-    if my_queue:
-        await redis_client.lrem(my_queue, 0, user_id_str)
-        await redis_client.delete(f"user_queue:{user_id}")
-        
-    await redis_client.hdel("queue_times", user_id_str)
-    await redis_client.srem("ai_chats", user_id_str)
\ No newline at end of file
+    await remove_from_queue_script(
+        redis_client, [f"user_queue:{user_id_str}", "queue_deadlines"], [user_id_str]
+    )
+    await detach_ai_chat(user_id)
+
+QUEUE_BUCKETS = [f"queue:{g}:{s}" for g in ("M", "F") for s in ("M", "F", "any")]
+
+async def get_queue_stats() -> dict:
+    """Длина каждой очереди и сколько ждет ее дольше всех ожидающий юзер (сек)"""
+    async with redis_client.pipeline(transaction=False) as pipe:
+        for queue in QUEUE_BUCKETS:
+            pipe.zcard(queue)
+            pipe.zrange(queue, 0, 0, withscores=True)
+        replies = await pipe.execute()
+
+    stats = {}
+    head_scores = {}
+    for i, queue in enumerate(QUEUE_BUCKETS):
+        length, head = replies[2 * i], replies[2 * i + 1]
+        stats[queue] = {"length": length, "oldest_wait": 0}
+        if head:
+            head_scores[queue] = head[0][1]
+    if not head_scores:
+        return stats
+
+    # Голова — наименьший приоритет, а у VIP он сдвинут на VIP_QUEUE_BOOST:
+    # дольше всех ждущий лежит не дальше буста от головы, смотрим всех в этом окне
+    async with redis_client.pipeline(transaction=False) as pipe:
+        for queue, score in head_scores.items():
+            pipe.zrangebyscore(queue, score, score + VIP_QUEUE_BOOST)
+        candidates = dict(zip(head_scores, await pipe.execute()))
+
+    # Реальное время входа = дедлайн ИИ-фоллбека минус таймаут
+    members = [member for group in candidates.values() for member in group]
+    deadlines = dict(zip(members, await redis_client.zmscore("queue_deadlines", members)))
+    now = time.time()
+    for queue, group in candidates.items():
+        known = [deadlines[member] for member in group if deadlines[member] is not None]
+        if known:
+            stats[queue]["oldest_wait"] = max(0, int(now - (min(known) - AI_FALLBACK_TIMEOUT)))
+    return stats
+
+async def get_match_quality() -> dict:
+    """Средние показатели пар по режимам подбора: разница в возрасте и рейтинге,
+    ожидание кандидата (цена качества) и сколько юзеров ушло к ИИ"""
+    raw = await redis_client.hgetall("match_quality")
+    report = {}
+    for mode in ("fifo", "scored"):
+        matches = int(raw.get(f"{mode}:matches", 0))
+        fallbacks = int(raw.get(f"{mode}:ai_fallbacks", 0))
+        if not matches and not fallbacks:
+            continue
+        age_pairs = int(raw.get(f"{mode}:age_pairs", 0))
+        report[mode] = {
+            "matches": matches,
+            "rematches": int(raw.get(f"{mode}:rematches", 0)),
+            "ai_fallbacks": fallbacks,
+            "avg_wait": float(raw.get(f"{mode}:wait", 0)) / matches if matches else 0.0,
+            "avg_age_diff": float(raw.get(f"{mode}:age_diff", 0)) / age_pairs if age_pairs else 0.0,
+            "avg_rating_diff": float(raw.get(f"{mode}:rating_diff", 0)) / matches if matches else 0.0,
+        }
+    return report
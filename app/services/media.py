@@ -0,0 +1,242 @@
+# app/services/media.py
+"""Пересылка картинок-файлов с очисткой метаданных без лишних копий в памяти.
+
+Файл скачивается кусками прямо в буфер нужного размера (MediaBuffer: mmap,
+анонимный для небольших файлов и поверх временного файла для больших),
+очищается в том же буфере (app/utils/security.py) и отдается Telegram
+кусками оттуда же (MediaBufferInputFile). Пик памяти на передачу — не больше
+размера файла (для больших — страницы временного файла, которые ОС может
+вытеснить).
+
+Сумма размеров передач узла ограничена MEDIA_INFLIGHT_BYTES: новые ждут
+освобождения (ByteBudget), а не раздувают память при всплеске.
+
+Повторные пересылки того же файла (мемы, скриншоты) не качаются заново:
+sanitized:<file_unique_id> хранит file_id уже очищенной копии (TTL
+MEDIA_CACHE_TTL), sorted set sanitized:lru — время последнего использования,
+по нему выбрасываются самые старые сверх MEDIA_CACHE_SIZE. Попадания, промахи
+и сэкономленные байты — в хеше stats (app/services/stats.py).
+"""
+import asyncio
+import contextlib
+import logging
+import mmap
+import tempfile
+import time
+from typing import AsyncGenerator, AsyncIterator, Awaitable, Callable
+from aiogram import Bot
+from aiogram.exceptions import TelegramBadRequest
+from aiogram.types import Document, Message
+from aiogram.types.input_file import InputFile
+from app.config import MEDIA_INFLIGHT_BYTES, MEDIA_SPOOL_MEMORY, SANITIZE_MAX_BYTES, MEDIA_CACHE_SIZE, MEDIA_CACHE_TTL
+from app.services.matchmaker import redis_client
+from app.utils.security import sanitize_in_place
+
+CACHE_LRU_KEY = "sanitized:lru"
+STATS_KEY = "stats"
+
+
+class ByteBudget:
+    """Лимит байт в работе: reserve() ждет, пока хватит места"""
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.in_flight = 0
+        self.peak = 0
+        self.waiting = 0
+        self.waits = 0            # сколько передач ждали бюджета
+        self.total_wait = 0.0
+        self._cond = asyncio.Condition()
+
+    def snapshot(self) -> dict:
+        return {
+            "in_flight": self.in_flight,
+            "peak": self.peak,
+            "capacity": self.capacity,
+            "waiting": self.waiting,
+            "waits": self.waits,
+            "total_wait": self.total_wait,
+        }
+
+    @contextlib.asynccontextmanager
+    async def reserve(self, nbytes: int) -> AsyncIterator[None]:
+        # Больше бюджета не бывает: такая передача просто идет одна
+        nbytes = min(nbytes, self.capacity)
+        async with self._cond:
+            if self.in_flight + nbytes > self.capacity:
+                self.waits += 1
+                self.waiting += 1
+                started = time.monotonic()
+                try:
+                    await self._cond.wait_for(lambda: self.in_flight + nbytes <= self.capacity)
+                finally:
+                    self.waiting -= 1
+                    self.total_wait += time.monotonic() - started
+            self.in_flight += nbytes
+            self.peak = max(self.peak, self.in_flight)
+        try:
+            yield
+        finally:
+            async with self._cond:
+                self.in_flight -= nbytes
+                self._cond.notify_all()
+
+
+budget = ByteBudget(MEDIA_INFLIGHT_BYTES)
+
+
+class MediaBuffer:
+    """Буфер файла известного размера: пишется как файл (download_file),
+    читается и правится как mmap. До MEDIA_SPOOL_MEMORY — в памяти, больше —
+    поверх временного файла"""
+
+    def __init__(self, size: int):
+        self._file = None
+        if size > MEDIA_SPOOL_MEMORY:
+            self._file = tempfile.TemporaryFile()
+            self._file.truncate(size)
+            self.view = mmap.mmap(self._file.fileno(), size)
+        else:
+            self.view = mmap.mmap(-1, max(size, 1))
+
+    def write(self, chunk: bytes) -> int:
+        if self.view.tell() + len(chunk) > len(self.view):
+            raise ValueError("Downloaded file is larger than declared")
+        return self.view.write(chunk)
+
+    def seek(self, offset: int, whence: int = 0) -> int:
+        return self.view.seek(offset, whence)
+
+    def finish(self):
+        """После скачивания: буфер ровно по скачанному"""
+        written = self.view.tell()
+        if written != len(self.view):
+            self.view.resize(max(written, 1))
+
+    def close(self):
+        self.view.close()
+        if self._file:
+            self._file.close()
+
+
+class MediaBufferInputFile(InputFile):
+    """Отправка из буфера кусками, без копии файла целиком. Читается заново при
+    каждой попытке (повторы после RetryAfter)"""
+
+    def __init__(self, buffer: MediaBuffer, length: int, filename: str | None = None):
+        super().__init__(filename=filename)
+        self.buffer = buffer
+        self.length = length
+
+    async def read(self, bot: Bot) -> AsyncGenerator[bytes, None]:
+        for start in range(0, self.length, self.chunk_size):
+            yield self.buffer.view[start:min(start + self.chunk_size, self.length)]
+
+
+# ==========================================
+# КЭШ ОЧИЩЕННЫХ ФАЙЛОВ
+# ==========================================
+def _cache_key(file_unique_id: str) -> str:
+    return f"sanitized:{file_unique_id}"
+
+
+async def lookup_sanitized(documents: list[Document]) -> list[str | None]:
+    """file_id очищенных копий (None — промах); попадания продлевают жизнь записи"""
+    if not documents:
+        return []
+    async with redis_client.pipeline(transaction=False) as pipe:
+        for doc in documents:
+            pipe.get(_cache_key(doc.file_unique_id))
+        cached = await pipe.execute()
+
+    now = time.time()
+    hits = [doc for doc, file_id in zip(documents, cached) if file_id]
+    async with redis_client.pipeline(transaction=False) as pipe:
+        for doc in hits:
+            pipe.expire(_cache_key(doc.file_unique_id), MEDIA_CACHE_TTL)
+        if hits:
+            pipe.zadd(CACHE_LRU_KEY, {doc.file_unique_id: now for doc in hits})
+            pipe.hincrby(STATS_KEY, "media_cache_hits", len(hits))
+            pipe.hincrby(STATS_KEY, "media_cache_bytes_saved", sum(doc.file_size or 0 for doc in hits))
+        if len(hits) < len(documents):
+            pipe.hincrby(STATS_KEY, "media_cache_misses", len(documents) - len(hits))
+        await pipe.execute()
+    return cached
+
+
+async def remember_sanitized(documents: list[Document], sent: list[Message]):
+    """Запоминает file_id отправленных очищенных копий; сверх MEDIA_CACHE_SIZE
+    выбрасывает давно не использованные"""
+    pairs = {doc.file_unique_id: msg.document.file_id for doc, msg in zip(documents, sent) if msg.document}
+    if not pairs:
+        return
+    now = time.time()
+    async with redis_client.pipeline(transaction=False) as pipe:
+        for file_unique_id, file_id in pairs.items():
+            pipe.set(_cache_key(file_unique_id), file_id, ex=MEDIA_CACHE_TTL)
+        pipe.zadd(CACHE_LRU_KEY, {file_unique_id: now for file_unique_id in pairs})
+        # Записи, истекшие по TTL, из LRU тоже убираем
+        pipe.zremrangebyscore(CACHE_LRU_KEY, "-inf", now - MEDIA_CACHE_TTL)
+        pipe.zcard(CACHE_LRU_KEY)
+        *_, size = await pipe.execute()
+
+    if size > MEDIA_CACHE_SIZE:
+        evicted = [file_unique_id for file_unique_id, _ in await redis_client.zpopmin(CACHE_LRU_KEY, size - MEDIA_CACHE_SIZE)]
+        if evicted:
+            await redis_client.delete(*(_cache_key(file_unique_id) for file_unique_id in evicted))
+
+
+async def forget_sanitized(documents: list[Document]):
+    async with redis_client.pipeline(transaction=False) as pipe:
+        pipe.delete(*(_cache_key(doc.file_unique_id) for doc in documents))
+        pipe.zrem(CACHE_LRU_KEY, *(doc.file_unique_id for doc in documents))
+        await pipe.execute()
+
+
+# ==========================================
+# СКАЧИВАНИЕ, ОЧИСТКА, ОТПРАВКА
+# ==========================================
+@contextlib.asynccontextmanager
+async def sanitized_documents(bot: Bot, documents: list[Document],
+                              use_cache: bool = True) -> AsyncIterator[list[str | MediaBufferInputFile]]:
+    """Очищенные картинки-файлы для отправки: file_id из кэша или скачанный и
+    очищенный файл. Бюджет занимается сразу на все промахи пачки (альбом) — без
+    взаимной блокировки двух альбомов, занявших по половине. Буферы живут до выхода из with"""
+    files: list[str | MediaBufferInputFile | None] = await lookup_sanitized(documents) if use_cache else [None] * len(documents)
+    misses = [i for i, file_id in enumerate(files) if not file_id]
+    sizes = {i: documents[i].file_size or SANITIZE_MAX_BYTES for i in misses}
+    async with budget.reserve(sum(sizes.values())):
+        buffers = []
+        try:
+            for i in misses:
+                doc = documents[i]
+                buffer = MediaBuffer(sizes[i])
+                buffers.append(buffer)
+                file_info = await bot.get_file(doc.file_id)
+                await bot.download_file(file_info.file_path, destination=buffer, seek=False)
+                buffer.finish()
+                length = await sanitize_in_place(buffer.view)
+                files[i] = MediaBufferInputFile(buffer, length, filename=doc.file_name or "safe_image.jpg")
+            yield files
+        finally:
+            for buffer in buffers:
+                buffer.close()
+
+
+async def send_sanitized(bot: Bot, documents: list[Document],
+                         send: Callable[[list], Awaitable[list[Message]]]) -> list[Message]:
+    """Отправка очищенных картинок-файлов: send получает файлы (по порядку documents)
+    и возвращает отправленные сообщения с ними же, по тому же порядку.
+    Если Telegram не принял file_id из кэша — кэш сбрасывается и файлы качаются заново"""
+    for use_cache in (True, False):
+        async with sanitized_documents(bot, documents, use_cache) as files:
+            try:
+                sent = await send(files)
+            except TelegramBadRequest as e:
+                if not use_cache or not any(isinstance(file, str) for file in files):
+                    raise
+                logging.warning(f"Cached sanitized file rejected, re-uploading: {e}")
+                await forget_sanitized(documents)
+                continue
+        await remember_sanitized(documents, sent)
+        return sent
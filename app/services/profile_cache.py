@@ -0,0 +1,165 @@
+# app/services/profile_cache.py
+"""Кэш профилей юзеров перед get_or_create_user.
+
+Держит только поля, которые читают хендлеры: пол, кого ищет, возраст,
+VIP до, ник, рейтинг. Два уровня: локальный LRU с TTL в процессе и хеш
+profile:<id> в Redis (общий для всех узлов, можно выключить).
+Любая запись этих полей в БД обязана вызвать invalidate_profile() после commit —
+он чистит оба уровня и рассылает id остальным узлам через PROFILE_CHANNEL.
+"""
+import asyncio
+import datetime
+import logging
+import time
+from collections import OrderedDict
+from app.config import PROFILE_CACHE_TTL, PROFILE_CACHE_SIZE, PROFILE_CACHE_REDIS, PROFILE_CACHE_REDIS_TTL
+from app.services.matchmaker import redis_client
+
+PROFILE_CHANNEL = "profile_invalidate"
+# Максимум id в одном сообщении инвалидации (id через пробел)
+INVALIDATE_CHUNK = 1000
+
+
+class Profile:
+    __slots__ = ("telegram_id", "gender", "search_gender", "age", "vip_until", "nickname", "rating")
+
+    def __init__(self, telegram_id: int, gender: str | None, search_gender: str | None, age: int | None,
+                 vip_until: datetime.datetime | None, nickname: str | None, rating: float):
+        self.telegram_id = telegram_id
+        self.gender = gender
+        self.search_gender = search_gender
+        self.age = age
+        self.vip_until = vip_until
+        self.nickname = nickname
+        self.rating = rating
+
+    @classmethod
+    def from_user(cls, user) -> "Profile":
+        return cls(user.telegram_id, user.gender, user.search_gender, user.age,
+                   user.vip_until, user.nickname, user.rating)
+
+    @property
+    def is_vip(self) -> bool:
+        return bool(self.vip_until and self.vip_until > datetime.datetime.utcnow())
+
+    def to_redis(self) -> dict:
+        return {
+            "g": self.gender or "", "s": self.search_gender or "", "a": self.age or "",
+            "v": self.vip_until.isoformat() if self.vip_until else "",
+            "n": self.nickname or "", "r": self.rating if self.rating is not None else 5.0,
+        }
+
+    @classmethod
+    def from_redis(cls, telegram_id: int, raw: dict) -> "Profile":
+        return cls(
+            telegram_id, raw["g"] or None, raw["s"] or None, int(raw["a"]) if raw["a"] else None,
+            datetime.datetime.fromisoformat(raw["v"]) if raw["v"] else None,
+            raw["n"] or None, float(raw["r"]),
+        )
+
+
+class ProfileCache:
+    def __init__(self, ttl: float = PROFILE_CACHE_TTL, max_size: int = PROFILE_CACHE_SIZE,
+                 use_redis: bool = PROFILE_CACHE_REDIS):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.use_redis = use_redis
+        self.profiles: OrderedDict[int, tuple[float, Profile]] = OrderedDict()
+        # Промахи в процессе загрузки: True — пока грузили, профиль инвалидировали
+        self._pending: dict[int, bool] = {}
+        self.local_hits = 0
+        self.redis_hits = 0
+        self.misses = 0
+
+    async def get(self, telegram_id: int) -> Profile | None:
+        cached = self.profiles.get(telegram_id)
+        if cached and cached[0] > time.monotonic():
+            self.profiles.move_to_end(telegram_id)
+            self.local_hits += 1
+            return cached[1]
+
+        self._pending[telegram_id] = False
+        if self.use_redis:
+            raw = await redis_client.hgetall(f"profile:{telegram_id}")
+            if raw:
+                self.redis_hits += 1
+                profile = Profile.from_redis(telegram_id, raw)
+                self._store_local(profile)
+                return profile
+        self.misses += 1
+        return None
+
+    async def put(self, profile: Profile):
+        """Кладет загруженный из БД профиль (если его не инвалидировали по дороге)"""
+        if self._pending.get(profile.telegram_id, False):
+            self._pending.pop(profile.telegram_id, None)
+            return
+        if self.use_redis:
+            key = f"profile:{profile.telegram_id}"
+            async with redis_client.pipeline(transaction=True) as pipe:
+                pipe.hset(key, mapping=profile.to_redis())
+                pipe.expire(key, PROFILE_CACHE_REDIS_TTL)
+                await pipe.execute()
+        self._store_local(profile)
+
+    def _store_local(self, profile: Profile):
+        self._pending.pop(profile.telegram_id, None)
+        self.profiles[profile.telegram_id] = (time.monotonic() + self.ttl, profile)
+        self.profiles.move_to_end(profile.telegram_id)
+        while len(self.profiles) > self.max_size:
+            self.profiles.popitem(last=False)
+
+    def drop_local(self, telegram_id: int):
+        self.profiles.pop(telegram_id, None)
+        if telegram_id in self._pending:
+            self._pending[telegram_id] = True
+
+    def stats(self) -> dict:
+        lookups = self.local_hits + self.redis_hits + self.misses
+        return {
+            "size": len(self.profiles),
+            "hit_ratio": (self.local_hits + self.redis_hits) / lookups if lookups else 0.0,
+            "local_hits": self.local_hits,
+            "redis_hits": self.redis_hits,
+            "misses": self.misses,
+        }
+
+
+profile_cache = ProfileCache()
+
+
+async def invalidate_profile(*telegram_ids: int):
+    """Сбросить профили во всех слоях и на всех узлах (вызывать после commit).
+    Любое число id — один pipeline: DEL ключей и PUBLISH id через пробел
+    (пачками по INVALIDATE_CHUNK, чтобы сообщение не разрасталось)"""
+    if not telegram_ids:
+        return
+    for telegram_id in telegram_ids:
+        profile_cache.drop_local(telegram_id)
+    async with redis_client.pipeline(transaction=False) as pipe:
+        for start in range(0, len(telegram_ids), INVALIDATE_CHUNK):
+            chunk = telegram_ids[start:start + INVALIDATE_CHUNK]
+            if profile_cache.use_redis:
+                pipe.delete(*(f"profile:{telegram_id}" for telegram_id in chunk))
+            pipe.publish(PROFILE_CHANNEL, " ".join(str(telegram_id) for telegram_id in chunk))
+        await pipe.execute()
+
+
+async def listen_profile_invalidations():
+    """Сбрасывает локальные профили, измененные на других узлах"""
+    while True:
+        try:
+            async with redis_client.pubsub() as pubsub:
+                await pubsub.subscribe(PROFILE_CHANNEL)
+                # Пока были отписаны, могли пропустить инвалидации
+                profile_cache.profiles.clear()
+                async for message in pubsub.listen():
+                    if message["type"] == "message":
+                        for telegram_id in message["data"].split():
+                            profile_cache.drop_local(int(telegram_id))
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logging.error(f"Profile invalidation listener error: {e}")
+            profile_cache.profiles.clear()
+            await asyncio.sleep(1)
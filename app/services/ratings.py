@@ -0,0 +1,260 @@
+# app/services/ratings.py
+"""Оценки собеседников: буфер в Redis и пакетная запись в PostgreSQL.
+
+Клик по звездам — один атомарный скрипт: проверка и снятие метки
+rateable:<sid>:<кто> (ее ставит end_chat: кого он может оценить за эту
+сессию — ровно один раз) + HINCRBY суммы и числа оценок цели в
+ratings:pending:*. Фоновый rating_flusher (на любом узле, под блокировкой)
+переименовывает буфер в пачку ratings:flushing:<id>:* и применяет ее
+UPDATE ... FROM (VALUES ...) вместе с записью id в rating_batches — пачка
+попадает в БД ровно один раз. Чтение рейтинга складывает сохраненное в БД и еще не сброшенное.
+"""
+import asyncio
+import logging
+import uuid
+from sqlalchemy import text
+from app.config import RATING_FLUSH_SECONDS
+from app.services.matchmaker import redis_client
+from app.services.match_scripts import RedisScript
+from app.services.profile_cache import invalidate_profile
+
+PENDING_SUM, PENDING_COUNT = "ratings:pending:sum", "ratings:pending:count"
+BATCH_KEY, FLUSH_LOCK_KEY = "ratings:batch", "ratings:flush_lock"
+# Блокировка сброса; если узел упал посреди сброса, пачку через это время подхватит другой
+FLUSH_LOCK_MS = 120_000
+# Сколько юзеров обновляем одним UPDATE
+RATING_FLUSH_CHUNK = 500
+
+# KEYS: 1 rateable:<sid>:<rater> (кого он может оценить; пишет end_chat),
+#       2 ratings:pending:sum, 3 ratings:pending:count
+# ARGV: 1 id цели, 2 оценка
+# Ответ: 1 — оценка принята, 0 — такой пары (сессия, цель) нет или уже оценивал
+RATE_LUA = """
+if redis.call('GET', KEYS[1]) ~= ARGV[1] then
+    return 0
+end
+redis.call('DEL', KEYS[1])
+redis.call('HINCRBY', KEYS[2], ARGV[1], ARGV[2])
+redis.call('HINCRBY', KEYS[3], ARGV[1], 1)
+return 1
+"""
+
+
+async def rate_reference(client, keys: list, args: list):
+    rateable_key, sum_key, count_key = keys
+    target, score = (str(a) for a in args)
+    if await client.get(rateable_key) != target:
+        return 0
+    await client.delete(rateable_key)
+    await client.hincrby(sum_key, target, int(score))
+    await client.hincrby(count_key, target, 1)
+    return 1
+
+
+rate_script = RedisScript(RATE_LUA, rate_reference)
+
+# Захват пачки для сброса. Сбрасывает один узел — владелец ratings:flush_lock.
+# Пачка получает id и переезжает в ratings:flushing:<id>:{sum,count}; id
+# лежит в ratings:batch, пока пачка не сброшена (после падения ее досбрасывают
+# с тем же id, а БД по таблице rating_batches не даст применить ее дважды).
+# KEYS: 1-2 ratings:pending:{sum,count}, 3 ratings:batch, 4 ratings:flush_lock
+# ARGV: 1 id новой пачки, 2 токен блокировки, 3 TTL блокировки (мс)
+# Ответ: id пачки; "" — сбрасывать нечего; nil — сбрасывает другой узел
+FLUSH_CLAIM_LUA = """
+if not redis.call('SET', KEYS[4], ARGV[2], 'NX', 'PX', ARGV[3]) then
+    return false
+end
+local batch = redis.call('GET', KEYS[3])
+if batch then
+    return batch
+end
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    redis.call('DEL', KEYS[4])
+    return ''
+end
+redis.call('RENAME', KEYS[1], 'ratings:flushing:' .. ARGV[1] .. ':sum')
+if redis.call('EXISTS', KEYS[2]) == 1 then
+    redis.call('RENAME', KEYS[2], 'ratings:flushing:' .. ARGV[1] .. ':count')
+end
+redis.call('SET', KEYS[3], ARGV[1])
+return ARGV[1]
+"""
+
+
+async def flush_claim_reference(client, keys: list, args: list):
+    pending_sum, pending_count, batch_key, lock_key = keys
+    batch_id, token, lock_ms = (str(a) for a in args)
+    if not await client.set(lock_key, token, nx=True, px=int(lock_ms)):
+        return None
+    batch = await client.get(batch_key)
+    if batch:
+        return batch
+    if not await client.exists(pending_sum):
+        await client.delete(lock_key)
+        return ""
+    await client.rename(pending_sum, f"ratings:flushing:{batch_id}:sum")
+    if await client.exists(pending_count):
+        await client.rename(pending_count, f"ratings:flushing:{batch_id}:count")
+    await client.set(batch_key, batch_id)
+    return batch_id
+
+
+flush_claim_script = RedisScript(FLUSH_CLAIM_LUA, flush_claim_reference)
+
+# Конец сброса: ARGV[3] == "1" — пачка в БД, ее ключи удаляются; в любом
+# случае снимаем свою блокировку (чужую, взятую после истечения TTL, не трогаем)
+# KEYS: 1 ratings:batch, 2 ratings:flush_lock
+# ARGV: 1 id пачки, 2 токен блокировки, 3 "1" | "0"
+FLUSH_FINISH_LUA = """
+if ARGV[3] == '1' and redis.call('GET', KEYS[1]) == ARGV[1] then
+    redis.call('DEL', 'ratings:flushing:' .. ARGV[1] .. ':sum', 'ratings:flushing:' .. ARGV[1] .. ':count')
+    redis.call('DEL', KEYS[1])
+end
+if redis.call('GET', KEYS[2]) == ARGV[2] then
+    redis.call('DEL', KEYS[2])
+end
+return 1
+"""
+
+
+async def flush_finish_reference(client, keys: list, args: list):
+    batch_key, lock_key = keys
+    batch_id, token, done = (str(a) for a in args)
+    if done == "1" and await client.get(batch_key) == batch_id:
+        await client.delete(f"ratings:flushing:{batch_id}:sum", f"ratings:flushing:{batch_id}:count")
+        await client.delete(batch_key)
+    if await client.get(lock_key) == token:
+        await client.delete(lock_key)
+    return 1
+
+
+flush_finish_script = RedisScript(FLUSH_FINISH_LUA, flush_finish_reference)
+
+# Несброшенные оценки юзера: буфер + пачка в процессе сброса
+# KEYS: 1-2 ratings:pending:{sum,count}, 3 ratings:batch
+# ARGV: 1 id юзера
+PENDING_LUA = """
+local result = {redis.call('HGET', KEYS[1], ARGV[1]), redis.call('HGET', KEYS[2], ARGV[1]), false, false}
+local batch = redis.call('GET', KEYS[3])
+if batch then
+    result[3] = redis.call('HGET', 'ratings:flushing:' .. batch .. ':sum', ARGV[1])
+    result[4] = redis.call('HGET', 'ratings:flushing:' .. batch .. ':count', ARGV[1])
+end
+return result
+"""
+
+
+async def pending_reference(client, keys: list, args: list):
+    pending_sum, pending_count, batch_key = keys
+    user_id = str(args[0])
+    result = [await client.hget(pending_sum, user_id), await client.hget(pending_count, user_id), None, None]
+    batch = await client.get(batch_key)
+    if batch:
+        result[2] = await client.hget(f"ratings:flushing:{batch}:sum", user_id)
+        result[3] = await client.hget(f"ratings:flushing:{batch}:count", user_id)
+    return result
+
+
+pending_script = RedisScript(PENDING_LUA, pending_reference)
+
+
+async def submit_rating(rater_id: int, target_id: int, score: int, session_id: str) -> bool:
+    """Буферизует оценку; False — rater не был в сессии session_id с target_id,
+    окно оценки истекло или оценка уже была"""
+    accepted = await rate_script(
+        redis_client, [f"rateable:{session_id}:{rater_id}", PENDING_SUM, PENDING_COUNT],
+        [target_id, score]
+    )
+    return bool(accepted)
+
+
+async def get_pending_rating(user_id: int) -> tuple[int, int]:
+    """(сумма, количество) оценок, еще не записанных в БД"""
+    pending_sum, pending_count, flushing_sum, flushing_count = await pending_script(
+        redis_client, [PENDING_SUM, PENDING_COUNT, BATCH_KEY], [user_id]
+    )
+    return (
+        int(pending_sum or 0) + int(flushing_sum or 0),
+        int(pending_count or 0) + int(flushing_count or 0),
+    )
+
+
+def merge_rating(rating: float, rating_count: int, pending_sum: int, pending_count: int) -> float:
+    """Средний рейтинг с учетом буфера (та же формула, что и при сбросе в БД)"""
+    if not pending_count:
+        return rating
+    return round((rating * rating_count + pending_sum) / (rating_count + pending_count), 2)
+
+
+async def apply_rating_batch(session, batch: list[tuple[int, int, int]]):
+    """Один UPDATE на пачку (telegram_id, сумма, количество)"""
+    values = ", ".join(
+        f"(CAST(:id{i} AS BIGINT), CAST(:total{i} AS INTEGER), CAST(:cnt{i} AS INTEGER))"
+        for i in range(len(batch))
+    )
+    params = {}
+    for i, (telegram_id, total, cnt) in enumerate(batch):
+        params.update({f"id{i}": telegram_id, f"total{i}": total, f"cnt{i}": cnt})
+    await session.execute(text(f"""
+        UPDATE users SET
+            rating = ROUND(CAST((users.rating * users.rating_count + v.total)
+                                / (users.rating_count + v.cnt) AS NUMERIC), 2),
+            rating_count = users.rating_count + v.cnt
+        FROM (VALUES {values}) AS v(id, total, cnt)
+        WHERE users.telegram_id = v.id
+    """), params)
+
+
+async def flush_ratings(session_pool) -> int:
+    """Переносит буфер оценок в БД. Возвращает число обновленных юзеров"""
+    token = uuid.uuid4().hex
+    batch_id = await flush_claim_script(
+        redis_client, [PENDING_SUM, PENDING_COUNT, BATCH_KEY, FLUSH_LOCK_KEY],
+        [uuid.uuid4().hex, token, FLUSH_LOCK_MS]
+    )
+    if not batch_id:
+        # Нечего сбрасывать или сбрасывает другой узел
+        return 0
+
+    applied = False
+    try:
+        async with redis_client.pipeline(transaction=False) as pipe:
+            pipe.hgetall(f"ratings:flushing:{batch_id}:sum")
+            pipe.hgetall(f"ratings:flushing:{batch_id}:count")
+            sums, counts = await pipe.execute()
+        batch = [(int(user_id), int(total), int(counts.get(user_id, 0))) for user_id, total in sums.items()]
+        batch = [row for row in batch if row[2]]
+
+        async with session_pool() as session:
+            # id пачки пишется в той же транзакции: пачку, уже примененную до
+            # падения (commit прошел, удалить ключи из Redis не успели), пропускаем
+            fresh = await session.scalar(text(
+                "INSERT INTO rating_batches (batch_id) VALUES (:id) ON CONFLICT DO NOTHING RETURNING batch_id"
+            ), {"id": batch_id})
+            if fresh:
+                for i in range(0, len(batch), RATING_FLUSH_CHUNK):
+                    await apply_rating_batch(session, batch[i:i + RATING_FLUSH_CHUNK])
+            await session.execute(text(
+                "DELETE FROM rating_batches WHERE applied_at < (now() AT TIME ZONE 'utc') - interval '7 days'"
+            ))
+            await session.commit()
+        applied = True
+    finally:
+        # После commit и до удаления пачки чтение видит оценки дважды — окно в один round-trip
+        await flush_finish_script(redis_client, [BATCH_KEY, FLUSH_LOCK_KEY], [batch_id, token, int(applied)])
+
+    await invalidate_profile(*(telegram_id for telegram_id, _, _ in batch))
+    return len(batch) if fresh else 0
+
+
+async def rating_flusher(session_pool):
+    while True:
+        await asyncio.sleep(RATING_FLUSH_SECONDS)
+        try:
+            flushed = await flush_ratings(session_pool)
+            if flushed:
+                logging.info(f"Flushed ratings for {flushed} users")
+        except Exception as e:
+            # Пачка остается в ratings:flushing:<id>:* и будет досброшена с тем же id
+            # (если commit все же прошел — rating_batches не даст применить ее повторно)
+            logging.error(f"Rating flush error: {e}")
@@ -0,0 +1,115 @@
+# app/services/reachability.py
+"""Доступность юзеров: кто заблокировал бота.
+
+Sorted set unreachable (id -> unix time, когда Telegram ответил Forbidden) —
+быстрая проверка для матчмейкера (прямо в Lua-скриптах) и статистики.
+Флаг ставит ReachabilityMiddleware на любом вызове API, снимает /start.
+В users.unreachable_since изменения попадают пакетно: id копятся в
+unreachable:dirty, reachability_flusher пишет текущее значение из Redis.
+"""
+import asyncio
+import datetime
+import logging
+import time
+from sqlalchemy import select, text
+from app.config import REACHABILITY_FLUSH_SECONDS
+from app.database.models import User
+from app.services.matchmaker import redis_client, remove_from_queue
+
+UNREACHABLE_KEY = "unreachable"
+DIRTY_KEY = "unreachable:dirty"
+# Сколько юзеров обновляем одним UPDATE
+FLUSH_CHUNK = 500
+
+
+async def mark_unreachable(user_id: int):
+    """Telegram ответил Forbidden: больше не подбираем юзера и не шлем рассылки"""
+    if await redis_client.zadd(UNREACHABLE_KEY, {user_id: time.time()}, nx=True):
+        await redis_client.sadd(DIRTY_KEY, user_id)
+        # Из очереди — сразу, чтобы его не выдали кому-то в пару
+        await remove_from_queue(user_id)
+        logging.info(f"User {user_id} marked unreachable")
+
+
+async def mark_reachable(user_id: int):
+    """Юзер снова написал боту (/start)"""
+    if await redis_client.zrem(UNREACHABLE_KEY, user_id):
+        await redis_client.sadd(DIRTY_KEY, user_id)
+
+
+async def is_unreachable(user_id: int) -> bool:
+    return await redis_client.zscore(UNREACHABLE_KEY, user_id) is not None
+
+
+async def count_unreachable() -> int:
+    return await redis_client.zcard(UNREACHABLE_KEY)
+
+
+async def flush_reachability(session_pool) -> int:
+    """Пишет флаги измененных юзеров в БД. Возвращает число обновленных"""
+    flushed = 0
+    while user_ids := await redis_client.spop(DIRTY_KEY, FLUSH_CHUNK):
+        since = await redis_client.zmscore(UNREACHABLE_KEY, user_ids)
+        # Флага нет, но id уже снова в dirty — состояние меняется прямо сейчас
+        # (например, бутстрап другого узла): NULL не пишем, запишет следующий сброс
+        cleared = [user_id for user_id, ts in zip(user_ids, since) if ts is None]
+        if cleared:
+            redirtied = {
+                user_id for user_id, dirty in zip(cleared, await redis_client.smismember(DIRTY_KEY, cleared)) if dirty
+            }
+            if redirtied:
+                pairs = [(user_id, ts) for user_id, ts in zip(user_ids, since) if user_id not in redirtied]
+                if not pairs:
+                    # Вся пачка снова в dirty — не крутимся, остальное в следующий раз
+                    break
+                user_ids, since = [user_id for user_id, _ in pairs], [ts for _, ts in pairs]
+        values = ", ".join(
+            f"(CAST(:id{i} AS BIGINT), CAST(:since{i} AS TIMESTAMP))" for i in range(len(user_ids))
+        )
+        params = {}
+        for i, (user_id, ts) in enumerate(zip(user_ids, since)):
+            params[f"id{i}"] = int(user_id)
+            params[f"since{i}"] = datetime.datetime.utcfromtimestamp(ts) if ts is not None else None
+        try:
+            async with session_pool() as session:
+                await session.execute(text(f"""
+                    UPDATE users SET unreachable_since = v.since
+                    FROM (VALUES {values}) AS v(id, since)
+                    WHERE users.telegram_id = v.id
+                """), params)
+                await session.commit()
+        except Exception:
+            # Вернем пачку, чтобы записать в следующий раз
+            await redis_client.sadd(DIRTY_KEY, *user_ids)
+            raise
+        flushed += len(user_ids)
+    return flushed
+
+
+async def bootstrap_reachability(session_pool):
+    """При старте: досбрасываем накопленное и досыпаем в set флаги из БД.
+    Set не пересоздается: другие узлы (rolling restart) могли отметить кого-то
+    уже после нашего сброса — DEL стер бы эти отметки. Юзеры с еще не
+    сброшенными изменениями (в dirty) остаются как есть: их состояние новее БД"""
+    await flush_reachability(session_pool)
+    async with session_pool() as session:
+        rows = (await session.execute(
+            select(User.telegram_id, User.unreachable_since).where(User.unreachable_since.is_not(None))
+        )).all()
+    dirty = await redis_client.smembers(DIRTY_KEY)
+    flags = {
+        telegram_id: since.replace(tzinfo=datetime.timezone.utc).timestamp()
+        for telegram_id, since in rows if str(telegram_id) not in dirty
+    }
+    if flags:
+        await redis_client.zadd(UNREACHABLE_KEY, flags, nx=True)
+    logging.info(f"Reachability loaded: {len(rows)} unreachable users")
+
+
+async def reachability_flusher(session_pool):
+    while True:
+        await asyncio.sleep(REACHABILITY_FLUSH_SECONDS)
+        try:
+            await flush_reachability(session_pool)
+        except Exception as e:
+            logging.error(f"Reachability flush error: {e}")
@@ -0,0 +1,128 @@
+# app/services/route_cache.py
+"""Локальный кэш маршрутов для пересылки сообщений (route_message).
+
+Запись route_cache[user_id] означает: юзер в чате с partner_id, его FSM-стейт
+in_chat, имя в чате — display_name. Пока запись жива, пересылка не читает Redis.
+
+Инвалидация — через канал ROUTE_CHANNEL: скрипты сессий публикуют id участников
+при открытии/закрытии чата, а хранилище FSM — при выходе из стейта in_chat.
+Каждый узел слушает канал и выбрасывает записи; TTL — страховка на случай
+потерянного сообщения pub/sub.
+"""
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import StorageKey
+from aiogram.fsm.storage.redis import RedisStorage
+from app.config import ROUTE_CACHE_TTL, ROUTE_CACHE_SIZE
+from app.utils.states import ChatState
+
+ROUTE_CHANNEL = "route_invalidate"
+
+
+class Route:
+    __slots__ = ("partner_id", "display_name", "expires")
+
+    def __init__(self, partner_id: str, display_name: str, expires: float):
+        self.partner_id = partner_id
+        self.display_name = display_name
+        self.expires = expires
+
+
+class RouteCache:
+    def __init__(self, ttl: float = ROUTE_CACHE_TTL, max_size: int = ROUTE_CACHE_SIZE):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.routes: OrderedDict[int, Route] = OrderedDict()
+        # Промахи, которые сейчас читают Redis: True — пока читали, пришла инвалидация
+        self._pending: dict[int, bool] = {}
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def get(self, user_id: int) -> Route | None:
+        route = self.routes.get(user_id)
+        if route and route.expires > time.monotonic():
+            self.hits += 1
+            return route
+        if route:
+            del self.routes[user_id]
+        self.misses += 1
+        return None
+
+    def begin(self, user_id: int):
+        """Вызывается ДО чтения маршрута из Redis (см. put)"""
+        self._pending[user_id] = False
+
+    def put(self, user_id: int, partner_id: str, display_name: str):
+        # Инвалидация между чтением и записью — значит, прочитанное уже устарело
+        if self._pending.pop(user_id, True):
+            return
+        self.routes[user_id] = Route(partner_id, display_name, time.monotonic() + self.ttl)
+        self.routes.move_to_end(user_id)
+        while len(self.routes) > self.max_size:
+            self.routes.popitem(last=False)
+
+    def abort(self, user_id: int):
+        """Промах без результата (юзер не в чате) — кэшировать нечего"""
+        self._pending.pop(user_id, None)
+
+    def drop(self, *user_ids):
+        for user_id in user_ids:
+            try:
+                user_id = int(user_id)
+            except (TypeError, ValueError):
+                continue  # "AI"
+            self.invalidations += 1
+            self.routes.pop(user_id, None)
+            if user_id in self._pending:
+                self._pending[user_id] = True
+
+    def clear(self):
+        self.routes.clear()
+        for user_id in self._pending:
+            self._pending[user_id] = True
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self.routes),
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+            "invalidations": self.invalidations,
+        }
+
+
+route_cache = RouteCache()
+
+
+async def listen_route_invalidations(client):
+    """Слушает ROUTE_CHANNEL и выбрасывает маршруты, которые изменились на любом узле"""
+    while True:
+        try:
+            async with client.pubsub() as pubsub:
+                await pubsub.subscribe(ROUTE_CHANNEL)
+                # Пока были отписаны, могли пропустить инвалидации
+                route_cache.clear()
+                async for message in pubsub.listen():
+                    if message["type"] == "message":
+                        route_cache.drop(message["data"])
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logging.error(f"Route invalidation listener error: {e}")
+            route_cache.clear()
+            await asyncio.sleep(1)
+
+
+class RouteAwareRedisStorage(RedisStorage):
+    """FSM-хранилище, которое сбрасывает маршрут юзера при выходе из стейта in_chat
+    (вход в in_chat всегда сопровождается открытием сессии — там своя инвалидация)"""
+
+    async def set_state(self, key: StorageKey, state: State | str | None = None) -> None:
+        await super().set_state(key, state)
+        state_name = state.state if isinstance(state, State) else state
+        if state_name != ChatState.in_chat.state:
+            route_cache.drop(key.user_id)
+            await self.redis.publish(ROUTE_CHANNEL, key.user_id)
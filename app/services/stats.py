@@ -0,0 +1,215 @@
+# app/services/stats.py
+"""Статистика бота: счетчики, которые обновляют сами пути записи.
+
+Хеш stats: users:<пол>, reports, payments, stars, а из Lua-скриптов
+матчмейкера — chats_started/chats_ended/chats_ai, chat_members:<пол>
+и queue_joins:<пол>. Пол — "M", "F" или "?" (еще не выбран).
+Статусы с истечением лежат в sorted set по полу (id -> unix time окончания):
+stats:vip:<пол> и stats:banned:<пол> (вечный бан — score +inf), активные
+считаются ZCOUNT now..+inf — без пересчета при истечении.
+DAU/WAU/MAU — PFCOUNT по дневным HyperLogLog (app/services/activity.py).
+Кэш очищенных файлов (app/services/media.py) пишет в stats
+media_cache_hits/misses/bytes_saved.
+Экран статистики читает все одним pipeline. При старте счетчики из БД
+(юзеры, VIP, баны, жалобы, платежи) пересобираются rebuild_stats,
+счетчики чатов и очередей живут только в Redis.
+"""
+import datetime
+import logging
+import time
+from sqlalchemy import select, func
+from app.database.models import User, Report, Transaction
+from app.services.matchmaker import redis_client
+from app.services.match_scripts import RedisScript
+from app.services.activity import active_keys
+
+STATS_KEY = "stats"
+GENDERS = ("M", "F", "?")
+
+
+def _bucket(gender: str | None) -> str:
+    return gender if gender in ("M", "F") else "?"
+
+
+def _until_ts(until: datetime.datetime | None) -> float:
+    return until.replace(tzinfo=datetime.timezone.utc).timestamp()
+
+
+# Смена пола: переносим юзера между бакетами счетчика и sorted set'ов статусов
+# KEYS: 1 stats
+# ARGV: 1 id, 2 старый бакет, 3 новый бакет
+SET_GENDER_LUA = """
+local uid, old, new = ARGV[1], ARGV[2], ARGV[3]
+if old == new then
+    return 0
+end
+redis.call('HINCRBY', KEYS[1], 'users:' .. old, -1)
+redis.call('HINCRBY', KEYS[1], 'users:' .. new, 1)
+for _, kind in ipairs({'vip', 'banned'}) do
+    local until_ts = redis.call('ZSCORE', 'stats:' .. kind .. ':' .. old, uid)
+    if until_ts then
+        redis.call('ZREM', 'stats:' .. kind .. ':' .. old, uid)
+        redis.call('ZADD', 'stats:' .. kind .. ':' .. new, until_ts, uid)
+    end
+end
+return 1
+"""
+
+
+async def set_gender_reference(client, keys: list, args: list):
+    uid, old, new = (str(a) for a in args)
+    if old == new:
+        return 0
+    await client.hincrby(keys[0], f"users:{old}", -1)
+    await client.hincrby(keys[0], f"users:{new}", 1)
+    for kind in ("vip", "banned"):
+        until_ts = await client.zscore(f"stats:{kind}:{old}", uid)
+        if until_ts is not None:
+            await client.zrem(f"stats:{kind}:{old}", uid)
+            await client.zadd(f"stats:{kind}:{new}", {uid: until_ts})
+    return 1
+
+
+set_gender_script = RedisScript(SET_GENDER_LUA, set_gender_reference)
+
+
+# ==========================================
+# ХУКИ ПУТЕЙ ЗАПИСИ (вызывать после commit)
+# ==========================================
+async def track_user_created():
+    await redis_client.hincrby(STATS_KEY, "users:?", 1)
+
+
+async def track_gender(user_id: int, old_gender: str | None, new_gender: str | None):
+    await set_gender_script(redis_client, [STATS_KEY], [user_id, _bucket(old_gender), _bucket(new_gender)])
+
+
+async def _track_until(kind: str, user_id: int, gender: str | None, until_ts: float | None):
+    key = f"stats:{kind}:{_bucket(gender)}"
+    if until_ts is None:
+        await redis_client.zrem(key, user_id)
+    else:
+        await redis_client.zadd(key, {user_id: until_ts})
+
+
+async def track_vip(user_id: int, gender: str | None, vip_until: datetime.datetime | None):
+    """Выдача/продление/снятие VIP (vip_until=None — снят)"""
+    await _track_until("vip", user_id, gender, _until_ts(vip_until) if vip_until else None)
+
+
+async def track_ban(user_id: int, gender: str | None, ban_until: datetime.datetime | None = None,
+                    permanent: bool = False):
+    """Бан до ban_until, вечный бан (permanent) или разбан (ни того, ни другого)"""
+    until_ts = float("inf") if permanent else _until_ts(ban_until) if ban_until else None
+    await _track_until("banned", user_id, gender, until_ts)
+
+
+async def track_report():
+    await redis_client.hincrby(STATS_KEY, "reports", 1)
+
+
+async def track_payment(amount: int):
+    async with redis_client.pipeline(transaction=True) as pipe:
+        pipe.hincrby(STATS_KEY, "payments", 1)
+        pipe.hincrby(STATS_KEY, "stars", amount)
+        await pipe.execute()
+
+
+# ==========================================
+# ЧТЕНИЕ
+# ==========================================
+async def get_stats() -> dict:
+    """Снимок статистики (один round-trip). Разбивки по полу — словари {пол: число}"""
+    now = time.time()
+    async with redis_client.pipeline(transaction=False) as pipe:
+        pipe.hgetall(STATS_KEY)
+        for kind in ("vip", "banned"):
+            for gender in GENDERS:
+                pipe.zcount(f"stats:{kind}:{gender}", now, "+inf")
+        pipe.zcard("unreachable")
+        # Уникальные активные (HyperLogLog, app/services/activity.py)
+        for days in (1, 7, 30):
+            pipe.pfcount(*active_keys(days))
+        raw, *active, unreachable, dau, wau, mau = await pipe.execute()
+
+    counters = {field: int(value) for field, value in raw.items()}
+
+    def by_gender(prefix: str) -> dict:
+        return {gender: counters.get(f"{prefix}:{gender}", 0) for gender in GENDERS}
+
+    users = by_gender("users")
+    vip = dict(zip(GENDERS, active[:len(GENDERS)]))
+    banned = dict(zip(GENDERS, active[len(GENDERS):]))
+    queue_joins = by_gender("queue_joins")
+    return {
+        "users": sum(users.values()), "users_by_gender": users,
+        "vip": sum(vip.values()), "vip_by_gender": vip,
+        "banned": sum(banned.values()), "banned_by_gender": banned,
+        "unreachable": unreachable,
+        "dau": dau, "wau": wau, "mau": mau,
+        "reports": counters.get("reports", 0),
+        "payments": counters.get("payments", 0),
+        "stars": counters.get("stars", 0),
+        "chats_started": counters.get("chats_started", 0),
+        "chats_ended": counters.get("chats_ended", 0),
+        "chats_ai": counters.get("chats_ai", 0),
+        "chat_members_by_gender": by_gender("chat_members"),
+        "queue_joins": sum(queue_joins.values()), "queue_joins_by_gender": queue_joins,
+        "media_cache_hits": counters.get("media_cache_hits", 0),
+        "media_cache_misses": counters.get("media_cache_misses", 0),
+        "media_cache_bytes_saved": counters.get("media_cache_bytes_saved", 0),
+    }
+
+
+# ==========================================
+# ПЕРЕСБОРКА ИЗ БД (при старте)
+# ==========================================
+async def rebuild_stats(session):
+    """Пересчитывает счетчики, источник правды для которых — БД.
+    Запись, прошедшая на другом узле между SELECT и записью в Redis, будет
+    потеряна до следующего рестарта — допустимо для статистики."""
+    now = datetime.datetime.utcnow()
+    users = {gender: 0 for gender in GENDERS}
+    for gender, count in await session.execute(select(User.gender, func.count()).group_by(User.gender)):
+        users[_bucket(gender)] += count
+
+    vip = {gender: {} for gender in GENDERS}
+    for telegram_id, gender, vip_until in await session.execute(
+        select(User.telegram_id, User.gender, User.vip_until).where(User.vip_until > now)
+    ):
+        vip[_bucket(gender)][telegram_id] = _until_ts(vip_until)
+
+    banned = {gender: {} for gender in GENDERS}
+    for telegram_id, gender, is_banned, ban_until in await session.execute(
+        select(User.telegram_id, User.gender, User.is_banned, User.ban_until)
+        .where((User.is_banned == True) | (User.ban_until > now))  # noqa: E712
+    ):
+        banned[_bucket(gender)][telegram_id] = float("inf") if is_banned else _until_ts(ban_until)
+
+    reports = await session.scalar(select(func.count(Report.id)))
+    payments, stars = (await session.execute(
+        select(func.count(Transaction.id), func.coalesce(func.sum(Transaction.amount), 0))
+    )).one()
+
+    async with redis_client.pipeline(transaction=True) as pipe:
+        pipe.hset(STATS_KEY, mapping={
+            **{f"users:{gender}": count for gender, count in users.items()},
+            "reports": reports, "payments": payments, "stars": stars,
+        })
+        for kind, buckets in (("vip", vip), ("banned", banned)):
+            for gender, members in buckets.items():
+                pipe.delete(f"stats:{kind}:{gender}")
+                if members:
+                    pipe.zadd(f"stats:{kind}:{gender}", members)
+        await pipe.execute()
+    logging.info(f"Stats rebuilt: {sum(users.values())} users, {reports} reports, {payments} payments")
+
+
+async def cleanup_expired():
+    """Чистит истекшие VIP/баны из sorted set'ов (на подсчет не влияет — только память)"""
+    now = time.time()
+    async with redis_client.pipeline(transaction=False) as pipe:
+        for kind in ("vip", "banned"):
+            for gender in GENDERS:
+                pipe.zremrangebyscore(f"stats:{kind}:{gender}", "-inf", now)
+        await pipe.execute()
@@ -0,0 +1,76 @@
+# app/utils/rate_limit.py
+import asyncio
+import heapq
+import itertools
+import time
+
+
+class TokenBucket:
+    """Токен-бакет: в среднем rate действий в секунду, всплеск — до capacity.
+
+    acquire() ждет токен; ожидающие обслуживаются по приоритету (меньше — раньше),
+    при равном приоритете — по очереди (FIFO).
+    pause() останавливает всех на время (RetryAfter от Telegram).
+    """
+
+    def __init__(self, rate: float, capacity: float | None = None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self._cond = asyncio.Condition()
+        self._waiters: list[list] = []  # куча [приоритет, номер]
+        self._seq = itertools.count()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    @property
+    def waiting(self) -> int:
+        return len(self._waiters)
+
+    def idle(self) -> bool:
+        """Никто не ждет и бакет снова полон — его можно выбросить"""
+        if self._waiters or time.monotonic() < self.blocked_until:
+            return False
+        self._refill(time.monotonic())
+        return self.tokens >= self.capacity
+
+    async def acquire(self, tokens: float = 1, priority: int = 0):
+        # Больше capacity бакет не накопит никогда
+        tokens = min(tokens, self.capacity)
+        entry = [priority, next(self._seq)]
+        async with self._cond:
+            heapq.heappush(self._waiters, entry)
+            # Новый ожидающий мог обогнать текущего первого — пусть пересчитает
+            self._cond.notify_all()
+            try:
+                while True:
+                    delay = None
+                    if self._waiters[0] is entry:
+                        now = time.monotonic()
+                        if now < self.blocked_until:
+                            delay = self.blocked_until - now
+                        else:
+                            self._refill(now)
+                            if self.tokens >= tokens:
+                                self.tokens -= tokens
+                                return
+                            delay = (tokens - self.tokens) / self.rate
+                    try:
+                        await asyncio.wait_for(self._cond.wait(), delay)
+                    except asyncio.TimeoutError:
+                        pass
+            finally:
+                self._waiters.remove(entry)
+                heapq.heapify(self._waiters)
+                self._cond.notify_all()
+
+    def pause(self, seconds: float):
+        now = time.monotonic()
+        self.blocked_until = max(self.blocked_until, now + seconds)
+        # После паузы начинаем с пустого бакета, без всплеска
+        self.tokens = 0
+        self.updated = max(self.updated, self.blocked_until)
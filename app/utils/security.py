@@ -1,25 +1,360 @@
 # app/utils/security.py
+"""Удаление метаданных (EXIF, GPS, XMP, ICC, комментарии) из картинок.
+
+JPEG, PNG и WebP чистятся без декодирования пикселей: файл разбирается на
+сегменты/чанки контейнера, служебные выбрасываются, данные изображения
+копируются байт в байт (без потери качества, память — пара размеров файла).
+У JPEG сохраняется только ориентация из EXIF, чтобы фото не легло на бок.
+Остальные форматы (и битые файлы) пересохраняются через Pillow.
+
+sanitize_in_place() выполняет это в отдельном пуле потоков (разбор — срезы
+байтов и memmove, Pillow отпускает GIL), не блокируя event loop, прямо в
+буфере, куда скачан файл (app/services/media.py).
+"""
+import asyncio
 import io
 import logging
-from PIL import Image
+import mmap
+import time
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image, ImageOps
+from app.config import SANITIZE_MAX_PIXELS, SANITIZE_WORKERS
 
-def strip_exif_data(image_bytes: bytes) -> bytes:
-    """Удаляет EXIF-метаданные из байтов изображения."""
-    try:
-        image = Image.open(io.BytesIO(image_bytes))
-        
-        # Пересохраняем изображение без EXIF (получая только пиксели)
-        data = list(image.getdata())
-        image_without_exif = Image.new(image.mode, image.size)
-        image_without_exif.putdata(data)
-        
+# Дольше — пишем в лог
+SLOW_SANITIZE_SECONDS = 1.0
+
+# ==========================================
+# JPEG
+# ==========================================
+JPEG_SOI, JPEG_EOI, JPEG_SOS = 0xD8, 0xD9, 0xDA
+# APP1-APP13, APP15 (EXIF, XMP, ICC, Photoshop/IPTC, MPF...) и комментарии.
+# APP0 (JFIF) и APP14 (Adobe — нужен для цветов CMYK) оставляем
+JPEG_DROP = set(range(0xE1, 0xEE)) | {0xEF, 0xFE}
+EXIF_HEADER = b"Exif\x00\x00"
+ORIENTATION_TAG = 0x0112
+
+
+def _exif_orientation(payload: bytes) -> int | None:
+    """Ориентация (1-8) из TIFF-структуры EXIF (payload — после "Exif\\0\\0")"""
+    order = {b"II": "little", b"MM": "big"}.get(payload[:2])
+    if order is None or len(payload) < 8:
+        return None
+    ifd = int.from_bytes(payload[4:8], order)
+    count = int.from_bytes(payload[ifd:ifd + 2], order)
+    for entry in range(ifd + 2, min(ifd + 2 + count * 12, len(payload) - 11), 12):
+        if int.from_bytes(payload[entry:entry + 2], order) == ORIENTATION_TAG:
+            value = int.from_bytes(payload[entry + 8:entry + 10], order)
+            return value if 1 <= value <= 8 else None
+    return None
+
+
+def _orientation_segment(orientation: int) -> bytes:
+    """Минимальный APP1: EXIF с единственным тегом Orientation"""
+    payload = (
+        EXIF_HEADER + b"MM\x00\x2a" + (8).to_bytes(4, "big")
+        + (1).to_bytes(2, "big")
+        + ORIENTATION_TAG.to_bytes(2, "big") + (3).to_bytes(2, "big") + (1).to_bytes(4, "big")
+        + orientation.to_bytes(2, "big") + b"\x00\x00"
+        + (0).to_bytes(4, "big")
+    )
+    return b"\xff\xe1" + (len(payload) + 2).to_bytes(2, "big") + payload
+
+
+def _plan_jpeg(data) -> list:
+    plan = [(0, 2)]
+    orientation_done = False
+    pos, size = 2, len(data)
+    while True:
+        if pos + 1 >= size or data[pos] != 0xFF:
+            raise ValueError(f"JPEG: no marker at {pos}")
+        while data[pos + 1] == 0xFF:  # байты-заполнители
+            pos += 1
+            if pos + 1 >= size:
+                raise ValueError("JPEG: no EOI")
+        marker_start, marker = pos, data[pos + 1]
+        pos += 2
+        if marker == JPEG_EOI:
+            # Все, что после EOI (хвосты телефонов, миниатюры MPF), отбрасываем
+            plan.append((marker_start, pos))
+            return plan
+        if 0xD0 <= marker <= 0xD7 or marker == 0x01:
+            plan.append((marker_start, pos))
+            continue
+
+        length = int.from_bytes(data[pos:pos + 2], "big")
+        if length < 2 or pos + length > size:
+            raise ValueError("JPEG: truncated segment")
+        payload_start, pos = pos + 2, pos + length
+
+        if marker == 0xE1 and not orientation_done and data[payload_start:payload_start + 6] == EXIF_HEADER:
+            orientation_done = True
+            orientation = _exif_orientation(data[payload_start + 6:pos])
+            if orientation and orientation != 1:
+                # На место EXIF — минимальный EXIF с одной ориентацией. Исходный EXIF
+                # бывает и короче (от 32 байт): тогда вставка не влезет на его место
+                # в том же буфере — такой файл пересохраняем
+                segment = _orientation_segment(orientation)
+                if pos - marker_start < len(segment):
+                    raise ValueError("JPEG: EXIF shorter than orientation segment")
+                plan.append(segment)
+            continue
+        if marker in JPEG_DROP or (marker == 0xE0 and data[payload_start:payload_start + 5] != b"JFIF\x00"):
+            # APP0 без JFIF — JFXX с миниатюрой
+            continue
+        plan.append((marker_start, pos))
+
+        if marker == JPEG_SOS:
+            # Сжатые данные: до следующего настоящего маркера
+            # (FF00 — экранированный байт, FFD0-FFD7 — рестарты, FFFF — заполнитель)
+            scan_start = pos
+            while True:
+                pos = data.find(b"\xff", pos)
+                if pos < 0 or pos + 1 >= size:
+                    raise ValueError("JPEG: no EOI")
+                following = data[pos + 1]
+                if following == 0x00 or 0xD0 <= following <= 0xD7:
+                    pos += 2
+                    continue
+                break
+            plan.append((scan_start, pos))
+
+
+# ==========================================
+# PNG
+# ==========================================
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+# Критические чанки + вспомогательные, влияющие на отображение (и APNG).
+# tEXt/zTXt/iTXt/eXIf/iCCP/tIME и неизвестные вспомогательные выбрасываем
+PNG_KEEP = {b"IHDR", b"PLTE", b"IDAT", b"IEND", b"tRNS", b"gAMA", b"cHRM", b"sRGB",
+            b"sBIT", b"bKGD", b"pHYs", b"acTL", b"fcTL", b"fdAT"}
+
+
+def _plan_png(data) -> list:
+    plan = [(0, len(PNG_SIGNATURE))]
+    pos, size = len(PNG_SIGNATURE), len(data)
+    while True:
+        if pos + 12 > size:
+            raise ValueError("PNG: no IEND")
+        length = int.from_bytes(data[pos:pos + 4], "big")
+        chunk_type = data[pos + 4:pos + 8]
+        end = pos + 12 + length
+        if end > size:
+            raise ValueError("PNG: truncated chunk")
+        # Критический чанк (заглавная первая буква) без него файл не прочитать
+        if chunk_type in PNG_KEEP or chunk_type[:1].isupper():
+            plan.append((pos, end))  # вместе с CRC
+        pos = end
+        if chunk_type == b"IEND":
+            return plan
+
+
+# ==========================================
+# WebP
+# ==========================================
+WEBP_KEEP = {b"VP8 ", b"VP8L", b"VP8X", b"ALPH", b"ANIM", b"ANMF"}
+# Флаги VP8X: ICC (0x20), EXIF (0x08), XMP (0x04)
+WEBP_META_FLAGS = 0x20 | 0x08 | 0x04
+
+
+def _plan_webp(data) -> list:
+    riff_end = min(len(data), 8 + int.from_bytes(data[4:8], "little"))
+    body, body_size = [], 0
+    pos = 12
+    while pos + 8 <= riff_end:
+        fourcc = data[pos:pos + 4]
+        length = int.from_bytes(data[pos + 4:pos + 8], "little")
+        end = pos + 8 + length + (length & 1)  # чанки выровнены по 2 байта
+        if pos + 8 + length > riff_end:
+            raise ValueError("WebP: truncated chunk")
+        if fourcc == b"VP8X":
+            chunk = bytearray(data[pos:end])
+            chunk[8] &= ~WEBP_META_FLAGS & 0xFF
+            body.append(bytes(chunk))
+        elif fourcc in WEBP_KEEP:
+            body.append((pos, end))
+        else:
+            pos = end
+            continue
+        body_size += end - pos
+        pos = end
+    if not body:
+        raise ValueError("WebP: no image data")
+    return [b"RIFF" + (body_size + 4).to_bytes(4, "little") + b"WEBP"] + body
+
+
+# Формат -> (сигнатура подходит, план очистки)
+PLANNERS = {
+    "jpeg": (lambda d: d[:3] == b"\xff\xd8\xff", _plan_jpeg),
+    "png": (lambda d: d[:8] == PNG_SIGNATURE, _plan_png),
+    "webp": (lambda d: d[:4] == b"RIFF" and d[8:12] == b"WEBP", _plan_webp),
+}
+
+
+def _plan(data) -> tuple[list | None, str]:
+    """План очистки без потерь: куски исходника (start, end) и вставки (bytes).
+    Каждая вставка заменяет не меньший по длине кусок исходника, который лежит
+    не раньше нее, — поэтому план можно записать поверх того же буфера."""
+    for method, (matches, planner) in PLANNERS.items():
+        if matches(data):
+            try:
+                return planner(data), method
+            except (ValueError, IndexError) as e:
+                logging.warning(f"Lossless {method} strip failed, re-encoding: {e}")
+            break
+    return None, "reencode"
+
+
+def _join(data, plan: list) -> bytes:
+    return b"".join(piece if isinstance(piece, bytes) else data[piece[0]:piece[1]] for piece in plan)
+
+
+def _fits_in_place(plan: list) -> bool:
+    """Каждая вставка кончается не дальше начала следующего куска исходника —
+    запись поверх буфера не затрет еще не перенесенные байты"""
+    written = 0
+    for i, piece in enumerate(plan):
+        if isinstance(piece, bytes):
+            written += len(piece)
+            following = next((p[0] for p in plan[i + 1:] if not isinstance(p, bytes)), None)
+            if following is not None and written > following:
+                return False
+        else:
+            if piece[0] < written:
+                return False
+            written += piece[1] - piece[0]
+    return True
+
+
+def _write_in_place(buffer: mmap.mmap, plan: list) -> int:
+    """Записывает план в начало того же буфера (memmove), возвращает новую длину"""
+    written = 0
+    for piece in plan:
+        if isinstance(piece, bytes):
+            buffer[written:written + len(piece)] = piece
+            written += len(piece)
+        else:
+            start, end = piece
+            if start != written:
+                buffer.move(written, start, end - start)
+            written += end - start
+    return written
+
+
+# ==========================================
+# ФОЛЛБЕК: ПЕРЕСОХРАНЕНИЕ
+# ==========================================
+# Ключи Image.info, которые Pillow запишет обратно при сохранении
+PIL_META_KEYS = ("exif", "icc_profile", "xmp", "XML:com.adobe.xmp", "comment", "photoshop", "iptc")
+
+
+def _reencode(data: bytes) -> bytes:
+    with Image.open(io.BytesIO(data)) as image:
+        if image.width * image.height > SANITIZE_MAX_PIXELS:
+            raise ValueError(f"Image too large to re-encode: {image.width}x{image.height}")
+        fmt = image.format or "JPEG"
+        animated = getattr(image, "is_animated", False)
+        # Ориентацию из EXIF применяем к пикселям (у анимаций ее не бывает)
+        clean = image if animated else ImageOps.exif_transpose(image)
+        for key in PIL_META_KEYS:
+            clean.info.pop(key, None)
         output = io.BytesIO()
-        # Сохраняем в оригинальном формате или по дефолту в JPEG
-        fmt = image.format if image.format else 'JPEG'
-        image_without_exif.save(output, format=fmt)
-        
+        if animated:
+            clean.save(output, format=fmt, save_all=True)
+        else:
+            clean.save(output, format=fmt)
         return output.getvalue()
+
+
+def strip_metadata(image_bytes: bytes) -> tuple[bytes, str]:
+    """Удаляет метаданные из байтов изображения. Возвращает (байты, способ)"""
+    plan, method = _plan(image_bytes)
+    if plan is not None:
+        return _join(image_bytes, plan), method
+    try:
+        return _reencode(image_bytes), method
     except Exception as e:
         logging.error(f"Error stripping EXIF: {e}")
         # Если не получилось (например, это вообще не картинка), возвращаем оригинал
-        return image_bytes
\ No newline at end of file
+        return image_bytes, "passthrough"
+
+
+def strip_metadata_in_place(buffer: mmap.mmap) -> tuple[int, str]:
+    """То же поверх буфера целиком (без копии файла). Возвращает (новую длину, способ).
+    Пересохранение (редкий случай) меняет размер буфера через resize"""
+    plan, method = _plan(buffer)
+    if plan is not None and not _fits_in_place(plan):
+        logging.warning(f"Lossless {method} plan does not fit in place, re-encoding")
+        plan, method = None, "reencode"
+    if plan is not None:
+        try:
+            return _write_in_place(buffer, plan), method
+        except Exception as e:
+            logging.error(f"In-place {method} strip failed, re-encoding: {e}")
+            method = "reencode"
+    try:
+        result = _reencode(buffer[:])
+    except Exception as e:
+        logging.error(f"Error stripping EXIF: {e}")
+        return len(buffer), "passthrough"
+    if len(result) != len(buffer):
+        buffer.resize(len(result))
+    buffer[:] = result
+    return len(result), method
+
+
+def strip_exif_data(image_bytes: bytes) -> bytes:
+    """Удаляет EXIF-метаданные из байтов изображения."""
+    return strip_metadata(image_bytes)[0]
+
+
+# ==========================================
+# ВЫПОЛНЕНИЕ ВНЕ EVENT LOOP
+# ==========================================
+class SanitizeMetrics:
+    """Очистка картинок на этом узле: способы, время, объемы"""
+
+    def __init__(self):
+        self.by_method: dict[str, int] = {}
+        self.in_progress = 0      # выполняются + ждут пула
+        self.total_time = 0.0
+        self.max_time = 0.0
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def snapshot(self) -> dict:
+        count = sum(self.by_method.values())
+        return {
+            "count": count,
+            "by_method": dict(self.by_method),
+            "in_progress": self.in_progress,
+            "avg_ms": self.total_time / count * 1000 if count else 0.0,
+            "max_ms": self.max_time * 1000,
+            "bytes_in": self.bytes_in,
+            "bytes_out": self.bytes_out,
+        }
+
+
+metrics = SanitizeMetrics()
+_executor = ThreadPoolExecutor(max_workers=SANITIZE_WORKERS, thread_name_prefix="sanitize")
+
+
+async def sanitize_in_place(buffer: mmap.mmap) -> int:
+    """strip_metadata_in_place в пуле потоков. Возвращает длину очищенного файла.
+    Память ограничивает вызывающий (app/services/media.py)"""
+    size = len(buffer)
+    metrics.in_progress += 1
+    started = time.monotonic()
+    try:
+        length, method = await asyncio.get_running_loop().run_in_executor(_executor, strip_metadata_in_place, buffer)
+    finally:
+        metrics.in_progress -= 1
+
+    elapsed = time.monotonic() - started
+    metrics.by_method[method] = metrics.by_method.get(method, 0) + 1
+    metrics.total_time += elapsed
+    metrics.max_time = max(metrics.max_time, elapsed)
+    metrics.bytes_in += size
+    metrics.bytes_out += length
+    if elapsed > SLOW_SANITIZE_SECONDS:
+        logging.warning(f"Slow image sanitize ({method}): {size} bytes in {elapsed:.2f}s")
+    return length
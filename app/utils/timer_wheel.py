@@ -0,0 +1,73 @@
+# app/utils/timer_wheel.py
+import asyncio
+import logging
+import math
+from typing import Awaitable, Callable
+
+
+class TimerWheel:
+    """Хешированное колесо таймеров для множества коротких отложенных действий.
+
+    Вместо отдельной задачи со sleep() на каждый таймер — один тикер, который
+    раз в `tick` секунд запускает коллбеки из текущего слота. Точность — один тик.
+    """
+
+    def __init__(self, tick: float = 0.25, slots: int = 64):
+        self.tick = tick
+        self.slots: list[list] = [[] for _ in range(slots)]
+        self.position = 0
+        self.pending = 0
+        self._ticker: asyncio.Task | None = None
+        self._tasks: set[asyncio.Task] = set()
+
+    def schedule(self, delay: float, callback: Callable[[], Awaitable]):
+        """Запустить корутину callback() примерно через delay секунд"""
+        ticks = max(1, math.ceil(delay / self.tick))
+        # rounds — сколько полных оборотов колеса нужно пропустить
+        rounds, offset = divmod(ticks, len(self.slots))
+        slot = (self.position + offset) % len(self.slots)
+        if offset == 0:
+            rounds -= 1
+        self.slots[slot].append([rounds, callback])
+        self.pending += 1
+
+        if self._ticker is None or self._ticker.done():
+            self._ticker = asyncio.create_task(self._run())
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        next_tick = loop.time()
+        while self.pending:
+            next_tick += self.tick
+            await asyncio.sleep(max(0.0, next_tick - loop.time()))
+            self.position = (self.position + 1) % len(self.slots)
+
+            due, waiting = [], []
+            for entry in self.slots[self.position]:
+                if entry[0] <= 0:
+                    due.append(entry[1])
+                else:
+                    entry[0] -= 1
+                    waiting.append(entry)
+            self.slots[self.position] = waiting
+
+            for callback in due:
+                self.pending -= 1
+                task = asyncio.create_task(self._fire(callback))
+                self._tasks.add(task)
+                task.add_done_callback(self._tasks.discard)
+
+    @staticmethod
+    async def _fire(callback):
+        try:
+            await callback()
+        except Exception as e:
+            logging.error(f"Timer callback error: {e}")
+
+    def stop(self):
+        if self._ticker:
+            self._ticker.cancel()
+        for task in list(self._tasks):
+            task.cancel()
+        self.slots = [[] for _ in self.slots]
+        self.pending = 0
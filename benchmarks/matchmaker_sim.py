@@ -0,0 +1,354 @@
+# benchmarks/matchmaker_sim.py
+"""Симуляция и бенчмарк матчмейкера на виртуальном времени.
+
+Гоняет настоящие join_queue / leave_chat / remove_from_queue, повторный подбор
+ожидающих и захват просроченных ожиданий (то же, что делает ai_fallback_worker) против
+fakeredis или локального redis-server и печатает отчет:
+время до собеседника (p50/p95/p99), доля ИИ-фоллбеков, Redis round-trip'ов
+на пару, задержка вызова join_queue и "осиротевшие" ключи после симуляции.
+
+Запуск из корня репозитория:
+    python -m benchmarks.matchmaker_sim --users 10000
+    python -m benchmarks.matchmaker_sim --users 100000 --rate 200 --redis-url redis://localhost:6379/15 --flush
+    python -m benchmarks.matchmaker_sim --engine python --mode scored --json
+
+Для fakeredis с Lua нужен пакет lupa (иначе используйте --engine python).
+"""
+import argparse
+import asyncio
+import heapq
+import json
+import random
+import statistics
+import time
+from collections import Counter
+
+import redis.asyncio as redis
+
+import app.services.matchmaker as matchmaker
+from app.services.ai_worker import REMATCH_INTERVAL
+from app.services.match_scripts import RedisScript
+
+
+class VirtualClock:
+    """Подменяет модуль time внутри матчмейкера: время идет по событиям симуляции"""
+
+    def __init__(self):
+        self.now = 1_700_000_000.0
+
+    def time(self) -> float:
+        return self.now
+
+
+class CommandCounter:
+    """Считает round-trip'ы к Redis: одиночные команды и пайплайны (EVALSHA — одна команда)"""
+
+    def __init__(self, client):
+        self.round_trips = 0
+        self.commands = Counter()
+        original_execute = client.execute_command
+        original_pipeline = client.pipeline
+
+        async def execute_command(*args, **kwargs):
+            self.round_trips += 1
+            self.commands[str(args[0]).upper()] += 1
+            return await original_execute(*args, **kwargs)
+
+        def pipeline(*args, **kwargs):
+            pipe = original_pipeline(*args, **kwargs)
+            original_pipe_execute = pipe.execute
+
+            async def execute(*a, **kw):
+                self.round_trips += 1
+                self.commands["PIPELINE"] += 1
+                return await original_pipe_execute(*a, **kw)
+
+            pipe.execute = execute
+            return pipe
+
+        client.execute_command = execute_command
+        client.pipeline = pipeline
+
+
+def percentile(values: list, q: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q / 100 * len(ordered)))]
+
+
+class Simulation:
+    def __init__(self, args, client):
+        self.args = args
+        self.client = client
+        self.clock = VirtualClock()
+        self.rng = random.Random(args.seed)
+        self.events = []
+        self.seq = 0
+
+        self.state = {}        # user_id -> idle | searching | chat | ai | done
+        self.generation = {}   # user_id -> счетчик для отмены устаревших событий
+        self.search_started = {}
+        self.profiles = {}
+        self.next_rematch = 0.0
+        # Доля "Следующий" — копия параметра: к концу симуляции ее обнуляем, args не трогаем
+        self.next_rate = args.next_rate
+
+        self.searches = 0
+        self.matches = 0
+        self.rematches = 0
+        self.ai_fallbacks = 0
+        self.ai_interceptions = 0
+        self.cancels = 0
+        self.time_to_match = []
+        self.time_to_ai = []
+        self.join_latency = []
+
+    # --- события -------------------------------------------------------
+    def schedule(self, at: float, kind: str, user_id: int):
+        self.seq += 1
+        heapq.heappush(self.events, (at, self.seq, kind, user_id, self.generation.get(user_id, 0)))
+
+    def bump(self, user_id: int):
+        self.generation[user_id] = self.generation.get(user_id, 0) + 1
+
+    def make_profile(self, user_id: int):
+        a, rng = self.args, self.rng
+        gender = "M" if rng.random() < a.male_share else "F"
+        search = "any" if rng.random() < a.any_share else ("F" if gender == "M" else "M")
+        self.profiles[user_id] = {
+            "is_vip": rng.random() < a.vip_share,
+            "user_gender": gender,
+            "search_gender": search,
+            "age": rng.randint(16, 45),
+            "rating": round(rng.uniform(2.5, 5.0), 2),
+        }
+
+    # --- потоки --------------------------------------------------------
+    async def search(self, user_id: int):
+        now = self.clock.now
+        self.searches += 1
+        self.search_started[user_id] = now
+        self.bump(user_id)
+
+        started = time.perf_counter()
+        partner_id, was_ai = await matchmaker.join_queue(user_id, **self.profiles[user_id])
+        self.join_latency.append(time.perf_counter() - started)
+
+        if not partner_id:
+            self.state[user_id] = "searching"
+            if self.rng.random() < self.args.cancel_rate:
+                self.schedule(now + self.rng.uniform(0, self.args.ai_timeout), "cancel", user_id)
+            return
+
+        self.matches += 1
+        self.time_to_match.append(0.0)
+        if was_ai:
+            self.ai_interceptions += 1
+        else:
+            self.time_to_match.append(now - self.search_started[partner_id])
+        self.bump(partner_id)
+        self.state[user_id] = self.state[partner_id] = "chat"
+        ender = user_id if self.rng.random() < 0.5 else partner_id
+        self.schedule(now + self.rng.expovariate(1 / self.args.chat_mean), "chat_end", ender)
+
+    async def after_chat(self, user_id: int):
+        if self.rng.random() < self.next_rate:
+            self.state[user_id] = "idle"
+            self.schedule(self.clock.now + self.args.think_time, "search", user_id)
+        else:
+            self.state[user_id] = "done"
+
+    async def chat_end(self, user_id: int):
+        if self.state.get(user_id) != "chat":
+            return
+        partner_id = await matchmaker.leave_chat(user_id)
+        self.bump(user_id)
+        await self.after_chat(user_id)
+        if partner_id and partner_id != "AI":
+            self.bump(int(partner_id))
+            await self.after_chat(int(partner_id))
+
+    async def ai_end(self, user_id: int):
+        if self.state.get(user_id) != "ai":
+            return
+        await matchmaker.leave_chat(user_id)
+        self.bump(user_id)
+        await self.after_chat(user_id)
+
+    async def cancel(self, user_id: int):
+        if self.state.get(user_id) != "searching":
+            return
+        self.cancels += 1
+        await matchmaker.remove_from_queue(user_id)
+        self.bump(user_id)
+        self.state[user_id] = "done"
+
+    async def claim_until(self, until: float):
+        """То, что делает ai_fallback_worker: просыпается к дедлайну (в режиме scored,
+        пока кто-то ждет, — и раз в REMATCH_INTERVAL), сводит ожидающих между собой
+        и забирает просроченных"""
+        while True:
+            deadline = await matchmaker.get_next_deadline()
+            if deadline is None:
+                return
+            wake = min(deadline, self.next_rematch) if self.args.mode == "scored" else deadline
+            if wake > until:
+                return
+            self.clock.now = max(self.clock.now, wake)
+            if self.args.mode == "scored":
+                self.next_rematch = self.clock.now + REMATCH_INTERVAL
+                for user_id, partner_id in await matchmaker.rematch_waiting():
+                    self.matches += 1
+                    self.rematches += 1
+                    for member in (user_id, partner_id):
+                        self.time_to_match.append(self.clock.now - self.search_started[member])
+                        self.bump(member)
+                        self.state[member] = "chat"
+                    ender = user_id if self.rng.random() < 0.5 else partner_id
+                    self.schedule(self.clock.now + self.rng.expovariate(1 / self.args.chat_mean), "chat_end", ender)
+            for user_id in await matchmaker.claim_due_users():
+                self.ai_fallbacks += 1
+                self.time_to_ai.append(self.clock.now - self.search_started[user_id])
+                self.bump(user_id)
+                self.state[user_id] = "ai"
+                self.schedule(self.clock.now + self.rng.expovariate(1 / self.args.ai_chat_mean), "ai_end", user_id)
+
+    async def run(self):
+        arrival = self.clock.now
+        for user_id in range(1, self.args.users + 1):
+            arrival += self.rng.expovariate(self.args.rate)
+            self.make_profile(user_id)
+            self.state[user_id] = "idle"
+            self.schedule(arrival, "search", user_id)
+
+        handlers = {
+            "search": self.search, "chat_end": self.chat_end,
+            "ai_end": self.ai_end, "cancel": self.cancel,
+        }
+        while self.events:
+            at, _, kind, user_id, generation = heapq.heappop(self.events)
+            await self.claim_until(at)
+            self.clock.now = max(self.clock.now, at)
+            if kind != "search" and generation != self.generation.get(user_id, 0):
+                continue
+            # ИИ-чат мог быть перехвачен живым собеседником
+            if kind == "ai_end" and self.state.get(user_id) != "ai":
+                continue
+            await handlers[kind](user_id)
+        await self.claim_until(float("inf"))
+        # Тех, кого забрал ИИ в самом конце, тоже отпускаем
+        while self.events:
+            at, _, kind, user_id, generation = heapq.heappop(self.events)
+            self.clock.now = max(self.clock.now, at)
+            if generation == self.generation.get(user_id, 0) and kind in ("ai_end", "chat_end"):
+                self.next_rate = 0
+                await handlers[kind](user_id)
+
+    async def orphaned_keys(self) -> dict:
+        """После того как все ушли, в Redis не должно остаться чатов, очередей и индексов"""
+        orphans = Counter()
+        async for key in self.client.scan_iter(count=1000):
+            prefix = key.split(":", 1)[0]
+            if prefix in ("chat", "chat_session", "session", "user_queue", "qidx", "qbands"):
+                orphans[prefix] += 1
+            elif prefix == "queue" or key.startswith("ai_chats:"):
+                orphans[prefix] += await self.client.zcard(key) if prefix == "queue" else await self.client.scard(key)
+        orphans["queue_deadlines"] = await self.client.zcard("queue_deadlines")
+        orphans["ai_chats"] = await self.client.scard("ai_chats")
+        orphans["ai_chat_bucket"] = await self.client.hlen("ai_chat_bucket")
+        orphans["queue_band"] = await self.client.hlen("queue_band")
+        orphans["live_sessions"] = await self.client.zcard("live_sessions")
+        return {k: v for k, v in orphans.items() if v}
+
+
+async def make_client(args):
+    if args.redis_url:
+        client = redis.Redis.from_url(args.redis_url, decode_responses=True)
+        if await client.dbsize() and not args.flush:
+            raise SystemExit("Redis DB is not empty: pass --flush or use a spare database (e.g. /15)")
+        await client.flushdb()
+        return client
+    import fakeredis
+    return fakeredis.FakeAsyncRedis(decode_responses=True)
+
+
+async def main(args):
+    client = await make_client(args)
+    counter = CommandCounter(client)
+
+    RedisScript.engine = args.engine
+    matchmaker.redis_client = client
+    matchmaker.MATCH_MODE = args.mode
+    matchmaker.AI_FALLBACK_TIMEOUT = args.ai_timeout
+    sim = Simulation(args, client)
+    matchmaker.time = sim.clock
+
+    started = time.perf_counter()
+    await sim.run()
+    elapsed = time.perf_counter() - started
+    orphans = await sim.orphaned_keys()
+    quality = await matchmaker.get_match_quality()
+
+    report = {
+        "users": args.users,
+        "engine": args.engine,
+        "mode": args.mode,
+        "searches": sim.searches,
+        "matches": sim.matches,
+        "rematches": sim.rematches,
+        "ai_fallbacks": sim.ai_fallbacks,
+        "ai_fallback_rate": round(sim.ai_fallbacks / sim.searches, 4) if sim.searches else 0,
+        "ai_interceptions": sim.ai_interceptions,
+        "cancels": sim.cancels,
+        "time_to_match_s": {
+            "p50": round(percentile(sim.time_to_match, 50), 3),
+            "p95": round(percentile(sim.time_to_match, 95), 3),
+            "p99": round(percentile(sim.time_to_match, 99), 3),
+        },
+        "time_to_ai_s_mean": round(statistics.fmean(sim.time_to_ai), 3) if sim.time_to_ai else 0,
+        "join_queue_latency_ms": {
+            "p50": round(percentile(sim.join_latency, 50) * 1000, 3),
+            "p99": round(percentile(sim.join_latency, 99) * 1000, 3),
+        },
+        "redis_round_trips": counter.round_trips,
+        "redis_round_trips_per_match": round(counter.round_trips / sim.matches, 2) if sim.matches else None,
+        "redis_commands": dict(counter.commands.most_common(10)),
+        "match_quality": quality,
+        "orphaned_keys": orphans,
+        "wall_time_s": round(elapsed, 2),
+    }
+
+    if args.json:
+        print(json.dumps(report, ensure_ascii=False, indent=2))
+    else:
+        for key, value in report.items():
+            print(f"{key:>30}: {value}")
+    if hasattr(client, "aclose"):
+        await client.aclose()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Matchmaker load simulation")
+    parser.add_argument("--users", type=int, default=10000, help="virtual users")
+    parser.add_argument("--rate", type=float, default=50.0, help="arrivals per second")
+    parser.add_argument("--male-share", type=float, default=0.7)
+    parser.add_argument("--any-share", type=float, default=0.6, help="share searching for anyone")
+    parser.add_argument("--vip-share", type=float, default=0.05)
+    parser.add_argument("--cancel-rate", type=float, default=0.1, help="share of queued users who cancel")
+    parser.add_argument("--next-rate", type=float, default=0.5, help="share pressing Next after a chat")
+    parser.add_argument("--chat-mean", type=float, default=90.0, help="mean chat duration, s")
+    parser.add_argument("--ai-chat-mean", type=float, default=60.0, help="mean AI chat duration, s")
+    parser.add_argument("--think-time", type=float, default=1.0, help="pause before Next search, s")
+    parser.add_argument("--ai-timeout", type=float, default=10.0)
+    parser.add_argument("--mode", choices=("fifo", "scored"), default="fifo")
+    parser.add_argument("--engine", choices=("lua", "python"), default="lua")
+    parser.add_argument("--redis-url", help="local redis-server instead of fakeredis")
+    parser.add_argument("--flush", action="store_true", help="allow FLUSHDB on a non-empty database")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--json", action="store_true")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    asyncio.run(main(parse_args()))
@@ -3,33 +3,74 @@ import logging
 from aiohttp import web
 from aiogram import Bot, Dispatcher
 from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
-from aiogram.fsm.storage.redis import RedisStorage
 from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
 
 from app.config import BOT_TOKEN, DATABASE_URL, REDIS_URL, WEBHOOK_URL, WEBHOOK_PATH, WEBAPP_HOST, WEBAPP_PORT
-from app.database.models import Base
+from app.database.migrations import migrate
 from app.middlewares.db_middleware import DbSessionMiddleware
+from app.database.lazy_session import instrument_engine
 from app.middlewares.ban_middleware import BanCheckMiddleware
 from app.middlewares.throttling import ThrottlingMiddleware
+from app.middlewares.ordering import UserOrderingMiddleware
+from app.middlewares.reachability import ReachabilityMiddleware
+from app.middlewares.outbound import OutboundSchedulerMiddleware
+from app.middlewares.activity import ActivityMiddleware
+from app.middlewares.album import AlbumMiddleware
 
 from app.handlers import admin, menu, chat
-from app.services.ai_worker import ai_fallback_worker
+from app.services.ai_worker import ai_fallback_worker, session_sweeper
+from app.services.matchmaker import redis_client, session_touches, session_touch_pusher
+from app.services.route_cache import RouteAwareRedisStorage, listen_route_invalidations
+from app.services.profile_cache import listen_profile_invalidations
+from app.services.ban_registry import ban_registry, ban_refresher
+from app.services.ratings import rating_flusher
+from app.services.stats import rebuild_stats
+from app.services.broadcast import resume_broadcasts, stop_broadcasts
+from app.services.reachability import bootstrap_reachability, reachability_flusher
+from app.services.activity import activity, activity_pusher, last_seen_flusher
 
 # Глобальные переменные для БД и тасок
 engine = None
 ai_task = None
+sweeper_task = None
+route_task = None
+profile_task = None
+ban_task = None
+rating_task = None
+reachability_task = None
+activity_task = None
+last_seen_task = None
+session_touch_task = None
 
 async def on_startup(bot: Bot, dispatcher: Dispatcher):
-    global engine, ai_task
+    global engine, ai_task, sweeper_task, route_task, profile_task, ban_task, rating_task, reachability_task
+    global activity_task, last_seen_task, session_touch_task
     logging.info("Starting up...")
     
     # Инициализация БД
     engine = create_async_engine(DATABASE_URL, echo=False)
-    async with engine.begin() as conn:
-        await conn.run_sync(Base.metadata.create_all)
+    instrument_engine(engine)
+    # Проверка версии схемы (и миграции, если она отстала) вместо create_all
+    await migrate(engine)
         
     session_pool = async_sessionmaker(engine, expire_on_commit=False)
     dispatcher.update.outer_middleware(DbSessionMiddleware(session_pool))
+    # Пул нужен фоновым задачам, запускаемым из хендлеров (рассылки)
+    dispatcher["session_pool"] = session_pool
+    
+    # Реестр банов: собираем из БД до приема апдейтов, дальше — из памяти
+    async with session_pool() as session:
+        await ban_registry.bootstrap(session)
+        await rebuild_stats(session)
+    ban_task = asyncio.create_task(ban_refresher())
+    # Пакетная запись оценок из буфера в Redis
+    rating_task = asyncio.create_task(rating_flusher(session_pool))
+    # Кто заблокировал бота: set в Redis из БД, дальше — пакетная запись изменений
+    await bootstrap_reachability(session_pool)
+    reachability_task = asyncio.create_task(reachability_flusher(session_pool))
+    # Активность: из памяти в Redis (DAU/WAU), из Redis в users.last_seen_at
+    activity_task = asyncio.create_task(activity_pusher())
+    last_seen_task = asyncio.create_task(last_seen_flusher(session_pool))
     
     # Устанавливаем вебхук в Telegram
     await bot.set_webhook(url=WEBHOOK_URL, drop_pending_updates=True)
@@ -37,15 +78,55 @@ async def on_startup(bot: Bot, dispatcher: Dispatcher):
     # Запускаем фоновый воркер ИИ
     storage = dispatcher.storage
     ai_task = asyncio.create_task(ai_fallback_worker(bot, storage))
+    sweeper_task = asyncio.create_task(session_sweeper())
+    # Счетчики сообщений и продление сессий чатов — пачкой из памяти
+    session_touch_task = asyncio.create_task(session_touch_pusher())
+    # Инвалидация локального кэша маршрутов (чаты, завершенные на любом узле)
+    route_task = asyncio.create_task(listen_route_invalidations(redis_client))
+    # ...и кэша профилей (изменения профиля/VIP на любом узле)
+    profile_task = asyncio.create_task(listen_profile_invalidations())
+    # Рассылки, прерванные рестартом, продолжаются с чекпоинта
+    await resume_broadcasts(bot, session_pool)
     logging.info(f"Webhook set to {WEBHOOK_URL}")
 
 async def on_shutdown(bot: Bot, dispatcher: Dispatcher):
-    global engine, ai_task
+    global engine, ai_task, sweeper_task, route_task, profile_task, ban_task, rating_task, reachability_task
+    global activity_task, last_seen_task, session_touch_task
     logging.info("Shutting down...")
     
-    # Останавливаем ИИ
+    # Останавливаем ИИ и очистку сессий
     if ai_task:
         ai_task.cancel()
+    if sweeper_task:
+        sweeper_task.cancel()
+    if route_task:
+        route_task.cancel()
+    if profile_task:
+        profile_task.cancel()
+    if ban_task:
+        ban_task.cancel()
+    if rating_task:
+        # Несброшенные оценки остаются в Redis и уйдут в БД после рестарта
+        rating_task.cancel()
+    if reachability_task:
+        reachability_task.cancel()
+    if activity_task:
+        activity_task.cancel()
+    if last_seen_task:
+        last_seen_task.cancel()
+    if session_touch_task:
+        session_touch_task.cancel()
+    # Отметки активности из памяти — в Redis (в БД уйдут после рестарта)
+    try:
+        await activity.push()
+    except Exception as e:
+        logging.error(f"Activity push error: {e}")
+    try:
+        await session_touches.push()
+    except Exception as e:
+        logging.error(f"Session touch push error: {e}")
+    # Незавершенные рассылки продолжит следующий запуск
+    stop_broadcasts()
         
     # Удаляем вебхук
     await bot.delete_webhook()
@@ -59,10 +140,19 @@ def main():
     logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
     
     bot = Bot(token=BOT_TOKEN)
-    storage = RedisStorage.from_url(REDIS_URL)
+    # Отмечаем заблокировавших бота на любом исходящем запросе
+    bot.session.middleware(ReachabilityMiddleware())
+    # Все отправки узла — через общий и початовые лимиты с полосами приоритета
+    bot.session.middleware(OutboundSchedulerMiddleware())
+    storage = RouteAwareRedisStorage.from_url(REDIS_URL)
     dp = Dispatcher(storage=storage)
 
     # Регистрация Middlewares (БД регистрируется в on_startup, чтобы избежать конфликтов)
+    # Альбом собирается в один апдейт до всего остального (троттлинг видит одно событие)
+    dp.update.outer_middleware(AlbumMiddleware())
+    # Порядок апдейтов одного юзера — до сессии БД
+    dp.update.outer_middleware(UserOrderingMiddleware())
+    dp.update.outer_middleware(ActivityMiddleware())
     dp.message.outer_middleware(BanCheckMiddleware())
     dp.callback_query.outer_middleware(BanCheckMiddleware())
     dp.message.middleware(ThrottlingMiddleware())